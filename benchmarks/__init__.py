@@ -0,0 +1 @@
+"""Benchmarks and diagnostics, run as modules e.g. `python -m benchmarks.query_plans`."""
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Compares the allocation summary and HPC storage blocks/cost computation
+with the row by row Python loops it replaced, checking both give the same
+result. The allocation summary now charges blocks and totals per
+biller/managerunit in SQL, in one query over all four storage systems, and HPC
+storage builds its records in one pass.
+
+Usage:
+    python -m benchmarks.cost_computation [--db-uri URI] [--users N] [--months N]
+        [--units N] [--repeat N]
+
+The default 5000 users over 24 months is 120k rows in each usage table. The
+target database is wiped, so point it at a scratch database. Defaults to an
+in-memory SQLite database.
+"""
+import argparse
+import math
+import time
+
+from benchmarks import synthetic
+from supersummariser.database import db
+import supersummariser.database as d
+import supersummariser.processors as p
+import supersummariser.services as services
+from sqlalchemy import func, literal_column
+
+
+def _row_by_row_allocation(sources, config, by_month):
+    """ what _live_allocationsummary_simple/chart used to do with the rows of
+        its four grouped queries """
+    summed_totals = {}
+    for source in sources:
+        for curr in source.all():
+            key = (curr.biller, curr.managerunit)
+            blocks = int(math.ceil(curr.usage / config.get('STORAGE_BLOCK_SIZE_GB')))
+            cost = blocks * curr.unit_price
+            try:
+                record = summed_totals[key]
+            except KeyError:
+                summed_totals[key] = {
+                    'usage': 0,
+                    'blocks': 0,
+                    'cost': 0
+                }
+                record = summed_totals[key]
+            record['usage'] += curr.usage
+            record['blocks'] += blocks
+            record['cost'] += cost
+            if by_month:
+                record['month'] = curr.month
+                record['year'] = curr.year
+    result = []
+    for key, record in summed_totals.items():
+        record.update({'biller': key[0], 'managerunit': key[1]})
+        result.append(services._clean_types(record))
+    return result
+
+
+def _allocation_sources(filters_for, by_month):
+    """ the four grouped queries the loop used. They're ordered as SQLite
+        happens to return them, as on PostgreSQL the month the loop saw last
+        could otherwise be any of them. """
+    result = []
+    for i, (model, key_column, usage_gb) in enumerate(services.ALLOCATION_USAGE_GB):
+        partial = services._allocation_source(i, model, key_column, usage_gb,
+            filters_for(model), by_month=by_month)
+        if by_month:
+            partial = partial.order_by(*[literal_column(x) for x in
+                ('biller', 'managerunit', 'unit_price', 'year', 'month')])
+        result.append(partial)
+    return result
+
+
+def _row_by_row_hpcstorage(config):
+    """ what _live_hpcstorage_chart used to do with the aggregated usage """
+    found = services._usage_by_contract(p.CONTRACT_TYPE_ERSA_ACCOUNT, d.HpcHomeUsage.owner,
+        (d.HpcHomeUsage.year, d.HpcHomeUsage.month),
+        (func.sum(d.HpcHomeUsage.usage),),
+        (services._since_month_window(d.HpcHomeUsage, 24),),
+        by_unit_price=False)
+    result = []
+    for key, sums in found.items():
+        item = services.build_dict(key, ['biller', 'managerunit', 'year', 'month'])
+        raw_usage = sums[0]
+        usage_gb = raw_usage * 1024 / services.BYTES_TO_GB
+        item['usage'] = usage_gb
+        if usage_gb < 1 and round(usage_gb) == 0:
+            blocks = 0
+        else:
+            blocks = int(math.ceil(usage_gb / config.get('STORAGE_BLOCK_SIZE_GB')))
+        item['blocks'] = blocks
+        item['cost'] = blocks * config.get('HPC_HOME_BLOCK_PRICE')
+        item['service'] = 'HPC Storage'
+        result.append(services._clean_types(item))
+    return result
+
+
+def _comparable(records, fields):
+    return sorted(tuple(round(x[f], 6) if isinstance(x[f], float) else x[f] for f in fields)
+        for x in records)
+
+
+def _time_ms(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _report(label, baseline, optimised, fields, repeat):
+    if _comparable(baseline(), fields) != _comparable(optimised(), fields):
+        raise AssertionError('%s: the results differ' % label)
+    baseline_ms = _time_ms(baseline, repeat)
+    optimised_ms = _time_ms(optimised, repeat)
+    print('%-26s row by row: %8.1f ms   now: %8.1f ms   speedup: %.1fx' %
+        (label, baseline_ms, optimised_ms, baseline_ms / optimised_ms))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-uri', default='sqlite://')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--units', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    app = synthetic.create_bench_app(args.db_uri)
+    config = app.config
+    storage_fields = ('biller', 'managerunit', 'usage', 'blocks', 'cost')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        synthetic.seed_database(args.users, args.months, args.units)
+        if db.engine.dialect.name == 'postgresql':
+            # without statistics the fresh tables are planned as near empty
+            db.session.execute('ANALYZE')
+            db.session.commit()
+        now = services._now_provider()
+        print('%d rows per usage table' % d.HnasVVUsage.query.count())
+        def in_month(model):
+            return (model.year == now.year, model.month == now.month)
+        def in_window(model):
+            return (services._since_month_window(model, 24),)
+        _report('allocationsummary/simple',
+            lambda: _row_by_row_allocation(_allocation_sources(in_month, False), config, False),
+            lambda: services._live_allocationsummary_simple(now.year, now.month, config),
+            storage_fields, args.repeat)
+        _report('allocationsummary/chart',
+            lambda: _row_by_row_allocation(_allocation_sources(in_window, True), config, True),
+            lambda: services._live_allocationsummary_chart(None, 24, config),
+            storage_fields + ('year', 'month'), args.repeat)
+        _report('hpcstorage/chart',
+            lambda: _row_by_row_hpcstorage(config),
+            lambda: services._live_hpcstorage_chart(None, 24, config),
+            storage_fields + ('year', 'month'), args.repeat)
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
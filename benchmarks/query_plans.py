@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Shows the query plans (and timings) for the raw usage queries behind the
+/<service>/simple and /<service>/chart endpoints (and the rollup refresh)
+with and without the secondary indexes.
+
+Usage:
+    python -m benchmarks.query_plans [--db-uri URI] [--users N] [--months N]
+
+The target database is wiped, so point it at a scratch database. Defaults
+to an in-memory SQLite database.
+"""
+import argparse
+import time
+
+import pendulum
+from sqlalchemy import event
+
+from benchmarks import synthetic
+from supersummariser.database import db
+import supersummariser.database as d
+import supersummariser.services as services
+
+INDEXED_MODELS = synthetic.USAGE_MODELS + (d.Contract, d.AccountContact, d.NovaFlavor)
+
+
+def _capture_statements(fn):
+    """ runs fn and returns the (statement, parameters) it sent to the DB """
+    captured = []
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        fn()
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    return captured
+
+
+def _explain(statement, parameters):
+    if db.engine.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN ANALYZE '
+    else:
+        prefix = 'EXPLAIN QUERY PLAN '
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(prefix + statement, parameters)
+        return [' '.join(str(x) for x in row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+
+def _set_indexes(enabled):
+    for model in INDEXED_MODELS:
+        for index in model.__table__.indexes:
+            if enabled:
+                index.create(db.engine, checkfirst=True)
+            else:
+                index.drop(db.engine, checkfirst=True)
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+
+def _calls(config):
+    now = pendulum.now()
+    year, month = now.year, now.month
+    return [
+        ('hpcsummary/simple', lambda: services._live_hpcsummary_simple(year, month, config)),
+        ('hpcsummary/chart', lambda: services._live_hpcsummary_chart(None, 12, config)),
+        ('allocationsummary/simple', lambda: services._live_allocationsummary_simple(year, month, config)),
+        ('allocationsummary/chart', lambda: services._live_allocationsummary_chart(None, 12, config)),
+        ('hpcstorage/simple', lambda: services._live_hpcstorage_simple(year, month, config)),
+        ('hpcstorage/chart', lambda: services._live_hpcstorage_chart(None, 12, config)),
+        ('nectar/simple', lambda: services._live_nectar_simple(year, month, config)),
+        ('nectar/chart', lambda: services._live_nectar_chart(None, 12, config)),
+        ('tango/simple', lambda: services._live_tango_simple(year, month, config)),
+        ('tango/chart', lambda: services._live_tango_chart(None, 12, config)),
+    ]
+
+
+def _report(label, config):
+    print('=' * 20, label, '=' * 20)
+    for name, call in _calls(config):
+        start = time.perf_counter()
+        statements = _capture_statements(call)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        print('--- %s (%.1f ms, %d queries)' % (name, elapsed_ms, len(statements)))
+        for statement, parameters in statements:
+            for line in _explain(statement, parameters):
+                print('    ' + line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-uri', default='sqlite://')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--months', type=int, default=24)
+    args = parser.parse_args()
+    app = synthetic.create_bench_app(args.db_uri)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        synthetic.seed_database(args.users, args.months)
+        _set_indexes(False)
+        _report('before (no secondary indexes)', app.config)
+        _set_indexes(True)
+        _report('after (with indexes)', app.config)
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Compares /summary/<year>/<month> with calling the five
+/<service>/simple endpoints, both while the rollup is stale (live queries)
+and once it has been refreshed.
+
+Usage:
+    python -m benchmarks.summary [--db-uri URI] [--users N] [--months N] [--repeat N]
+
+The target database is wiped, so point it at a scratch database. Defaults
+to an in-memory SQLite database.
+"""
+import argparse
+import time
+
+import pendulum
+
+from benchmarks import synthetic
+from supersummariser.database import db
+import supersummariser.services as services
+
+
+def _time_ms(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+def _report(label, config, repeat):
+    now = pendulum.now()
+    def five_calls():
+        services.get_hpcsummary_simple(now.year, now.month, config)
+        services.get_allocationsummary_simple(now.year, now.month, config)
+        services.get_hpcstorage_simple(now.year, now.month, config)
+        services.get_nectar_simple(now.year, now.month, config)
+        services.get_tango_simple(now.year, now.month, config)
+    def summary():
+        services.get_summary(now.year, now.month, config)
+    five_ms = _time_ms(five_calls, repeat)
+    summary_ms = _time_ms(summary, repeat)
+    print('%-10s five /simple calls: %8.1f ms   /summary: %8.1f ms   speedup: %.1fx' %
+        (label, five_ms, summary_ms, five_ms / summary_ms))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-uri', default='sqlite://')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    app = synthetic.create_bench_app(args.db_uri)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        synthetic.seed_database(args.users, args.months)
+        synthetic.mark_all_stale()
+        _report('stale', app.config, args.repeat)
+        services.refresh_rollups(app.config)
+        _report('rollup', app.config, args.repeat)
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
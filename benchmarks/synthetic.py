@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Synthetic data for the benchmarks"""
+import random
+
+import pendulum
+
+from supersummariser.app import create_app
+from supersummariser.cache import ALL_SERVICES
+from supersummariser.database import db
+import supersummariser.database as d
+import supersummariser.processors as p
+from supersummariser.settings import TestConfig
+
+USAGE_MODELS = (d.HpcSummaryUsage, d.HnasVVUsage, d.HnasFSUsage, d.HcpUsage,
+    d.XfsUsage, d.HpcHomeUsage, d.NectarUsage, d.TangoUsage)
+
+
+def seed_database(users, months, units=7):
+    """ adds contracts for `users` accounts of every contract type, spread
+        over `units` managerunits, and a usage record per account per table
+        for the last `months` months """
+    rnd = random.Random(42)
+    now = pendulum.now()
+    contract_specs = [
+        (p.CONTRACT_TYPE_ERSA_ACCOUNT, lambda i: {}),
+        (p.CONTRACT_TYPE_STORAGE, lambda i: {'file_system_name': 'fs%d' % i}),
+        (p.CONTRACT_TYPE_NECTAR, lambda i: {'openstack_project_id': 'tenant%d' % i}),
+        (p.CONTRACT_TYPE_TANGO, lambda i: {'openstack_project_id': 'vm%d' % i}),
+    ]
+    for i in range(users):
+        for contract_type, extra in contract_specs:
+            db.session.add(d.Account(
+                order_id=str(i), name='acc%d' % i, biller='Biller %d' % (i % 20),
+                account_contact=d.AccountContact(managerusername='user%d' % i,
+                    managerunit='Unit %d' % (i % units)),
+                contract=d.Contract(contract_type=contract_type, unit_price=1, **extra(i))))
+    db.session.add(d.NovaFlavor(openstack_id='flavor1', vcpus=2))
+    db.session.commit()
+    for months_ago in range(months):
+        when = now.subtract(months=months_ago)
+        ym = {'year': when.year, 'month': when.month}
+        def rows(build):
+            return [dict(ym, **build(i)) for i in range(users)]
+        d.bulk_insert(d.HpcSummaryUsage, rows(lambda i: {'owner': 'user%d' % i,
+            'cores': rnd.randint(1, 64), 'cpu_seconds': rnd.randint(1, 10**6), 'job_count': 1}))
+        d.bulk_insert(d.HnasVVUsage, rows(lambda i: {'virtual_volume': 'fs%d' % i, 'usage': rnd.randint(1, 10**6)}))
+        d.bulk_insert(d.HnasFSUsage, rows(lambda i: {'filesystem': 'fs%d' % i, 'live_usage': rnd.randint(1, 10**6)}))
+        d.bulk_insert(d.HcpUsage, rows(lambda i: {'namespace': 'fs%d' % i, 'ingested_bytes': rnd.randint(1, 10**12)}))
+        d.bulk_insert(d.XfsUsage, rows(lambda i: {'filesystem': 'fs%d' % i, 'usage': rnd.randint(1, 10**9)}))
+        d.bulk_insert(d.HpcHomeUsage, rows(lambda i: {'owner': 'user%d' % i, 'usage': rnd.randint(1, 10**9)}))
+        d.bulk_insert(d.NectarUsage, rows(lambda i: {'tenant': 'tenant%d' % i, 'flavor': 'flavor1'}))
+        d.bulk_insert(d.TangoUsage, rows(lambda i: {'vm_id': 'vm%d' % i, 'core': rnd.randint(1, 8)}))
+    db.session.commit()
+
+
+def create_bench_app(db_uri):
+    """ an app pointed at the scratch database """
+    class BenchConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = db_uri
+    return create_app(BenchConfig)
+
+
+def mark_all_stale():
+    """ forces the next refresh_rollups to rebuild every month """
+    for curr in ALL_SERVICES:
+        db.session.add(d.RollupStale(service=curr))
+    db.session.commit()
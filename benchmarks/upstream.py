@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for USAGE_SERVER, CRM_SERVER and REPORTING_SERVER that
+serves synthetic payloads, so ingestion can be benchmarked end to end.
+
+The same `users` accounts appear in the CRM (ersa_account and attached
+storage contracts) and in the HPC, storage and home directory usage, and the
+same `vms` in the Tango/NECTAR contracts and usage, so everything ingested
+joins up. Payloads are deterministic for a given month so a second harvest
+finds them unchanged. Months more than `months` back return a 404, like the
+real servers do for months without data.
+"""
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pendulum
+
+from supersummariser.processors import adelaide_tz
+
+FILESYSTEM_ID = 'fs-hpchome'
+FLAVOR_ID = 'flavor1'
+
+
+class SyntheticData(object):
+    def __init__(self, billers=20, users=2000, vms=500, months=3, units=50):
+        self.billers = billers
+        self.users = users
+        self.vms = vms
+        self.months = months
+        self.units = units
+        now = pendulum.now(tz=adelaide_tz)
+        self.available_months = set()
+        for curr in range(months):
+            when = now.subtract(months=curr)
+            self.available_months.add((when.year, when.month))
+        self._routes = [
+            ('/api/v2/contract/ersaaccount/', self._ersaaccount_contracts, False),
+            ('/api/v2/contract/attachedstorage/', self._storage_contracts, False),
+            ('/api/v2/contract/attachedbackupstorage/', self._backup_contracts, False),
+            ('/api/v2/contract/nectarcloudvm/', self._nectar_contracts, False),
+            ('/api/v2/contract/tangocloudvm/', self._tango_contracts, False),
+            ('/nova/flavor', self._flavors, False),
+            ('/xfs/filesystem', self._filesystems, False),
+            ('/hpc/job/summary', self._hpcsummary, True),
+            ('/hnas/virtual-volume%2Fusage/summary', self._hnasvv, True),
+            ('/hnas/filesystem%2Fusage/summary', self._hnasfs, True),
+            ('/hcp/usage/summary', self._hcp, True),
+            ('/xfs/usage/summary', self._xfs, True),
+            ('/xfs/filesystem/%s/summary' % FILESYSTEM_ID, self._hpchome, True),
+            ('/vms/instance', self._tango, True),
+        ]
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def _biller(self, i):
+        return 'Biller %d' % (i % self.billers)
+
+    def _unit(self, i):
+        return 'Unit %d' % (i % self.units)
+
+    def _contract(self, prefix, i, **extra):
+        result = {
+            'orderID': '%s-%d' % (prefix, i),
+            'name': '%s account %d' % (prefix, i),
+            'biller': self._biller(i),
+            'allocated': 1,
+            'unitPrice': '0.5',
+            'managerusername': 'user%d' % i,
+            'manageremail': 'user%d@example.edu.au' % i,
+            'managertitle': 'Dr',
+            'managerunit': self._unit(i),
+            'manager': 'User %d' % i,
+        }
+        result.update(extra)
+        return result
+
+    def _ersaaccount_contracts(self):
+        return [self._contract('hpc', i) for i in range(self.users)]
+
+    def _storage_contracts(self):
+        return [self._contract('storage', i, FileSystemName='fs%d' % i) for i in range(self.users)]
+
+    def _backup_contracts(self):
+        return [self._contract('backup', i, FileSystemName='ns%d' % i)
+            for i in range(0, self.users, 10)]
+
+    def _nectar_contracts(self):
+        return [self._contract('nectar', i, OpenstackProjectID='tenant%d' % i)
+            for i in range(self.vms)]
+
+    def _tango_contracts(self):
+        return [self._contract('tango', i, OpenstackProjectID='vm%d' % i) for i in range(self.vms)]
+
+    def _flavors(self):
+        return [{'id': FLAVOR_ID, 'openstack_id': FLAVOR_ID, 'vcpus': 2, 'name': 'm1.small',
+            'ram': 4096, 'disk': 30, 'ephemeral': 0, 'public': True}]
+
+    def _filesystems(self):
+        return [{'id': FILESYSTEM_ID, 'name': 'hpchome'}]
+
+    def _hpcsummary(self, rnd):
+        return [{'owner': 'user%d' % i, 'queue': 'batch', 'cores': rnd.randint(1, 64),
+            'cpu_seconds': rnd.randint(1, 10 ** 7), 'job_count': rnd.randint(1, 100)}
+            for i in range(self.users)]
+
+    def _hnasvv(self, rnd):
+        return [{'virtual_volume': 'fs%d' % i, 'filesystem': 'hnas1', 'owner': 'user%d' % i,
+            'usage': rnd.randint(1, 10 ** 7), 'files': rnd.randint(1, 10 ** 5),
+            'quota': 10 ** 7} for i in range(self.users)]
+
+    def _hnasfs(self, rnd):
+        return [{'filesystem': 'fs%d' % i, 'live_usage': rnd.randint(1, 10 ** 7),
+            'capacity': 10 ** 7, 'snapshot_usage': 0, 'free': 0}
+            for i in range(0, self.users, 10)]
+
+    def _hcp(self, rnd):
+        return [{'namespace': 'ns%d' % i, 'ingested_bytes': rnd.randint(1, 10 ** 13),
+            'raw_bytes': 0, 'reads': 0, 'writes': 0, 'deletes': 0, 'objects': 0, 'bytes_in': 0,
+            'bytes_out': 0, 'metadata_only_objects': 0, 'metadata_only_bytes': 0,
+            'tiered_objects': 0, 'tiered_bytes': 0} for i in range(0, self.users, 10)]
+
+    def _xfs(self, rnd):
+        return [{'filesystem': 'fs%d' % i, 'host': 'xfs1', 'usage': rnd.randint(1, 10 ** 9),
+            'soft': 10 ** 9, 'hard': 10 ** 9} for i in range(self.users)]
+
+    def _hpchome(self, rnd):
+        return [{'owner': 'user%d' % i, 'usage': rnd.randint(1, 10 ** 8), 'soft': 10 ** 8,
+            'hard': 10 ** 8} for i in range(self.users)]
+
+    def _tango(self, rnd):
+        return [{'id': 'vm%d' % i, 'businessUnit': self._unit(i), 'core': rnd.randint(1, 16),
+            'os': 'linux', 'ram': 8, 'server': 'tango%d' % i, 'storage': 100,
+            'span': 2592000} for i in range(self.vms)]
+
+    def _nectar(self, rnd):
+        return [{'tenant': 'tenant%d' % i, 'flavor': FLAVOR_ID, 'instance_id': 'i-%d' % i,
+            'manager': [self._biller(i), self._unit(i)], 'server': 'nectar%d' % i,
+            'server_id': 's-%d' % i, 'az': 'sa', 'account': 'acc%d' % i, 'image': 'centos',
+            'span': 2592000, 'hypervisor': 'hv1'} for i in range(self.vms)]
+
+    def _month_of(self, start_secs):
+        when = pendulum.from_timestamp(int(start_secs), tz=adelaide_tz)
+        return (when.year, when.month)
+
+    def body_for(self, raw_path):
+        """ the payload bytes for the request path (not unquoted, some of
+            the real paths contain %2F), None for a 404 """
+        parts = urlsplit(raw_path)
+        build, month = None, None
+        nectar = re.match(r'^/usage/nova/NovaUsage_(\d+)_(\d+)\.json$', parts.path)
+        if nectar:
+            build, month = self._nectar, self._month_of(nectar.group(1))
+        else:
+            for path, fn, is_monthly in self._routes:
+                if parts.path != path:
+                    continue
+                build = fn
+                if is_monthly:
+                    start = parse_qs(parts.query).get('start')
+                    if not start:
+                        return None
+                    month = self._month_of(start[0])
+                break
+        if build is None or (month is not None and month not in self.available_months):
+            return None
+        key = (parts.path, month)
+        with self._lock:
+            try:
+                return self._bodies[key]
+            except KeyError:
+                pass
+        records = build(random.Random('%s %s' % key)) if month else build()
+        result = json.dumps(records).encode('utf-8')
+        with self._lock:
+            self._bodies[key] = result
+        return result
+
+
+def _handler_for(data):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            body = data.body_for(self.path)
+            if body is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # far too noisy for a benchmark
+    return Handler
+
+
+class FakeUpstream(object):
+    """ serves the SyntheticData on a free local port, on a background
+        thread, until stopped """
+
+    def __init__(self, data):
+        self.data = data
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _handler_for(data))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -0,0 +1,100 @@
+"""partition the usage tables by month on PostgreSQL
+
+Revision ID: c717fdc4488f
+Revises: 35c8a8cb6b32
+Create Date: 2026-10-17 19:25:55.416977
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c717fdc4488f'
+down_revision = '35c8a8cb6b32'
+branch_labels = None
+depends_on = None
+
+# table: (year/month index, its columns)
+TABLES = {
+    'hpc_summary_usage': ('ix_hpc_summary_usage_year_month_owner', ['year', 'month', 'owner']),
+    'hnas_vv_usage': ('ix_hnas_vv_usage_year_month_virtual_volume', ['year', 'month', 'virtual_volume']),
+    'hnas_fs_usage': ('ix_hnas_fs_usage_year_month_filesystem', ['year', 'month', 'filesystem']),
+    'hcp_usage': ('ix_hcp_usage_year_month_namespace', ['year', 'month', 'namespace']),
+    'xfs_usage': ('ix_xfs_usage_year_month_filesystem', ['year', 'month', 'filesystem']),
+    'hpc_home_usage': ('ix_hpc_home_usage_year_month_owner', ['year', 'month', 'owner']),
+    'nectar_usage': ('ix_nectar_usage_year_month_tenant_flavor', ['year', 'month', 'tenant', 'flavor']),
+    'tango_usage': ('ix_tango_usage_year_month_vm_id', ['year', 'month', 'vm_id']),
+}
+
+
+def _partition_ddl(table, year, month):
+    # must match supersummariser.database.month_partition_name, which creates new months
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return 'CREATE TABLE %s_y%04dm%02d PARTITION OF %s FOR VALUES FROM (%d, %d) TO (%d, %d)' % (
+        table, year, month, table, year, month, next_year, next_month)
+
+
+def _replace_table(table, index_name, index_columns, partitioned):
+    """ swaps the table for a (non-)partitioned copy. The copy is built LIKE
+        the original, so the columns and the id sequence default carry over,
+        then the rows are moved and the sequence handed over before the
+        original is dropped. """
+    bind = op.get_bind()
+    old = table + '_old'
+    op.drop_index(index_name, table_name=table)
+    op.rename_table(table, old)
+    op.execute('ALTER INDEX %s_pkey RENAME TO %s_pkey' % (table, old))
+    if partitioned:
+        op.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS) PARTITION BY RANGE (year, month)' %
+            (table, old))
+        # the partition key has to be part of the primary key, which makes year/month NOT NULL
+        op.execute('ALTER TABLE %s ADD CONSTRAINT %s_pkey PRIMARY KEY (id, year, month)' %
+            (table, table))
+        months = bind.execute(sa.text('SELECT DISTINCT year, month FROM %s '
+            'WHERE year IS NOT NULL AND month IS NOT NULL' % old)).fetchall()
+        for year, month in months:
+            op.execute(_partition_ddl(table, year, month))
+        # rows without a month were never returned by any query, they can't be partitioned
+        op.execute('INSERT INTO %s SELECT * FROM %s WHERE year IS NOT NULL AND month IS NOT NULL' %
+            (table, old))
+    else:
+        op.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (table, old))
+        op.execute('ALTER TABLE %s ALTER COLUMN year DROP NOT NULL, ALTER COLUMN month DROP NOT NULL' %
+            table)
+        op.execute('ALTER TABLE %s ADD CONSTRAINT %s_pkey PRIMARY KEY (id)' % (table, table))
+        op.execute('INSERT INTO %s SELECT * FROM %s' % (table, old))
+    op.create_index(index_name, table, index_columns, unique=False)
+    op.execute('ALTER SEQUENCE %s_id_seq OWNED BY %s.id' % (table, table))
+    op.execute('DROP TABLE %s' % old)
+
+
+def _supports_partitioning(bind):
+    """ PostgreSQL 11 or later. 10 can partition but not with the primary key
+        and index the tables need, so they're left plain there. """
+    return bind.dialect.name == 'postgresql' and \
+        int(bind.execute(sa.text('SHOW server_version_num')).scalar()) >= 110000
+
+
+def _is_partitioned(bind, table):
+    return bind.execute(sa.text('SELECT 1 FROM pg_partitioned_table pt '
+        'JOIN pg_class c ON c.oid = pt.partrelid '
+        'WHERE c.relname = :name AND pg_table_is_visible(c.oid)'), {'name': table}).first() is not None
+
+
+def upgrade():
+    bind = op.get_bind()
+    if not _supports_partitioning(bind):
+        return
+    for table, (index_name, index_columns) in TABLES.items():
+        _replace_table(table, index_name, index_columns, True)
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+    for table, (index_name, index_columns) in TABLES.items():
+        # only those upgrade partitioned, none before PostgreSQL 11
+        if _is_partitioned(bind, table):
+            _replace_table(table, index_name, index_columns, False)
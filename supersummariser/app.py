@@ -1,19 +1,33 @@
 # -*- coding: utf-8 -*-
 """The app module, containing the app factory function."""
+import hashlib
+import hmac
 import logging
+import time
 
-from flask import Flask, jsonify, request, abort, Response, current_app
+import click
+from flask import Flask, jsonify, request, abort, Response, current_app, g
 from voluptuous import All, Length, Range, Coerce, Schema,\
     MultipleInvalid, Optional, Any
 
+from supersummariser import backfill, cache, compression, encoding, jobs, metrics, profiling, \
+    scheduler
 from supersummariser.extensions import db, migrate
 from supersummariser.settings import ProdConfig
+import supersummariser.processors as processors
 import supersummariser.services as services
 
 logging.basicConfig()
 logger = logging.getLogger('app')
 logger.setLevel(logging.DEBUG)
 
+FORMAT_RECORDS = 'records' # a list of objects
+FORMAT_COLUMNAR = 'columnar' # see encoding.to_columns
+RESPONSE_VERSION = 1 # bump when the shape of a response changes, so old ETags no longer match
+# config that changes the responses, so it's part of the ETags
+ETAG_CONFIG_KEYS = ('STORAGE_BLOCK_SIZE_GB', 'HPC_HOME_BLOCK_PRICE', 'NECTAR_NOVA_VCPU_PRICE',
+    'HPC_STORAGE_FSNAME')
+
 
 def create_app(config_object=ProdConfig):
     """An application factory, as explained here: http://flask.pocoo.org/docs/patterns/appfactories/.
@@ -24,6 +38,8 @@ def create_app(config_object=ProdConfig):
     app.config.from_object(config_object)
     _log_config(app.config)
     register_extensions(app)
+    register_commands(app)
+    register_request_metrics(app)
     add_routes(app)
     return app
 
@@ -44,15 +60,128 @@ def _log_config(config):
     log_for('AUTH_HEADER_KEY')
     log_for('SSL_VERIFY')
     log_for('REMOTE_SERVER_CONNECT_TIMEOUT_SECS')
+    log_for('HTTP_POOL_MAXSIZE')
+    log_for('HTTP_MAX_RETRIES')
+    log_for('HTTP_RETRY_BACKOFF_SECS')
+    log_for('STREAM_JSON')
+    log_for('INGEST_BATCH_SIZE')
+    log_for('STAGED_MONTH_SWAP')
+    log_for('VACUUM_AFTER_INGEST')
+    log_for('SKIP_UNCHANGED_PAYLOADS')
+    log_for('SPOOL_MAX_MEMORY_BYTES')
+    log_for('PROCESS_WORKERS')
+    log_for('TRANSFORM_PROCESSES')
+    log_for('RESPONSE_CACHE_SIZE')
+    log_for('RESPONSE_CACHE_TTL_SECS')
+    log_for('PROCESS_JOB_HISTORY')
+    log_for('SCHEDULE_CURRENT_MONTH_SECS')
+    log_for('SCHEDULE_CONTRACTS_SECS')
+    log_for('SCHEDULE_HISTORICAL_SECS')
+    log_for('SCHEDULE_HISTORICAL_MONTHS')
+    log_for('SCHEDULE_JITTER_SECS')
+    log_for('SCHEDULE_LOCK_FILE')
+    log_for('STREAM_RESPONSE_MIN_RECORDS')
+    log_for('DATA_VERSION_ETAGS')
+    log_for('COMPRESS_MIN_BYTES')
+    log_for('COMPRESS_LEVEL')
+    log_for('PROFILE_HEADER')
+    log_for('PROFILE_SLOW_QUERY_MS')
 
 
 def register_extensions(app):
     """Register Flask extensions."""
     db.init_app(app)
     migrate.init_app(app, db)
+    cache.response_cache.configure(app.config.get('RESPONSE_CACHE_SIZE'),
+        app.config.get('RESPONSE_CACHE_TTL_SECS'))
+    jobs.job_queue.configure(app.config.get('PROCESS_JOB_HISTORY'))
     return None
 
 
+def register_commands(app):
+    """Register Click commands."""
+    @app.cli.command('scheduler')
+    @click.option('--once', is_flag=True, help='run everything once, then exit')
+    def run_scheduler(once):
+        """Ingest periodically, each group of processors at its own cadence."""
+        result = scheduler.create_scheduler(app.config)
+        if once:
+            result.start_now()
+            result.run_pending()
+            return
+        result.run_forever()
+
+    @app.cli.command('detach-partitions')
+    @click.option('--before', required=True, metavar='YYYY-MM', callback=_year_month,
+        help='detach the months before this one')
+    def detach_partitions(before):
+        """Detach old months of the partitioned usage tables for archiving (PostgreSQL)."""
+        for curr in processors.detach_months(*before):
+            click.echo('Detached %s' % curr)
+        services.refresh_rollups(app.config)
+
+    @app.cli.command('backfill')
+    @click.option('--from', 'start', required=True, metavar='YYYY-MM', callback=_year_month,
+        help='the first month to ingest')
+    @click.option('--to', 'end', required=True, metavar='YYYY-MM', callback=_year_month,
+        help='the last month to ingest')
+    @click.option('--service', 'service_names', multiple=True,
+        type=click.Choice(services.MONTH_SERVICES), help='repeat for each, defaults to all')
+    @click.option('--contracts', is_flag=True, help='pull the contracts first')
+    @click.option('--workers', type=click.IntRange(min=1),
+        help='tasks to run at once, defaults to PROCESS_WORKERS')
+    @click.option('--chunk-months', type=click.IntRange(min=1),
+        default=backfill.DEFAULT_CHUNK_MONTHS, show_default=True,
+        help='months to ingest between releasing the ingest lock')
+    @click.option('--restart', is_flag=True,
+        help="start over rather than resume an interrupted run of the same backfill")
+    def run_backfill(start, end, service_names, contracts, workers, chunk_months, restart):
+        """Ingest a range of months, resuming if an earlier run was interrupted."""
+        config = dict(app.config)
+        if workers:
+            config['PROCESS_WORKERS'] = workers
+        lock = scheduler.IngestLock(config['SCHEDULE_LOCK_FILE']) \
+            if config.get('SCHEDULE_LOCK_FILE') else None
+        def report(outcome):
+            if outcome['success']:
+                click.echo('Ingested %s' % ', '.join(x['name'] for x in outcome['timings']))
+        result = backfill.run(start, end, config, service_names or services.MONTH_SERVICES,
+            contracts=contracts, restart=restart, chunk_months=chunk_months, lock=lock,
+            progress=report)
+        if not result['success']:
+            raise click.ClickException('%s, run the same command again to resume' %
+                result['message'])
+        click.echo('Backfill finished, ran %d tasks and resumed past %d' %
+            (result['tasks_run'], result['tasks_resumed']))
+
+
+def _year_month(ctx, param, value):
+    """ parses a YYYY-MM option into (year, month) """
+    try:
+        year, month = [int(x) for x in value.split('-')]
+    except ValueError:
+        raise click.BadParameter('expected YYYY-MM')
+    if not 1 <= month <= 12:
+        raise click.BadParameter('month must be 1 to 12')
+    return (year, month)
+
+
+def register_request_metrics(app):
+    """ times every request, by route, for /metrics """
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def record_latency(response):
+        start = g.get('request_start')
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            metrics.observe_request(request.method, route, response.status_code,
+                time.perf_counter() - start)
+        return response
+
+
 def _handle_with_schema_validation(success_handler, schema_dict):
     """ validates that the request is valid before calling the handler """
     try:
@@ -61,10 +190,12 @@ def _handle_with_schema_validation(success_handler, schema_dict):
     except MultipleInvalid as e:
         return abort(400, 'value at %s failed validation: %s' % (e.path, e.msg))
     result = success_handler(args)
+    if isinstance(result, Response):
+        return result
     return jsonify(result)
 
 
-def _handle_with_year_month_validation(success_handler, year, month):
+def _handle_with_year_month_validation(success_handler, year, month, services_used):
     """
         validates that the year and month values are in range
         before calling the handler.
@@ -80,18 +211,144 @@ def _handle_with_year_month_validation(success_handler, year, month):
         })
     except MultipleInvalid as e:
         return abort(400, 'value at %s failed validation: %s' % (e.path, e.msg))
-    result = success_handler(year, month, current_app.config)
-    return jsonify(result)
+    return _cached_json_response((request.endpoint, year, month), services_used, [(year, month)],
+        lambda: success_handler(year, month, current_app.config))
+
+
+def _data_etag(key, services_used, months):
+    """ a strong ETag built from the data versions of the services and months
+        the response covers. Ingestion bumps those in the same transaction
+        as it changes the data, so this is the same in every process until
+        the data really changes, and it only costs one small query. """
+    names = [processors.usage_version_name(x) for x in services_used]
+    names += [processors.usage_version_name(x, year, month)
+        for x in services_used for year, month in months]
+    versions = services.get_data_versions(names)
+    config = current_app.config
+    seed = repr((RESPONSE_VERSION, key, sorted(versions.items()),
+        [config.get(x) for x in ETAG_CONFIG_KEYS]))
+    return hashlib.sha1(seed.encode('utf-8')).hexdigest()
+
+
+def _encoded_etag(etag, content_encoding):
+    """ each Content-Encoding is a different representation so it needs its
+        own strong ETag """
+    if content_encoding:
+        return '%s-%s' % (etag, content_encoding)
+    return etag
+
+
+def _not_modified(etag):
+    """ a 304 when the client already has any representation of the etag """
+    for curr in [None] + compression.supported_encodings():
+        candidate = _encoded_etag(etag, curr)
+        if request.if_none_match.contains(candidate):
+            resp = Response(status=304)
+            resp.set_etag(candidate)
+            resp.vary.add('Accept-Encoding')
+            return resp
+    return None
 
 
-def _chart_delegate(service_fn):
+def _profiling_requested():
+    """ whether the request carries the PROFILE_HEADER with the PROFILE_TOKEN """
+    config = current_app.config
+    token = config.get('PROFILE_TOKEN')
+    if not token:
+        return False
+    supplied = request.headers.get(config.get('PROFILE_HEADER'), '')
+    return hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8'))
+
+
+def _profiled_json_response(key, services_used, months, compute, columnar=False):
+    """ computes the response, bypassing the cache and conditional requests,
+        while profiling the SQL and Python work. The summary goes in a
+        Server-Timing header and the whole profile, with every query, is
+        logged. """
+    config = current_app.config
+    with profiling.profiled(config.get('PROFILE_SLOW_QUERY_MS')) as profile:
+        records = compute()
+    payload = encoding.to_columns(records) if columnar else records
+    resp = Response(encoding.dumps(payload), mimetype='application/json')
+    resp.headers['Server-Timing'] = profile.server_timing()
+    resp.cache_control.no_store = True
+    profiling.logger.info('Profile of %s: %s' % (request.full_path,
+        encoding.dumps(profile.to_dict()).decode('utf-8')))
+    return resp
+
+
+def _cached_json_response(key, services_used, months, compute, columnar=False):
+    """ serves the JSON for compute() from the response cache when we can,
+        with an ETag and Last-Modified so clients can make conditional
+        requests and get a 304. With DATA_VERSION_ETAGS the ETag comes from
+        the data versions, so a client with the current data gets its 304
+        without us computing anything. Big results that aren't cached yet
+        are streamed, and cached once the last chunk has gone out. Bodies of
+        at least COMPRESS_MIN_BYTES are compressed when the client accepts
+        it. """
+    if _profiling_requested():
+        return _profiled_json_response(key, services_used, months, compute, columnar)
+    config = current_app.config
+    etag = _data_etag(key, services_used, months) if config.get('DATA_VERSION_ETAGS') else None
+    if etag:
+        resp = _not_modified(etag)
+        if resp:
+            return resp
+    level = config.get('COMPRESS_LEVEL')
+    content_encoding = compression.choose_encoding(request.accept_encodings) if level else None
+    entry = cache.response_cache.get(key)
+    if entry is None or (etag and entry.etag != etag):
+        records = compute()
+        payload = encoding.to_columns(records) if columnar else records
+        stream_min = config.get('STREAM_RESPONSE_MIN_RECORDS')
+        if stream_min and len(records) >= stream_min:
+            chunks = _stream_and_cache(key, payload, services_used, months, etag)
+            if content_encoding:
+                chunks = compression.compress_chunks(chunks, content_encoding, level)
+            resp = Response(chunks, mimetype='application/json')
+            if content_encoding:
+                resp.content_encoding = content_encoding
+            if etag:
+                resp.set_etag(_encoded_etag(etag, content_encoding))
+            resp.vary.add('Accept-Encoding')
+            return resp
+        entry = cache.response_cache.put(key, encoding.dumps(payload), services_used, months, etag)
+    body = entry.body
+    if content_encoding and len(body) < (config.get('COMPRESS_MIN_BYTES') or 0):
+        content_encoding = None
+    if content_encoding:
+        body = entry.encoded(content_encoding, level)
+    resp = Response(body, mimetype='application/json')
+    if content_encoding:
+        resp.content_encoding = content_encoding
+    resp.set_etag(_encoded_etag(entry.etag, content_encoding))
+    resp.last_modified = entry.created
+    resp.vary.add('Accept-Encoding')
+    return resp.make_conditional(request)
+
+
+def _stream_and_cache(key, payload, services_used, months, etag=None):
+    chunks = []
+    for curr in encoding.iter_dumps(payload):
+        chunks.append(curr)
+        yield curr
+    cache.response_cache.put(key, b''.join(chunks), services_used, months, etag)
+
+
+def _chart_delegate(service_fn, services_used):
     def handler(args):
         org_filter = args['org'] # TODO might not want case sensitivity
         month_window = args['month_window']
-        return service_fn(org_filter, month_window, current_app.config)
+        columnar = args['format'] == FORMAT_COLUMNAR
+        # the window moves with the current month so that's part of the key too
+        months = services._get_months_to_process(month_window, services._now_provider())
+        key = (request.endpoint, org_filter, month_window, months[-1], args['format'])
+        return _cached_json_response(key, services_used, months,
+            lambda: service_fn(org_filter, month_window, current_app.config), columnar)
     return _handle_with_schema_validation(handler, {
         Optional('org', default=None): Any(None, All(str, Length(min=1))),
-        Optional('month_window', default=12): All(Coerce(int), Range(min=1, max=24))
+        Optional('month_window', default=12): All(Coerce(int), Range(min=1, max=24)),
+        Optional('format', default=FORMAT_RECORDS): Any(FORMAT_RECORDS, FORMAT_COLUMNAR)
     })
 
 
@@ -99,75 +356,103 @@ def add_routes(app):
     @app.route('/hpcsummary/simple/<int:year>/<int:month>')
     def get_hpcsummary_simple(year, month):
         return _handle_with_year_month_validation(
-            services.get_hpcsummary_simple, year, month)
+            services.get_hpcsummary_simple, year, month, [cache.SERVICE_HPCSUMMARY])
 
 
     @app.route('/hpcsummary/rollup/<int:year>/<int:month>')
     def get_hpcsummary_rollup(year, month):
         return _handle_with_year_month_validation(
-            services.get_hpcsummary_rollup, year, month)
+            services.get_hpcsummary_rollup, year, month, [cache.SERVICE_HPCSUMMARY])
 
 
     @app.route('/hpcsummary/detailed/<int:year>/<int:month>')
     def get_hpcsummary_detailed(year, month):
         return _handle_with_year_month_validation(
-            services.get_hpcsummary_detailed, year, month)
+            services.get_hpcsummary_detailed, year, month, [cache.SERVICE_HPCSUMMARY])
 
 
     @app.route('/hpcsummary/chart')
     def get_hpcsummary_chart():
-        return _chart_delegate(services.get_hpcsummary_chart)
+        return _chart_delegate(services.get_hpcsummary_chart, [cache.SERVICE_HPCSUMMARY])
 
 
     @app.route('/allocationsummary/simple/<int:year>/<int:month>')
     def get_allocationsummary_simple(year, month):
         return _handle_with_year_month_validation(
-            services.get_allocationsummary_simple, year, month)
+            services.get_allocationsummary_simple, year, month, [cache.SERVICE_ALLOCATIONSUMMARY])
 
 
     @app.route('/allocationsummary/chart')
     def get_allocationsummary_chart():
-        return _chart_delegate(services.get_allocationsummary_chart)
+        return _chart_delegate(services.get_allocationsummary_chart, [cache.SERVICE_ALLOCATIONSUMMARY])
 
 
     @app.route('/hpcstorage/simple/<int:year>/<int:month>')
     def get_hpcstorage_simple(year, month):
         return _handle_with_year_month_validation(
-            services.get_hpcstorage_simple, year, month)
+            services.get_hpcstorage_simple, year, month, [cache.SERVICE_HPCSTORAGE])
 
 
     @app.route('/hpcstorage/chart')
     def get_hpcstorage_chart():
-        return _chart_delegate(services.get_hpcstorage_chart)
+        return _chart_delegate(services.get_hpcstorage_chart, [cache.SERVICE_HPCSTORAGE])
 
 
     @app.route('/nectar/simple/<int:year>/<int:month>')
     def get_nectar_simple(year, month):
         return _handle_with_year_month_validation(
-            services.get_nectar_simple, year, month)
+            services.get_nectar_simple, year, month, [cache.SERVICE_NECTAR])
 
 
     @app.route('/nectar/chart')
     def get_nectar_chart():
-        return _chart_delegate(services.get_nectar_chart)
+        return _chart_delegate(services.get_nectar_chart, [cache.SERVICE_NECTAR])
 
 
     @app.route('/tango/simple/<int:year>/<int:month>')
     def get_tango_simple(year, month):
         return _handle_with_year_month_validation(
-            services.get_tango_simple, year, month)
+            services.get_tango_simple, year, month, [cache.SERVICE_TANGO])
 
 
     @app.route('/tango/chart')
     def get_tango_chart():
-        return _chart_delegate(services.get_tango_chart)
+        return _chart_delegate(services.get_tango_chart, [cache.SERVICE_TANGO])
+
+
+    @app.route('/chart')
+    def get_chart():
+        return _chart_delegate(services.get_chart, cache.ALL_SERVICES)
 
 
     @app.route('/process')
     def process():
         def handler(args):
             months_back = args['months_back']
-            return services.process(months_back, current_app.config)
+            job, coalesced = jobs.job_queue.submit(current_app._get_current_object(), months_back)
+            result = jsonify(dict(job, coalesced=coalesced))
+            result.status_code = 202
+            result.headers['Location'] = '/process/' + job['job_id']
+            return result
         return _handle_with_schema_validation(handler,
             {Optional('months_back', default=2): All(Coerce(int), Range(min=1, max=100))}
         )
+
+
+    @app.route('/process/<job_id>')
+    def get_process_status(job_id):
+        job = jobs.job_queue.get(job_id)
+        if job is None:
+            return abort(404, 'no job with id=%s, it may have been forgotten' % job_id)
+        return jsonify(job)
+
+
+    @app.route('/metrics')
+    def get_metrics():
+        return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+    @app.route('/summary/<int:year>/<int:month>')
+    def get_summary(year, month):
+        return _handle_with_year_month_validation(
+            services.get_summary, year, month, cache.ALL_SERVICES)
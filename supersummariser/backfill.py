@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Ingestion of an arbitrary range of past months, resumable when interrupted"""
+import logging
+
+import supersummariser.database as database
+import supersummariser.processors as processors
+import supersummariser.services as services
+
+logger = logging.getLogger('backfill')
+logger.setLevel(logging.DEBUG)
+db = database.db
+
+DEFAULT_CHUNK_MONTHS = 6
+FINISHED_STATUSES = (services.TASK_DONE,) + services.PROCESSOR_STATUSES
+
+
+def months_between(start, end):
+    """ every (year, month) from start to end, both included """
+    result = []
+    year, month = start
+    while (year, month) <= tuple(end):
+        result.append((year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return result
+
+
+def checkpoint_name(start, end, service_names, contracts):
+    """ identifies a backfill, so only a rerun of the same one resumes """
+    return '%d-%d..%d-%d %s%s' % (start + end + (','.join(sorted(service_names)),
+        ' +contracts' if contracts else ''))
+
+
+def _completed(name):
+    return {x.task for x in database.BackfillCheckpoint.query.filter_by(backfill=name)}
+
+
+def _save_checkpoint(name, task, status, config):
+    with processors.writer(config):
+        db.session.add(database.BackfillCheckpoint(backfill=name, task=task, status=status))
+        db.session.commit()
+
+
+def _clear_checkpoints(name):
+    database.BackfillCheckpoint.query.filter_by(backfill=name).delete()
+    db.session.commit()
+
+
+def _failing_cleanly(task):
+    """ wraps the task so that any error it raises fails the backfill with
+        a message, like a ProcessingFailedError does, rather than escaping """
+    name, fn, args = task
+    def run_task(*task_args):
+        try:
+            return fn(*task_args)
+        except processors.ProcessingFailedError:
+            raise
+        except Exception as e:
+            logger.exception('%s failed' % name)
+            raise processors.ProcessingFailedError('%s failed: %s' % (name, e)) from e
+    return name, run_task, args
+
+
+def _chunks(values, size):
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def run(start, end, config, service_names=services.MONTH_SERVICES, contracts=False,
+        restart=False, chunk_months=DEFAULT_CHUNK_MONTHS, lock=None, progress=None):
+    """ ingests the services for every month from start to end, both
+        (year, month), and optionally the contracts first. Months are run a
+        chunk at a time, PROCESS_WORKERS tasks at once, holding the lock
+        (e.g. an IngestLock) for each chunk, so a long backfill lets the
+        scheduler in between chunks. Each task that finishes is checkpointed
+        so running the same backfill again, after a failure or interruption,
+        skips it. restart discards the checkpoints. progress, if supplied, is
+        called with the result of each chunk. """
+    name = checkpoint_name(start, end, service_names, contracts)
+    if restart:
+        _clear_checkpoints(name)
+    completed = _completed(name)
+    if completed:
+        logger.info('Resuming backfill %s, %d tasks already done' % (name, len(completed)))
+    def checkpoint(task, status):
+        if status in FINISHED_STATUSES:
+            _save_checkpoint(name, task, status, config)
+    chunks = [services._build_month_tasks(x, service_names)
+        for x in _chunks(months_between(start, end), chunk_months)]
+    if contracts:
+        chunks.insert(0, services._build_contract_tasks())
+    result = {'success': True, 'tasks_run': 0, 'tasks_resumed': 0}
+    for curr in chunks:
+        tasks = [_failing_cleanly(x) for x in curr if x[0] not in completed]
+        result['tasks_resumed'] += len(curr) - len(tasks)
+        if not tasks:
+            continue
+        if lock:
+            lock.acquire(blocking=True)
+        try:
+            outcome = services.run_tasks(tasks, config, progress=checkpoint)
+        finally:
+            if lock:
+                lock.release()
+        if progress:
+            progress(outcome)
+        if not outcome['success']:
+            result.update(success=False, message=outcome['message'])
+            return result
+        result['tasks_run'] += len(tasks)
+    _clear_checkpoints(name)
+    return result
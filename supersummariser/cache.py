@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""In-process cache of read endpoint responses, invalidated by ingestion"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from supersummariser import compression
+
+SERVICE_HPCSUMMARY = 'hpcsummary'
+SERVICE_ALLOCATIONSUMMARY = 'allocationsummary'
+SERVICE_HPCSTORAGE = 'hpcstorage'
+SERVICE_NECTAR = 'nectar'
+SERVICE_TANGO = 'tango'
+ALL_SERVICES = (SERVICE_HPCSUMMARY, SERVICE_ALLOCATIONSUMMARY, SERVICE_HPCSTORAGE,
+    SERVICE_NECTAR, SERVICE_TANGO)
+
+
+class CacheEntry(object):
+    def __init__(self, body, services, months, etag=None):
+        self.body = body
+        self.services = frozenset(services)
+        self.months = frozenset(months)
+        self.etag = etag or hashlib.sha1(body).hexdigest()
+        self.created = time.time()
+        self._encoded = {}
+
+    def encoded(self, encoding, level):
+        """ the body compressed with the Content-Encoding, done on first use
+            and kept for the life of the entry """
+        try:
+            return self._encoded[encoding]
+        except KeyError:
+            result = self._encoded[encoding] = compression.compress(self.body, encoding, level)
+            return result
+
+    def covers(self, year, month):
+        return (year, month) in self.months
+
+
+class ResponseCache(object):
+    """ size bounded LRU cache of response bodies. Each entry records the
+        services and months it was built from so ingestion can drop just the
+        entries it made stale. Entries also expire after ttl_secs as a safety
+        net for when ingestion happened in another process. """
+
+    def __init__(self, max_size=0, ttl_secs=None):
+        self.max_size = max_size
+        self.ttl_secs = ttl_secs
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def configure(self, max_size, ttl_secs):
+        with self._lock:
+            self.max_size = max_size or 0
+            self.ttl_secs = ttl_secs
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _is_expired(self, entry):
+        return self.ttl_secs and time.time() - entry.created > self.ttl_secs
+
+    def get(self, key):
+        with self._lock:
+            try:
+                entry = self._entries[key]
+            except KeyError:
+                return None
+            if self._is_expired(entry):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body, services, months, etag=None):
+        entry = CacheEntry(body, services, months, etag)
+        with self._lock:
+            if self.max_size > 0:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                self._evict()
+        return entry
+
+    def invalidate(self, service, year=None, month=None):
+        """ drops the entries for the service, or just those that include the
+            month when one is given """
+        with self._lock:
+            stale_keys = [k for k, v in self._entries.items()
+                if service in v.services and (year is None or v.covers(year, month))]
+            for curr in stale_keys:
+                del self._entries[curr]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+response_cache = ResponseCache()
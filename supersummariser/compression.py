@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Content-Encoding of read endpoint responses"""
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError: # optional, we only offer gzip without it
+    brotli = None
+
+GZIP = 'gzip'
+BROTLI = 'br'
+
+
+def supported_encodings():
+    """ in order of preference """
+    return [BROTLI, GZIP] if brotli else [GZIP]
+
+
+def choose_encoding(accept_encodings):
+    """ the best encoding the client accepts, None for identity. Takes a
+        werkzeug Accept, like request.accept_encodings """
+    return accept_encodings.best_match(supported_encodings())
+
+
+def _brotli_quality(level):
+    # gzip's levels are 1-9, brotli's 0-11
+    return min(max(int(level), 0), 11)
+
+
+def compress(body, encoding, level):
+    if encoding == BROTLI:
+        return brotli.compress(body, quality=_brotli_quality(level))
+    return gzip.compress(body, compresslevel=level)
+
+
+def compress_chunks(chunks, encoding, level):
+    """ compresses a stream of chunks as they come, for streamed responses """
+    if encoding == BROTLI:
+        compressor = brotli.Compressor(quality=_brotli_quality(level))
+        for curr in chunks:
+            result = compressor.process(curr)
+            if result:
+                yield result
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS) # gzip framing
+    for curr in chunks:
+        result = compressor.compress(curr)
+        if result:
+            yield result
+    yield compressor.flush()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""In-memory index of the contracts that usage is billed against"""
+import threading
+
+import supersummariser.database as d
+from supersummariser.extensions import db
+import supersummariser.processors as p
+
+# the Account/AccountContact/Contract column each contract type's usage joins on
+JOIN_KEY_COLUMNS = {
+    p.CONTRACT_TYPE_ERSA_ACCOUNT: 'managerusername',
+    p.CONTRACT_TYPE_STORAGE: 'file_system_name',
+    p.CONTRACT_TYPE_STORAGE_BACKUP: 'file_system_name',
+    p.CONTRACT_TYPE_NECTAR: 'openstack_project_id',
+    p.CONTRACT_TYPE_TANGO: 'openstack_project_id',
+}
+
+
+class ContractIndex(object):
+    """ maps (contract_type, join key) to the (biller, managerunit,
+        unit_price) of every contract that usage with that key is billed
+        against. It's built from one Account/AccountContact/Contract join
+        and rebuilt when the contracts' DataVersion, which the contract sync
+        bumps in the same transaction as its changes, no longer matches the
+        one we built from. That notices changes made by any process for the
+        price of a single row lookup. """
+
+    def __init__(self):
+        self._entries = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _current_version(self):
+        return db.session.query(d.DataVersion.version).\
+            filter(d.DataVersion.name == p.VERSION_CONTRACTS).\
+            scalar()
+
+    def _build(self):
+        found = db.session.query(
+                d.Contract.contract_type,
+                d.AccountContact.managerusername,
+                d.Contract.file_system_name,
+                d.Contract.openstack_project_id,
+                d.Account.biller,
+                d.AccountContact.managerunit,
+                d.Contract.unit_price
+            ).\
+            join(d.AccountContact).\
+            join(d.Contract).\
+            all()
+        result = {}
+        for curr in found:
+            contract_type = curr[0]
+            try:
+                key_column = JOIN_KEY_COLUMNS[contract_type]
+            except KeyError:
+                continue
+            key = getattr(curr, key_column)
+            if key is None:
+                continue # a NULL never matches in the SQL join either
+            result.setdefault((contract_type, key), []).append((curr[4], curr[5], curr[6]))
+        return result
+
+    def _entries_for_current_contracts(self):
+        version = self._current_version()
+        with self._lock:
+            if self._entries is None or self._version != version:
+                self._entries = self._build()
+                self._version = version
+            return self._entries
+
+    def lookup(self, contract_type, key):
+        """ all the (biller, managerunit, unit_price) billed for the key, one
+            per matching contract just like the SQL join would produce """
+        return self._entries_for_current_contracts().get((contract_type, key), ())
+
+    def lookup_all(self):
+        """ the whole index, for callers resolving many keys at once """
+        return self._entries_for_current_contracts()
+
+    def invalidate(self):
+        """ forces a rebuild on next use, mainly useful for tests """
+        with self._lock:
+            self._entries = None
+            self._version = None
+
+
+contract_index = ContractIndex()
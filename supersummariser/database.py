@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 """Database module, including the SQLAlchemy database object and DB-related utilities."""
+import io
+import math
+import re
+import sqlite3
+
 from .compat import basestring
 from .extensions import db
+from sqlalchemy import Column as SAColumn, MetaData, Table, event, text
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import backref # 
 
 # Alias common SQLAlchemy names
@@ -76,6 +83,220 @@ def reference_col(tablename, nullable=False, pk_name='id', **kwargs):
         nullable=nullable, **kwargs)
 
 
+def _copy_value(value):
+    """ formats a value for PostgreSQL's COPY text format """
+    if value is None:
+        return '\\N'
+    return str(value).\
+        replace('\\', '\\\\').\
+        replace('\t', '\\t').\
+        replace('\n', '\\n').\
+        replace('\r', '\\r')
+
+
+def _rows_to_copy_text(columns, rows):
+    result = io.StringIO()
+    for curr in rows:
+        result.write('\t'.join(_copy_value(curr[x]) for x in columns))
+        result.write('\n')
+    result.seek(0)
+    return result
+
+
+class CopyRows(object):
+    """ rows already formatted for PostgreSQL's COPY, so the formatting can
+        be done somewhere else (e.g. a worker process) and only the text has
+        to be handed back """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.text = _rows_to_copy_text(columns, rows).getvalue()
+        self.count = len(rows)
+
+    def __len__(self):
+        return self.count
+
+
+def uses_copy():
+    """ whether bulk_insert will COPY, so it can be given CopyRows """
+    return db.session.connection().dialect.name == 'postgresql'
+
+
+def bulk_insert(model, rows):
+    """ inserts a list of dicts (all with the same keys), or CopyRows when
+        uses_copy(), into the table for the model (or a Table, like a
+        month's swap table) without creating ORM objects. Uses COPY on PostgreSQL
+        and a single executemany INSERT elsewhere (e.g. SQLite for the
+        tests). Runs on the session's connection so it's part of the current
+        transaction. """
+    if not rows:
+        return
+    table = getattr(model, '__table__', model)
+    connection = db.session.connection()
+    if isinstance(rows, CopyRows):
+        columns, text_rows = rows.columns, io.StringIO(rows.text)
+    elif connection.dialect.name != 'postgresql':
+        connection.execute(table.insert(), rows)
+        return
+    else:
+        columns = list(rows[0].keys())
+        text_rows = _rows_to_copy_text(columns, rows)
+    sql = 'COPY {} ({}) FROM STDIN'.format(table.name, ', '.join(columns))
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(sql, text_rows)
+    finally:
+        cursor.close()
+
+
+def vacuum(table_names):
+    """ VACUUM ANALYZEs the tables on PostgreSQL, so the rows left dead by
+        replacing months are reclaimed in one pass rather than whenever
+        autovacuum gets to them. VACUUM can't run in a transaction so this
+        uses its own connection. Does nothing elsewhere, returns the names
+        of the tables vacuumed. """
+    engine = db.engine
+    if engine.dialect.name != 'postgresql' or not table_names:
+        return []
+    preparer = engine.dialect.identifier_preparer
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        for curr in table_names:
+            connection.execute(text('VACUUM (ANALYZE) ' + preparer.quote(curr)))
+    return list(table_names)
+
+
+def month_partition_name(table_name, year, month):
+    return '%s_y%04dm%02d' % (table_name, year, month)
+
+
+def _month_bounds(year, month):
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return 'FOR VALUES FROM (%d, %d) TO (%d, %d)' % (year, month, next_year, next_month)
+
+
+def _month_partition_ddl(table_name, year, month):
+    return 'CREATE TABLE IF NOT EXISTS %s PARTITION OF %s %s' % (
+        month_partition_name(table_name, year, month), table_name, _month_bounds(year, month))
+
+
+def _supports_partitioning(connection):
+    """ PostgreSQL 11 or later, which allows the primary key and indexes the
+        usage tables need on a partitioned table. 10 rejects them so the
+        migration leaves its tables plain. """
+    return connection.dialect.name == 'postgresql' and \
+        int(connection.execute(text('SHOW server_version_num')).scalar()) >= 110000
+
+
+def _is_partitioned(connection, table_name):
+    return connection.execute(text('SELECT 1 FROM pg_partitioned_table pt '
+        'JOIN pg_class c ON c.oid = pt.partrelid '
+        'WHERE c.relname = :name AND pg_table_is_visible(c.oid)'),
+        {'name': table_name}).first() is not None
+
+
+def ensure_month_partition(model, year, month):
+    """ creates the partition for the month when the model's table is
+        partitioned (PostgreSQL, after the migration) and it doesn't exist
+        yet, so the month's rows have somewhere to go. Creating a partition
+        briefly locks the whole table so it's done, and committed, on its
+        own connection rather than in the ingestion transaction. The check
+        is left to the DB every time, rather than remembered, as another
+        process may have detached the partition since. Returns whether the
+        table is partitioned. """
+    engine = db.engine
+    if engine.dialect.name != 'postgresql':
+        return False
+    table_name = model.__tablename__
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if not _supports_partitioning(connection) or not _is_partitioned(connection, table_name):
+            return False
+        connection.execute(text(_month_partition_ddl(table_name, year, month)))
+    return True
+
+
+def create_month_swap_table(model, year, month):
+    """ creates an empty table, in the current transaction, to load the
+        month into before swap_month_partition swaps it in for the month's
+        partition. It's LIKE the partitioned table, so it has its indexes
+        and takes the ids from its sequence, and is checked to only hold the
+        month so attaching it doesn't have to scan it. Nobody else can see
+        it until the commit. """
+    name = month_partition_name(model.__tablename__, year, month) + '_swap'
+    db.session.connection().execute(text(
+        'CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING INDEXES, '
+        'CHECK (year = %d AND month = %d))' % (name, model.__tablename__, year, month)))
+    columns = [SAColumn(x.name, x.type) for x in model.__table__.columns]
+    return Table(name, MetaData(), *columns)
+
+
+def swap_month_partition(model, year, month, swap_table):
+    """ replaces the month's partition with the loaded swap table, in the
+        current transaction. The old partition is dropped whole, so there
+        are no dead rows to vacuum. The table is locked from the detach to
+        the commit, which should follow straight after. Only for tables
+        ensure_month_partition says are partitioned. """
+    table_name = model.__tablename__
+    partition = month_partition_name(table_name, year, month)
+    connection = db.session.connection()
+    if not _supports_partitioning(connection):
+        raise ValueError('Swapping in the partition for %s needs PostgreSQL 11 or later' % partition)
+    for curr in ['ALTER TABLE %s DETACH PARTITION %s' % (table_name, partition),
+            'DROP TABLE %s' % partition,
+            'ALTER TABLE %s RENAME TO %s' % (swap_table.name, partition),
+            'ALTER TABLE %s ATTACH PARTITION %s %s' % (table_name, partition,
+                _month_bounds(year, month))]:
+        connection.execute(text(curr))
+
+
+_PARTITION_MONTH = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def detach_month_partitions(model, before_year, before_month):
+    """ detaches the partitions for the months before the given one from the
+        model's table, so they can be archived (e.g. with pg_dump) and
+        dropped. Each is left as a standalone table, renamed with a
+        _detached suffix so ingesting the month again can make a fresh
+        partition (see processors.detach_months, which also forgets the
+        month). Returns the (new name, year, month) of each. """
+    engine = db.engine
+    table_name = model.__tablename__
+    result = []
+    if engine.dialect.name != 'postgresql':
+        return result
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        if not _supports_partitioning(connection) or not _is_partitioned(connection, table_name):
+            return result
+        found = connection.execute(text('SELECT c.relname FROM pg_inherits i '
+            'JOIN pg_class c ON c.oid = i.inhrelid '
+            'JOIN pg_class p ON p.oid = i.inhparent '
+            'WHERE p.relname = :name AND pg_table_is_visible(p.oid) ORDER BY c.relname'),
+            {'name': table_name}).fetchall()
+        for curr in [x[0] for x in found]:
+            match = _PARTITION_MONTH.search(curr)
+            if not match:
+                continue
+            year, month = int(match.group(1)), int(match.group(2))
+            if (year, month) >= (before_year, before_month):
+                continue
+            detached = curr + '_detached'
+            connection.execute(text('ALTER TABLE %s DETACH PARTITION %s' % (table_name, curr)))
+            connection.execute(text('ALTER TABLE %s RENAME TO %s' % (curr, detached)))
+            result.append((detached, year, month))
+    return result
+
+
+def _sqlite_ceil(value):
+    return None if value is None else math.ceil(value)
+
+
+@event.listens_for(Engine, 'connect')
+def _add_sqlite_functions(dbapi_connection, connection_record):
+    """ SQLite only has CEIL when it's compiled with the math functions, the
+        storage queries need it so make sure it's there (e.g. for the tests) """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('ceil', 1, _sqlite_ceil)
+
+
 class MonthlyModel(Model):
     __abstract__ = True
     year = db.Column(db.Integer)
@@ -84,6 +305,9 @@ class MonthlyModel(Model):
 
 class HpcSummaryUsage(MonthlyModel, SurrogatePK):
     """ HPC usage """
+    __table_args__ = (
+        db.Index('ix_hpc_summary_usage_year_month_owner', 'year', 'month', 'owner'),
+        {'extend_existing': True})
     cores = db.Column(db.Integer)
     cpu_seconds = db.Column(db.Integer)
     job_count = Column(db.Integer)
@@ -93,6 +317,11 @@ class HpcSummaryUsage(MonthlyModel, SurrogatePK):
 
 class Contract(Model, SurrogatePK):
     """ eRSA contract """
+    __table_args__ = (
+        db.Index('ix_contract_contract_type_file_system_name', 'contract_type', 'file_system_name'),
+        db.Index('ix_contract_contract_type_openstack_project_id', 'contract_type', 'openstack_project_id'),
+        db.Index('ix_contract_account_id', 'account_id'),
+        {'extend_existing': True})
     contract_type = db.Column(db.String(32))
     allocated = db.Column(db.Integer)
     unit_price = db.Column(db.Numeric)
@@ -101,6 +330,10 @@ class Contract(Model, SurrogatePK):
     openstack_project_id = db.Column(db.String(128)) # FIXME only used for tango, might split too like above
 
 class AccountContact(Model, SurrogatePK):
+    __table_args__ = (
+        db.Index('ix_account_contact_managerusername', 'managerusername'),
+        db.Index('ix_account_contact_account_id', 'account_id'),
+        {'extend_existing': True})
     managerusername = db.Column(db.String(64))
     manageremail = db.Column(db.String(64))
     managertitle = db.Column(db.String(256))
@@ -119,6 +352,9 @@ class Account(Model, SurrogatePK):
 
 class HnasVVUsage(MonthlyModel, SurrogatePK):
     """ HNAS VV usage """
+    __table_args__ = (
+        db.Index('ix_hnas_vv_usage_year_month_virtual_volume', 'year', 'month', 'virtual_volume'),
+        {'extend_existing': True})
     filesystem = db.Column(db.String(256))
     owner = db.Column(db.String(64))
     usage = db.Column(db.Integer)
@@ -129,6 +365,9 @@ class HnasVVUsage(MonthlyModel, SurrogatePK):
 
 class HnasFSUsage(MonthlyModel, SurrogatePK):
     """ HNAS FS usage """
+    __table_args__ = (
+        db.Index('ix_hnas_fs_usage_year_month_filesystem', 'year', 'month', 'filesystem'),
+        {'extend_existing': True})
     live_usage = db.Column(db.Integer)
     filesystem = db.Column(db.String(256))
     capacity = db.Column(db.Integer)
@@ -138,6 +377,9 @@ class HnasFSUsage(MonthlyModel, SurrogatePK):
 
 class HcpUsage(MonthlyModel, SurrogatePK):
     """ HCP usage """
+    __table_args__ = (
+        db.Index('ix_hcp_usage_year_month_namespace', 'year', 'month', 'namespace'),
+        {'extend_existing': True})
     ingested_bytes = db.Column(db.BigInteger)
     bytes_in = db.Column(db.BigInteger)
     namespace = db.Column(db.String(256))
@@ -155,6 +397,9 @@ class HcpUsage(MonthlyModel, SurrogatePK):
 
 class XfsUsage(MonthlyModel, SurrogatePK):
     """ XFS usage """
+    __table_args__ = (
+        db.Index('ix_xfs_usage_year_month_filesystem', 'year', 'month', 'filesystem'),
+        {'extend_existing': True})
     hard = db.Column(db.BigInteger)
     usage = db.Column(db.BigInteger)
     soft = db.Column(db.BigInteger)
@@ -164,6 +409,9 @@ class XfsUsage(MonthlyModel, SurrogatePK):
 
 class HpcHomeUsage(MonthlyModel, SurrogatePK):
     """ HPC Home usage """
+    __table_args__ = (
+        db.Index('ix_hpc_home_usage_year_month_owner', 'year', 'month', 'owner'),
+        {'extend_existing': True})
     hard = db.Column(db.BigInteger)
     usage = db.Column(db.BigInteger)
     soft = db.Column(db.BigInteger)
@@ -172,6 +420,9 @@ class HpcHomeUsage(MonthlyModel, SurrogatePK):
 
 class NectarUsage(MonthlyModel, SurrogatePK):
     """ NECTAR usage """
+    __table_args__ = (
+        db.Index('ix_nectar_usage_year_month_tenant_flavor', 'year', 'month', 'tenant', 'flavor'),
+        {'extend_existing': True})
     flavor = db.Column(db.String(128))
     instance_id = db.Column(db.String(128))
     biller = db.Column(db.String(128))
@@ -188,6 +439,9 @@ class NectarUsage(MonthlyModel, SurrogatePK):
 
 class TangoUsage(MonthlyModel, SurrogatePK):
     """ Tango usage """
+    __table_args__ = (
+        db.Index('ix_tango_usage_year_month_vm_id', 'year', 'month', 'vm_id'),
+        {'extend_existing': True})
     business_unit = db.Column(db.String(64))
     core = db.Column(db.Integer)
     vm_id = db.Column(db.String(64))
@@ -200,6 +454,9 @@ class TangoUsage(MonthlyModel, SurrogatePK):
 
 class NovaFlavor(Model, SurrogatePK):
     """ NECTAR Nova flavour """
+    __table_args__ = (
+        db.Index('ix_nova_flavor_openstack_id', 'openstack_id'),
+        {'extend_existing': True})
     flavor_id = db.Column(db.String(128))
     vcpus = db.Column(db.Integer)
     ephemeral = db.Column(db.Integer)
@@ -208,3 +465,97 @@ class NovaFlavor(Model, SurrogatePK):
     disk = db.Column(db.Integer)
     is_public = db.Column(db.Boolean)
     openstack_id = db.Column(db.String(128))
+
+
+# partitioned by (year, month) on PostgreSQL, see the migration
+PARTITIONED_MODELS = (HpcSummaryUsage, HnasVVUsage, HnasFSUsage, HcpUsage, XfsUsage, HpcHomeUsage,
+    NectarUsage, TangoUsage)
+
+
+class MonthlyRollup(MonthlyModel, SurrogatePK):
+    """ per service/biller/managerunit/month totals, refreshed after ingestion
+        so the read endpoints don't have to aggregate the raw usage """
+    __table_args__ = (
+        db.Index('ix_monthly_rollup_service_year_month', 'service', 'year', 'month'),
+        db.Index('ix_monthly_rollup_service_period', 'service', 'period'),
+        {'extend_existing': True})
+    service = db.Column(db.String(32))
+    period = db.Column(db.Integer) # year * 12 + month, so a window is one range
+    biller = db.Column(db.String(256))
+    managerunit = db.Column(db.String(256))
+    unit_price = db.Column(db.Numeric)
+    cores = db.Column(db.BigInteger)
+    cpu_seconds = db.Column(db.BigInteger)
+    job_count = db.Column(db.BigInteger)
+    cpu_hours = db.Column(db.Numeric)
+    usage = db.Column(db.Numeric)
+    blocks = db.Column(db.BigInteger)
+    core = db.Column(db.BigInteger)
+    cost = db.Column(db.Numeric)
+    last_system = db.Column(db.Integer) # National Storage only, labels its chart
+
+
+class RollupStale(Model, SurrogatePK):
+    """ marks the rollup for a service's month (or every month when year and
+        month are null) as out of date with the raw usage """
+    service = db.Column(db.String(32))
+    year = db.Column(db.Integer)
+    month = db.Column(db.Integer)
+
+
+class UpstreamDigest(Model, SurrogatePK):
+    """ the digest (and ETag, when the server sends one) of the last payload
+        we ingested for an upstream endpoint's month, so unchanged months can
+        be skipped """
+    __table_args__ = (
+        db.Index('ix_upstream_digest_endpoint_year_month', 'endpoint', 'year', 'month',
+            unique=True),
+        {'extend_existing': True})
+    endpoint = db.Column(db.String(32))
+    year = db.Column(db.Integer)
+    month = db.Column(db.Integer)
+    digest = db.Column(db.String(64))
+    etag = db.Column(db.String(256))
+
+
+class BackfillCheckpoint(Model, SurrogatePK):
+    """ a task that a backfill has completed, so the backfill can carry on
+        from where it was interrupted. Removed when the backfill finishes. """
+    __table_args__ = (
+        db.Index('ix_backfill_checkpoint_backfill_task', 'backfill', 'task', unique=True),
+        {'extend_existing': True})
+    backfill = db.Column(db.String(128))
+    task = db.Column(db.String(64))
+    status = db.Column(db.String(16))
+
+
+class DataVersion(Model, SurrogatePK):
+    """ a counter, bumped whenever the named data changes, that processes
+        compare against to know when their in-memory copy is stale """
+    __table_args__ = (
+        db.Index('ix_data_version_name', 'name', unique=True),
+        {'extend_existing': True})
+    name = db.Column(db.String(32))
+    version = db.Column(db.Integer)
+
+
+class ProcessJob(Model, SurrogatePK):
+    """ a /process harvest and its progress. Kept in the DB so any web
+        process can report on it. active is the months_back while the job
+        is queued or running, and null once it's finished, so its unique
+        index only lets one unfinished job per months_back in. """
+    __table_args__ = (
+        db.Index('ix_process_job_job_id', 'job_id', unique=True),
+        db.Index('ix_process_job_active', 'active', unique=True),
+        {'extend_existing': True})
+    job_id = db.Column(db.String(32))
+    months_back = db.Column(db.Integer)
+    active = db.Column(db.Integer)
+    state = db.Column(db.String(16))
+    owner = db.Column(db.String(128)) # host:pid of the process running it
+    submitted = db.Column(db.Float)
+    started = db.Column(db.Float)
+    finished = db.Column(db.Float)
+    tasks = db.Column(db.Text) # JSON
+    result = db.Column(db.Text) # JSON
+    message = db.Column(db.Text)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""JSON encoding of read endpoint responses"""
+import json
+from decimal import Decimal
+
+try:
+    import orjson
+except ImportError: # optional, we fall back to the (slower) stdlib encoder
+    orjson = None
+
+STREAM_CHUNK_RECORDS = 500
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def dumps(value):
+    """ compact JSON bytes with sorted keys, like jsonify gives, but Decimals
+        are written as numbers rather than needing to be converted first """
+    if orjson:
+        return orjson.dumps(value, default=_default, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(value, default=_default, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+
+def to_columns(records):
+    """ turns a list of dicts into parallel arrays, one per field, which is
+        much smaller for long lists as the field names are only written
+        once. A record without a field gets a null in that column. """
+    fields = []
+    seen = set()
+    for curr in records:
+        for key in curr:
+            if key not in seen:
+                seen.add(key)
+                fields.append(key)
+    return {
+        'count': len(records),
+        'columns': {f: [x.get(f) for x in records] for f in fields}
+    }
+
+
+def iter_dumps(value):
+    """ the same bytes as dumps(value) but in chunks, so a response can start
+        going out before the whole body is encoded. Lists are split every
+        STREAM_CHUNK_RECORDS items and columnar results (see to_columns) per
+        column. """
+    if isinstance(value, list):
+        yield b'['
+        for i in range(0, len(value), STREAM_CHUNK_RECORDS):
+            chunk = dumps(value[i:i + STREAM_CHUNK_RECORDS])[1:-1]
+            yield chunk if i == 0 else b',' + chunk
+        yield b']'
+        return
+    if isinstance(value, dict) and 'columns' in value:
+        yield b'{"columns":{'
+        for i, key in enumerate(sorted(value['columns'])):
+            prefix = b'' if i == 0 else b','
+            yield prefix + dumps(key) + b':' + dumps(value['columns'][key])
+        yield b'},"count":' + dumps(value['count']) + b'}'
+        return
+    yield dumps(value)
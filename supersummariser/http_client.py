@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Shared HTTP client used to talk to the upstream CRM, usage and reporting servers"""
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _session_key(config):
+    return (
+        config.get('SSL_VERIFY'),
+        config.get('HTTP_POOL_MAXSIZE'),
+        config.get('HTTP_MAX_RETRIES'),
+        config.get('HTTP_RETRY_BACKOFF_SECS'),
+    )
+
+
+def _build_session(config):
+    """ builds a session that keeps connections alive, pools up to
+        HTTP_POOL_MAXSIZE connections per host and retries 5xx responses
+        and read timeouts with exponential backoff. The verify bundle is
+        set once on the session so it isn't re-read for every request. """
+    retries = Retry(
+        total=config.get('HTTP_MAX_RETRIES') or 0,
+        read=config.get('HTTP_MAX_RETRIES') or 0,
+        status=config.get('HTTP_MAX_RETRIES') or 0,
+        backoff_factor=config.get('HTTP_RETRY_BACKOFF_SECS') or 0,
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False) # let the caller inspect the final status code
+    pool_maxsize = config.get('HTTP_POOL_MAXSIZE') or 10
+    adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize,
+            max_retries=retries)
+    result = requests.Session()
+    result.mount('http://', adapter)
+    result.mount('https://', adapter)
+    result.verify = config.get('SSL_VERIFY')
+    result.headers['Accept-Encoding'] = 'gzip, deflate'
+    return result
+
+
+def get_session(config):
+    """ gets the shared session for this config, creating it on first use """
+    key = _session_key(config)
+    with _sessions_lock:
+        try:
+            return _sessions[key]
+        except KeyError:
+            result = _build_session(config)
+            _sessions[key] = result
+            return result
+
+
+def close_sessions():
+    """ closes all the pooled connections, mainly useful for tests """
+    with _sessions_lock:
+        for curr in _sessions.values():
+            curr.close()
+        _sessions.clear()
+
+
+def get(config, url, **kwargs):
+    """ performs a GET using the shared session for this config """
+    return get_session(config).get(url,
+            timeout=config.get('REMOTE_SERVER_CONNECT_TIMEOUT_SECS'), **kwargs)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Queue that runs /process harvests in the background, keeping the jobs in the
+DB so every web process can report on them"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import IntegrityError
+
+import supersummariser.database as database
+from supersummariser.extensions import db
+import supersummariser.processors as processors
+import supersummariser.services as services
+from supersummariser.scheduler import IngestLock
+
+logger = logging.getLogger('jobs')
+
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_SUCCEEDED = 'succeeded'
+STATE_FAILED = 'failed'
+FINISHED_STATES = (STATE_SUCCEEDED, STATE_FAILED)
+
+
+def _owner():
+    """ identifies this process. Worked out each time as uWSGI forks its
+        workers after we're imported. """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def _is_alive(owner):
+    """ whether the process that owns a job is still running. One on
+        another host is assumed to be. """
+    host, _, pid = owner.rpartition(':')
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def to_dict(job):
+    """ the status of a ProcessJob as the /process endpoints report it """
+    return {
+        'job_id': job.job_id,
+        'months_back': job.months_back,
+        'state': job.state,
+        'submitted': job.submitted,
+        'started': job.started,
+        'finished': job.finished,
+        'tasks': json.loads(job.tasks or '[]'),
+        'result': json.loads(job.result) if job.result else None,
+        'message': job.message,
+    }
+
+
+def _update(job_id, **values):
+    database.ProcessJob.query.filter_by(job_id=job_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+class _Progress(object):
+    """ records the status of each task of a running job as services.process
+        reports it. May be called from several worker threads at once, so
+        the writes go through the ingestion writer like the tasks' own. """
+
+    def __init__(self, job_id, config):
+        self.job_id = job_id
+        self.config = config
+        self.tasks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, name, status):
+        with self._lock:
+            self.tasks[name] = status
+            tasks = json.dumps([{'name': k, 'status': v} for k, v in self.tasks.items()])
+            try:
+                with processors.writer(self.config):
+                    _update(self.job_id, tasks=tasks)
+            except Exception:
+                db.session.rollback()
+                logger.exception('Could not record the progress of job %s' % self.job_id)
+
+
+class JobQueue(object):
+    """ runs the harvests submitted to this process one at a time on a
+        single background thread, so the request that triggers one can
+        return straight away. A submission that matches a harvest that's
+        already queued or running, in any process, is coalesced into it
+        rather than starting another. Only the last history_size finished
+        jobs are kept. """
+
+    def __init__(self, history_size=20):
+        self.history_size = history_size
+        self._done = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def configure(self, history_size):
+        self.history_size = history_size or 0
+
+    def submit(self, app, months_back):
+        """ returns (job status, coalesced), where coalesced is True when an
+            existing job was returned instead of a new one being queued.
+            Must be called with an app context. """
+        existing = self._active(months_back)
+        if existing:
+            return to_dict(existing), True
+        job = database.ProcessJob(job_id=uuid.uuid4().hex, months_back=months_back,
+            active=months_back, state=STATE_QUEUED, owner=_owner(), submitted=time.time(),
+            tasks='[]')
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another process queued one between our check and insert
+            db.session.rollback()
+            existing = self._active(months_back)
+            if existing is None:
+                raise
+            return to_dict(existing), True
+        with self._lock:
+            self._done[job.job_id] = threading.Event()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1)
+            self._executor.submit(self._run, app, job.job_id, months_back)
+        return to_dict(job), False
+
+    def _active(self, months_back):
+        """ the unfinished job for months_back, after failing it if the
+            process that was running it has gone (e.g. uWSGI restarted it) """
+        result = database.ProcessJob.query.filter_by(active=months_back).first()
+        if result is None:
+            return None
+        with self._lock:
+            is_ours = result.job_id in self._done
+        if is_ours or (result.owner != _owner() and _is_alive(result.owner)):
+            return result
+        logger.warning('Job %s was abandoned by %s' % (result.job_id, result.owner))
+        _update(result.job_id, state=STATE_FAILED, active=None, finished=time.time(),
+            message='abandoned, the process running it (%s) has gone' % result.owner)
+        return None
+
+    def _run(self, app, job_id, months_back):
+        lock = IngestLock(app.config.get('SCHEDULE_LOCK_FILE')) \
+            if app.config.get('SCHEDULE_LOCK_FILE') else None
+        with app.app_context():
+            try:
+                if lock:
+                    # wait for the scheduler to finish rather than ingest alongside it
+                    lock.acquire(blocking=True)
+                _update(job_id, state=STATE_RUNNING, started=time.time())
+                result = services.process(months_back, app.config,
+                    progress=_Progress(job_id, app.config))
+                state = STATE_SUCCEEDED if result.get('success') else STATE_FAILED
+                self._finish(job_id, state, result=result, message=result.get('message'))
+            except Exception as e:
+                logger.exception('Job %s failed' % job_id)
+                db.session.rollback()
+                self._finish(job_id, STATE_FAILED, message=str(e))
+            finally:
+                if lock:
+                    lock.release()
+                db.session.remove()
+                with self._lock:
+                    self._done.pop(job_id).set()
+
+    def _finish(self, job_id, state, result=None, message=None):
+        _update(job_id, state=state, active=None, finished=time.time(), message=message,
+            result=json.dumps(result, default=str) if result is not None else None)
+        self._trim()
+
+    def _trim(self):
+        finished = db.session.query(database.ProcessJob.id).\
+            filter(database.ProcessJob.state.in_(FINISHED_STATES)).\
+            order_by(database.ProcessJob.finished.desc()).\
+            offset(self.history_size).\
+            all()
+        ids = [x[0] for x in finished]
+        for i in range(0, len(ids), processors.DELETE_CHUNK_SIZE):
+            database.ProcessJob.query.\
+                filter(database.ProcessJob.id.in_(ids[i:i + processors.DELETE_CHUNK_SIZE])).\
+                delete(synchronize_session=False)
+        db.session.commit()
+
+    def get(self, job_id):
+        """ the status of the job, None when there's no such job (or it's
+            been forgotten). Must be called with an app context. """
+        result = database.ProcessJob.query.filter_by(job_id=job_id).first()
+        return None if result is None else to_dict(result)
+
+    def wait(self, job_id, timeout=None):
+        """ waits for a job submitted to this process to finish, mainly
+            useful for tests """
+        with self._lock:
+            done = self._done.get(job_id)
+        return True if done is None else done.wait(timeout)
+
+
+job_queue = JobQueue()
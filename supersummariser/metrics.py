@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""Ingestion and request metrics, rendered in the Prometheus text format"""
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+STAGE_FETCH = 'fetch'
+STAGE_DECODE = 'decode'
+STAGE_DELETE = 'delete'
+STAGE_INSERT = 'insert'
+STAGE_COMMIT = 'commit'
+STAGE_SWAP = 'swap'
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in pairs]
+    return '{%s}' % ','.join(escaped)
+
+
+class Counter(object):
+    """ a monotonically increasing value per combination of label values """
+
+    def __init__(self, name, description, labelnames):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        result = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                result.append('%s%s %s' % (self.name, _format_labels(self.labelnames, labels),
+                    _format_value(value)))
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(object):
+    """ counts of observations in cumulative buckets, plus their sum, per
+        combination of label values """
+
+    def __init__(self, name, description, labelnames, buckets):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            try:
+                counts, total = self._values[labels]
+            except KeyError:
+                counts, total = [0] * len(self.buckets), 0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[labels] = (counts, total + value)
+
+    def count(self, labels):
+        return sum(self._values.get(labels, ([], 0))[0])
+
+    def render(self):
+        result = ['# HELP %s %s' % (self.name, self.description), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    result.append('%s_bucket%s %d' % (self.name,
+                        _format_labels(self.labelnames, labels, [('le', _format_value(bound))]),
+                        cumulative))
+                label_text = _format_labels(self.labelnames, labels)
+                result.append('%s_sum%s %s' % (self.name, label_text, _format_value(total)))
+                result.append('%s_count%s %d' % (self.name, label_text, cumulative))
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for curr in self._metrics:
+            lines.extend(curr.render())
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        """ resets every metric, mainly useful for tests """
+        for curr in self._metrics:
+            curr.clear()
+
+
+registry = Registry()
+ingest_stage_seconds = registry.register(Histogram('supersummariser_ingest_stage_seconds',
+    'Time spent in each ingestion stage, by upstream endpoint (fetch, decode) or table '
+    '(delete, insert, swap, commit)', ('source', 'stage'), STAGE_BUCKETS))
+ingest_records = registry.register(Counter('supersummariser_ingest_records_total',
+    'Records decoded, deleted or inserted by each ingestion stage', ('source', 'stage')))
+ingest_bytes = registry.register(Counter('supersummariser_ingest_bytes_total',
+    'Payload bytes fetched from each upstream endpoint', ('source', 'stage')))
+request_seconds = registry.register(Histogram('supersummariser_http_request_duration_seconds',
+    'Time to handle each request, until the response (or for streamed responses, its '
+    'headers) is ready', ('method', 'route', 'status'), REQUEST_BUCKETS))
+
+
+class StageRecorder(object):
+    """ totals the stages of a single task, e.g. one service for one month,
+        so they can be reported alongside its elapsed time """
+
+    def __init__(self):
+        self._stages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _add(self, source, stage, seconds=0, records=0, payload_bytes=0):
+        with self._lock:
+            curr = self._stages.setdefault((source, stage), [0, 0, 0])
+            curr[0] += seconds
+            curr[1] += records
+            curr[2] += payload_bytes
+
+    def to_list(self):
+        with self._lock:
+            return [{
+                'source': k[0],
+                'stage': k[1],
+                'elapsed_ms': int(round(v[0] * 1000)),
+                'records': v[1],
+                'bytes': v[2],
+            } for k, v in self._stages.items()]
+
+
+_current = threading.local()
+
+
+def _recorder():
+    return getattr(_current, 'recorder', None)
+
+
+@contextmanager
+def recording():
+    """ makes a new StageRecorder current for the calling thread, for as long
+        as the block runs, so the stages that run in it are totalled """
+    previous = _recorder()
+    result = _current.recorder = StageRecorder()
+    try:
+        yield result
+    finally:
+        _current.recorder = previous
+
+
+def observe_stage(source, stage, seconds):
+    ingest_stage_seconds.observe((source, stage), seconds)
+    recorder = _recorder()
+    if recorder:
+        recorder._add(source, stage, seconds=seconds)
+
+
+def add_records(source, stage, count):
+    ingest_records.inc((source, stage), count)
+    recorder = _recorder()
+    if recorder:
+        recorder._add(source, stage, records=count)
+
+
+def add_bytes(source, stage, count):
+    ingest_bytes.inc((source, stage), count)
+    recorder = _recorder()
+    if recorder:
+        recorder._add(source, stage, payload_bytes=count)
+
+
+@contextmanager
+def stage(source, name):
+    """ times the block as the named stage of the source """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(source, name, time.perf_counter() - start)
+
+
+def timed_iter(values, source, name):
+    """ passes values through, counting them and timing how long each took to
+        produce, for stages that run lazily like a streamed decode """
+    values = iter(values)
+    elapsed = 0
+    count = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                value = next(values)
+            except StopIteration:
+                elapsed += time.perf_counter() - start
+                return
+            elapsed += time.perf_counter() - start
+            count += 1
+            yield value
+    finally:
+        observe_stage(source, name, elapsed)
+        add_records(source, name, count)
+
+
+def counted_bytes(chunks, source, name):
+    """ passes chunks through, counting their bytes """
+    total = 0
+    try:
+        for curr in chunks:
+            total += len(curr)
+            yield curr
+    finally:
+        add_bytes(source, name, total)
+
+
+def observe_request(method, route, status, seconds):
+    request_seconds.observe((method, route, str(status)), seconds)
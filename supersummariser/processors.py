@@ -1,9 +1,24 @@
+import codecs
+import contextlib
+import hashlib
+import json
 import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from urllib.parse import urlparse
 
 import requests
 import pendulum
+from sqlalchemy import text
 
+from supersummariser import cache, metrics
 import supersummariser.database as database
+import supersummariser.http_client as http_client
 
 logger = logging.getLogger('processors')
 logger.setLevel(logging.DEBUG)
@@ -15,6 +30,12 @@ CONTRACT_TYPE_TANGO = 'tango_contract'
 CONTRACT_TYPE_NECTAR = 'nectar_contract'
 CONTRACT_TYPE_STORAGE = 'attached_storage'
 CONTRACT_TYPE_STORAGE_BACKUP = 'attached_storage_backup'
+STREAM_CHUNK_SIZE_BYTES = 64 * 1024
+STATUS_REWRITTEN = 'rewritten'
+STATUS_SKIPPED = 'skipped'
+STATUS_NO_DATA = 'no_data'
+VERSION_CONTRACTS = 'contracts'
+JSON_WHITESPACE = ' \t\n\r'
 
 def get(field_name, target):
     try:
@@ -33,87 +54,217 @@ def _dedupe_list_of_dicts(list_of_dicts):
     return list(map(dict, frozenset(frozenset(i.items()) for i in list_of_dicts)))
 
 
+# if other columns are added to the model, make sure this key is specific
+# enough to find unique records
+CONTRACT_MATCH_FIELDS = ('order_id', 'name', 'biller', 'openstack_project_id',
+    'file_system_name', 'allocated')
+CONTRACT_VALUE_FIELDS = CONTRACT_MATCH_FIELDS + ('unit_price', 'managerusername',
+    'manageremail', 'managertitle', 'managerunit', 'manager')
+# the CRM fields stored as strings, which the CRM doesn't always send as strings
+CONTRACT_STRING_FIELDS = ('order_id', 'name', 'biller', 'openstack_project_id',
+    'file_system_name', 'managerusername', 'manageremail', 'managertitle', 'managerunit',
+    'manager')
+DELETE_CHUNK_SIZE = 500
+CONTRACT_TYPE_SERVICES = {
+    CONTRACT_TYPE_ERSA_ACCOUNT: (cache.SERVICE_HPCSUMMARY, cache.SERVICE_HPCSTORAGE),
+    CONTRACT_TYPE_TANGO: (cache.SERVICE_TANGO,),
+    CONTRACT_TYPE_NECTAR: (cache.SERVICE_NECTAR,),
+    CONTRACT_TYPE_STORAGE: (cache.SERVICE_ALLOCATIONSUMMARY,),
+    CONTRACT_TYPE_STORAGE_BACKUP: (cache.SERVICE_ALLOCATIONSUMMARY,),
+}
+
+
+def _contract_values(curr):
+    """ maps a CRM record to the values we store for it, as the types they're
+        stored as so they compare equal to the stored contracts """
+    result = {
+        'order_id': get('orderID', curr),
+        'name': get('name', curr),
+        'biller': get('biller', curr),
+        'allocated': get('allocated', curr),
+        'openstack_project_id': get('OpenstackProjectID', curr),
+        'file_system_name': get('FileSystemName', curr),
+        'unit_price': get('unitPrice', curr),
+        'managerusername': get('managerusername', curr),
+        'manageremail': get('manageremail', curr),
+        'managertitle': get('managertitle', curr),
+        'managerunit': get('managerunit', curr),
+        'manager': get('manager', curr),
+    }
+    for field in CONTRACT_STRING_FIELDS:
+        if result[field] is not None:
+            result[field] = str(result[field])
+    if result['allocated'] is not None:
+        result['allocated'] = int(result['allocated'])
+    return result
+
+
+def _comparable(values, fields):
+    def normalise(field):
+        val = values[field]
+        if field == 'unit_price' and val is not None:
+            return Decimal(str(val)).normalize()
+        return val
+    return tuple(normalise(x) for x in fields)
+
+
+def _diff_contracts(existing, incoming):
+    """ works out what needs to change to make the stored contracts mirror the
+        CRM. existing is a list of (account_id, values) and incoming a list of
+        values. Returns (account ids to delete, values to insert). Stored
+        contracts that aren't in the CRM payload are left alone and when the
+        payload has more than one record for a key, the last one wins. """
+    incoming_by_key = {}
+    for curr in incoming:
+        incoming_by_key[_comparable(curr, CONTRACT_MATCH_FIELDS)] = curr
+    existing_by_key = {}
+    for account_id, values in existing:
+        key = _comparable(values, CONTRACT_MATCH_FIELDS)
+        existing_by_key.setdefault(key, []).append((account_id, values))
+    ids_to_delete = []
+    to_insert = []
+    for key, values in incoming_by_key.items():
+        matches = existing_by_key.get(key, [])
+        is_unchanged = len(matches) == 1 and \
+            _comparable(matches[0][1], CONTRACT_VALUE_FIELDS) == _comparable(values, CONTRACT_VALUE_FIELDS)
+        if is_unchanged:
+            continue
+        ids_to_delete.extend(x[0] for x in matches)
+        to_insert.append(values)
+    return ids_to_delete, to_insert
+
+
+def _load_contracts(contract_type):
+    found = db.session.query(
+            database.Account.id,
+            database.Account.order_id,
+            database.Account.name,
+            database.Account.biller,
+            database.Contract.openstack_project_id,
+            database.Contract.file_system_name,
+            database.Contract.allocated,
+            database.Contract.unit_price,
+            database.AccountContact.managerusername,
+            database.AccountContact.manageremail,
+            database.AccountContact.managertitle,
+            database.AccountContact.managerunit,
+            database.AccountContact.manager
+        ).\
+        join(database.Contract, database.Contract.account_id == database.Account.id).\
+        outerjoin(database.AccountContact, database.AccountContact.account_id == database.Account.id).\
+        filter(database.Contract.contract_type == contract_type).\
+        all()
+    fields = ('order_id', 'name', 'biller', 'openstack_project_id', 'file_system_name',
+        'allocated', 'unit_price', 'managerusername', 'manageremail', 'managertitle',
+        'managerunit', 'manager')
+    return [(x[0], dict(zip(fields, x[1:]))) for x in found]
+
+
+def _delete_accounts(account_ids):
+    for i in range(0, len(account_ids), DELETE_CHUNK_SIZE):
+        chunk = account_ids[i:i + DELETE_CHUNK_SIZE]
+        for model in (database.AccountContact, database.Contract):
+            db.session.query(model).\
+                filter(model.account_id.in_(chunk)).\
+                delete(synchronize_session=False)
+        db.session.query(database.Account).\
+            filter(database.Account.id.in_(chunk)).\
+            delete(synchronize_session=False)
+
+
+def _build_account(contract_type, values):
+    return database.Account(
+        order_id=values['order_id'],
+        name=values['name'],
+        biller=values['biller'],
+        account_contact=database.AccountContact(
+            managerusername=values['managerusername'],
+            manageremail=values['manageremail'],
+            managertitle=values['managertitle'],
+            managerunit=values['managerunit'],
+            manager=values['manager'],
+        ),
+        contract=database.Contract(
+            contract_type=contract_type,
+            allocated=values['allocated'],
+            unit_price=values['unit_price'],
+            file_system_name=values['file_system_name'],
+            openstack_project_id=values['openstack_project_id']
+        )
+    )
+
+
 def _apiv2_contract_helper(url, contract_type, config):
+    """ syncs the stored contracts of contract_type with the CRM. The current
+        contracts are loaded once and diffed in memory so we only issue the
+        deletes and inserts for records that actually changed. Returns
+        STATUS_REWRITTEN when any did, otherwise STATUS_SKIPPED (or
+        STATUS_NO_DATA for a 404). """
     def handler(json_body):
         orig_length = len(json_body)
         dedupe_json_body = _dedupe_list_of_dicts(json_body)
         dedupe_length = len(dedupe_json_body)
         dupes_count = orig_length - dedupe_length
         logger.debug('retrieved %d records for contract_type=%s, %d were duplicates' % (orig_length, contract_type, dupes_count))
-        for curr in dedupe_json_body:
-            order_id = get('orderID', curr)
-            name = get('name', curr)
-            biller = get('biller', curr)
-            allocated = get('allocated', curr)
-            openstack_project_id=get('OpenstackProjectID', curr)
-            file_system_name=get('FileSystemName', curr)
-            # if other columns are added to the model, make sure this
-            # delete query is specific enough to find unique records
-            existing_records = database.Account.query.filter(
-                database.Account.id==database.Contract.account_id,
-                database.Account.order_id==order_id,
-                database.Account.name==name,
-                database.Account.biller==biller,
-                database.Contract.openstack_project_id==openstack_project_id,
-                database.Contract.file_system_name==file_system_name,
-                database.Contract.allocated==allocated,
-                database.Contract.contract_type==contract_type).all()
-            for curr_existing in existing_records:
-                curr_existing.account_contact.delete()
-                curr_existing.contract.delete()
-                curr_existing.delete()
-            account_contact = database.AccountContact(
-                managerusername=get('managerusername', curr),
-                manageremail=get('manageremail', curr),
-                managertitle=get('managertitle', curr),
-                managerunit=get('managerunit', curr),
-                manager=get('manager', curr),
-            )
-            contract = database.Contract(
-                contract_type=contract_type,
-                allocated=allocated,
-                unit_price=get('unitPrice', curr),
-                file_system_name=file_system_name,
-                openstack_project_id=openstack_project_id
-            )
-            account = database.Account(
-                order_id=order_id,
-                name=name,
-                biller=biller,
-                account_contact=account_contact,
-                contract=contract
-            )
-            account.save(commit=False)
-        db.session.commit()
-    _get_json(config, url, handler)
+        incoming = [_contract_values(x) for x in dedupe_json_body]
+        ids_to_delete, to_insert = _diff_contracts(_load_contracts(contract_type), incoming)
+        affected_services = CONTRACT_TYPE_SERVICES[contract_type]
+        is_changed = bool(ids_to_delete or to_insert)
+        with writer(config):
+            try:
+                with metrics.stage(contract_type, metrics.STAGE_DELETE):
+                    _delete_accounts(ids_to_delete)
+                metrics.add_records(contract_type, metrics.STAGE_DELETE, len(ids_to_delete))
+                with metrics.stage(contract_type, metrics.STAGE_INSERT):
+                    db.session.add_all([_build_account(contract_type, x) for x in to_insert])
+                    db.session.flush()
+                metrics.add_records(contract_type, metrics.STAGE_INSERT, len(to_insert))
+                if is_changed:
+                    # every month of the services using these contracts is affected
+                    for curr in affected_services:
+                        _data_changed(curr)
+                    _bump_version(VERSION_CONTRACTS)
+                with metrics.stage(contract_type, metrics.STAGE_COMMIT):
+                    db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        logger.debug('contract_type=%s: deleted %d and inserted %d records' %
+            (contract_type, len(ids_to_delete), len(to_insert)))
+        if is_changed:
+            for curr in affected_services:
+                cache.response_cache.invalidate(curr)
+            return STATUS_REWRITTEN
+        return STATUS_SKIPPED
+    return _get_json(config, url, handler, contract_type) or STATUS_NO_DATA
 
 
 def process_ersaaccount(config):
     """ pull and store the HPC contract data """
     url = config.get('CRM_SERVER') + '/api/v2/contract/ersaaccount/'
-    _apiv2_contract_helper(url, CONTRACT_TYPE_ERSA_ACCOUNT, config)
+    return _apiv2_contract_helper(url, CONTRACT_TYPE_ERSA_ACCOUNT, config)
 
 
 def process_tango_contract(config):
     url = config.get('CRM_SERVER') + '/api/v2/contract/tangocloudvm/'
-    _apiv2_contract_helper(url, CONTRACT_TYPE_TANGO, config)
+    return _apiv2_contract_helper(url, CONTRACT_TYPE_TANGO, config)
 
 
 def process_nectar_contract(config):
     url = config.get('CRM_SERVER') + '/api/v2/contract/nectarcloudvm/'
-    _apiv2_contract_helper(url, CONTRACT_TYPE_NECTAR, config)
+    return _apiv2_contract_helper(url, CONTRACT_TYPE_NECTAR, config)
 
 
 def process_attachedstorage(config):
     """ pull and store the attached storage contract data """
     url = config.get('CRM_SERVER') + '/api/v2/contract/attachedstorage/'
-    _apiv2_contract_helper(url, CONTRACT_TYPE_STORAGE, config)
+    return _apiv2_contract_helper(url, CONTRACT_TYPE_STORAGE, config)
 
 
 def process_attachedstoragebackup(config):
     """ pull and store the attached storage for backups contract data """
     url = config.get('CRM_SERVER') + '/api/v2/contract/attachedbackupstorage/'
-    _apiv2_contract_helper(url, CONTRACT_TYPE_STORAGE_BACKUP, config)
+    return _apiv2_contract_helper(url, CONTRACT_TYPE_STORAGE_BACKUP, config)
 
 
 def get_start(year, month):
@@ -139,125 +290,351 @@ def get_year_month_for_n_months_ago(months_ago):
     }
 
 
+def _batches(records, batch_size):
+    """ groups an iterable of records into lists of at most batch_size """
+    batch = []
+    for curr in records:
+        batch.append(curr)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _mark_stale(service, year=None, month=None):
+    """ flags the rollup for the service's month (or all months) as needing a
+        refresh. Added to the current transaction so readers never see new
+        usage with an old rollup. """
+    db.session.add(database.RollupStale(service=service, year=year, month=month))
+
+
+def usage_version_name(service, year=None, month=None):
+    """ the DataVersion name for a service's month, or for all of its months
+        (contracts, flavors) when no month is given """
+    if year is None:
+        return service
+    return '%s %d-%d' % (service, year, month)
+
+
+def _data_changed(service, year=None, month=None):
+    """ records, in the current transaction, that the service's month (or all
+        months) changed: the rollup is marked stale and the usage version,
+        that the read API's ETags are built from, is bumped """
+    _mark_stale(service, year, month)
+    _bump_version(usage_version_name(service, year, month))
+
+
+# an upsert, so concurrent tasks bumping a version that doesn't exist yet
+# don't both insert it. PostgreSQL (9.5+) and SQLite (3.24+) share the syntax.
+BUMP_VERSION_SQL = text('INSERT INTO data_version (name, version) VALUES (:name, 1) '
+    'ON CONFLICT (name) DO UPDATE SET version = data_version.version + 1')
+
+
+def _bump_version(name):
+    """ increments the named data version in the current transaction so
+        other processes can tell their in-memory copies are out of date """
+    db.session.execute(BUMP_VERSION_SQL, {'name': name})
+
+
+class Payload(object):
+    """ an undecoded usage payload, spooled to the file at path as it was
+        read off the wire. With TRANSFORM_PROCESSES the handlers get one of
+        these, rather than the records, so that the decoding and row
+        building can be done in a worker process. Only the path is sent to
+        the worker, not the body. The file is removed once the handler
+        returns. """
+
+    def __init__(self, path, encoding, source):
+        self.path = path
+        self.encoding = encoding
+        self.source = source
+
+
+def _transform(path, encoding, build_row, year, month, batch_size, for_copy):
+    """ runs in a transform worker process: decodes the payload file, as a
+        stream, and builds the insert-ready rows in batches of batch_size.
+        The batches are CopyRows when for_copy, as handing back the text is
+        much cheaper than pickling the dicts. Each batch is pickled to a
+        temporary file as it's built, rather than the month being returned
+        in one piece, so only a batch at a time is ever in memory. Returns
+        the file's path and how many rows are in it. """
+    count = 0
+    with open(path, 'rb') as payload, \
+            tempfile.NamedTemporaryFile(suffix='.batches', delete=False) as f:
+        chunks = iter(lambda: payload.read(STREAM_CHUNK_SIZE_BYTES), b'')
+        try:
+            for batch in _batches(_iter_json_array(_decode_chunks(chunks, encoding)), batch_size):
+                rows = [build_row(year, month, x) for x in batch]
+                pickle.dump(database.CopyRows(list(rows[0].keys()), rows) if for_copy else rows,
+                    f, pickle.HIGHEST_PROTOCOL)
+                count += len(rows)
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+    return f.name, count
+
+
+def _unpickled_batches(f):
+    """ reads back the batches _transform pickled, one at a time """
+    with f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+_transform_pools = {}
+_transform_pools_lock = threading.Lock()
+_writer_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _no_lock():
+    yield
+
+
+def writer(config):
+    """ held while writing ingested data, or anything written alongside it
+        (job progress, backfill checkpoints). With PROCESS_WORKERS > 1 or
+        TRANSFORM_PROCESSES the fetches (and transforms) happen in parallel
+        but the writes go through this one at a time, so there's a single
+        writer. Otherwise SQLite fails concurrent writers with "database is
+        locked". """
+    is_concurrent = (config.get('PROCESS_WORKERS') or 1) > 1 or config.get('TRANSFORM_PROCESSES')
+    return _writer_lock if is_concurrent else _no_lock()
+
+
+def _get_transform_pool(processes):
+    """ gets the shared pool with this many processes, starting it on first
+        use. The workers are forked so they only ever run _transform, which
+        doesn't touch the DB or anything else they inherit. """
+    with _transform_pools_lock:
+        try:
+            return _transform_pools[processes]
+        except KeyError:
+            result = ProcessPoolExecutor(max_workers=processes)
+            _transform_pools[processes] = result
+            return result
+
+
+def shutdown_transform_pools():
+    """ stops the worker processes, mainly useful for tests """
+    with _transform_pools_lock:
+        for curr in _transform_pools.values():
+            curr.shutdown()
+        _transform_pools.clear()
+
+
+def _transformed_batches(payload, build_row, year, month, batch_size, config):
+    """ the batches of rows for the payload, built by the transform pool and
+        read back lazily. The time spent waiting on the pool counts as the
+        decode stage. """
+    pool = _get_transform_pool(config.get('TRANSFORM_PROCESSES'))
+    with metrics.stage(payload.source, metrics.STAGE_DECODE):
+        path, count = pool.submit(_transform, payload.path, payload.encoding, build_row, year,
+            month, batch_size, database.uses_copy()).result()
+    metrics.add_records(payload.source, metrics.STAGE_DECODE, count)
+    f = open(path, 'rb')
+    # the open file can still be read, and goes away once it's closed
+    os.unlink(path)
+    return _unpickled_batches(f)
+
+
+def _row_batches(records, build_row, year, month, batch_size, config):
+    if isinstance(records, Payload):
+        return _transformed_batches(records, build_row, year, month, batch_size, config)
+    return ([build_row(year, month, x) for x in batch] for batch in _batches(records, batch_size))
+
+
+def _delete_month(model, year, month):
+    table = model.__tablename__
+    with metrics.stage(table, metrics.STAGE_DELETE):
+        deleted = db.session.query(model).filter(
+            model.year==year,
+            model.month==month).delete()
+    metrics.add_records(table, metrics.STAGE_DELETE, deleted)
+
+
+def _replace_month(model, service, year, month, records, build_row, config):
+    """ replaces all the records for the month with the supplied ones, in a
+        single transaction. Records are bulk inserted, bypassing the ORM, in
+        batches of INGEST_BATCH_SIZE and we don't hold on to them, so a
+        streamed payload never has to be completely in memory.
+
+        With STAGED_MONTH_SWAP, and the table partitioned by month
+        (PostgreSQL), the records are loaded into a new table which then
+        replaces the month's partition. The old rows go with the old
+        partition rather than being deleted, and readers only wait on the
+        swap, not the download. Otherwise the month's rows are deleted and
+        the new ones inserted.
+
+        records can also be a Payload, which is decoded and turned into
+        rows by the transform pool. The rows are then written while holding
+        the writer lock, so however many tasks are transforming at once
+        there's a single writer. """
+    is_partitioned = database.ensure_month_partition(model, year, month)
+    swap = is_partitioned and config.get('STAGED_MONTH_SWAP')
+    batch_size = config.get('INGEST_BATCH_SIZE') or 1000
+    batches = _row_batches(records, build_row, year, month, batch_size, config)
+    with writer(config):
+        _write_month(model, service, year, month, batches, swap)
+    cache.response_cache.invalidate(service, year, month)
+
+
+def _write_month(model, service, year, month, batches, swap):
+    table = model.__tablename__
+    try:
+        target = database.create_month_swap_table(model, year, month) if swap else model
+        if not swap:
+            _delete_month(model, year, month)
+        inserted = 0
+        for rows in batches:
+            with metrics.stage(table, metrics.STAGE_INSERT):
+                database.bulk_insert(target, rows)
+            metrics.add_records(table, metrics.STAGE_INSERT, len(rows))
+            inserted += len(rows)
+        _data_changed(service, year, month)
+        if swap:
+            with metrics.stage(table, metrics.STAGE_SWAP):
+                database.swap_month_partition(model, year, month, target)
+            metrics.add_records(table, metrics.STAGE_SWAP, inserted)
+        with metrics.stage(table, metrics.STAGE_COMMIT):
+            db.session.commit()
+    except Exception:
+        # a streamed payload can fail part way through, don't leave the
+        # delete pending for the next commit on this session
+        db.session.rollback()
+        raise
+
+
+def _build_hpcsummary(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        cores=get('cores', curr),
+        cpu_seconds=get('cpu_seconds', curr),
+        job_count=get('job_count', curr),
+        owner=get('owner', curr),
+        queue=get('queue', curr)
+    )
+
+
 def process_hpcsummary(year, month, config):
     """ pull and store the HpcSummary data """
     _log(year, month, 'HPC Summary')
     start_ms = get_start_ms(year, month)
     end_ms = get_end_ms(year, month)
-    def handler(json_body):
-        db.session.query(database.HpcSummaryUsage).filter(
-            database.HpcSummaryUsage.year==year,
-            database.HpcSummaryUsage.month==month).delete()
-        for curr in json_body:
-            record = database.HpcSummaryUsage(
-                year=year,
-                month=month,
-                cores=get('cores', curr),
-                cpu_seconds=get('cpu_seconds', curr),
-                job_count=get('job_count', curr),
-                owner=get('owner', curr),
-                queue=get('queue', curr)
-            )
-            record.save(commit=False)
-        db.session.commit()
-    _get_json(config, '{}/hpc/job/summary?start={}&end={}'.\
+    def handler(records):
+        _replace_month(database.HpcSummaryUsage, cache.SERVICE_HPCSUMMARY, year, month, records,
+            _build_hpcsummary, config)
+    return _get_records(config, '{}/hpc/job/summary?start={}&end={}'.\
             format(config.get('USAGE_SERVER'), start_ms, end_ms),
-        handler)
+        handler, 'hpcsummary', year, month)
+
+
+def _build_hnasvv(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        filesystem=get('filesystem', curr),
+        owner=get('owner', curr),
+        usage=get('usage', curr),
+        files=get('files', curr),
+        virtual_volume=get('virtual_volume', curr),
+        quota=get('quota', curr)
+    )
+
 
 def _process_allocationsummary_hnasvv(year, month, start_ms, end_ms, config):
-    def handler(json_body):
-        db.session.query(database.HnasVVUsage).filter(
-            database.HnasVVUsage.year==year,
-            database.HnasVVUsage.month==month).delete()
-        for curr in json_body:
-            record = database.HnasVVUsage(
-                year=year,
-                month=month,
-                filesystem=get('filesystem', curr),
-                owner=get('owner', curr),
-                usage=get('usage', curr),
-                files=get('files', curr),
-                virtual_volume=get('virtual_volume', curr),
-                quota=get('quota', curr)
-            )
-            record.save(commit=False)
-        db.session.commit()
-    _get_json(config, '{}/hnas/virtual-volume%2Fusage/summary?start={}&end={}'.\
+    def handler(records):
+        _replace_month(database.HnasVVUsage, cache.SERVICE_ALLOCATIONSUMMARY, year, month, records,
+            _build_hnasvv, config)
+    return _get_records(config, '{}/hnas/virtual-volume%2Fusage/summary?start={}&end={}'.\
             format(config.get('USAGE_SERVER'), start_ms, end_ms),
-        handler)
+        handler, 'hnasvv', year, month)
+
+
+def _build_hnasfs(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        live_usage=get('live_usage', curr),
+        filesystem=get('filesystem', curr),
+        capacity=get('capacity', curr),
+        snapshot_usage=get('snapshot_usage', curr),
+        free=get('free', curr)
+    )
+
 
 def _process_allocationsummary_hnasfs(year, month, start_ms, end_ms, config):
-    def handler(json_body):
-        db.session.query(database.HnasFSUsage).filter(
-            database.HnasFSUsage.year==year,
-            database.HnasFSUsage.month==month).delete()
-        for curr in json_body:
-            record = database.HnasFSUsage(
-                year=year,
-                month=month,
-                live_usage=get('live_usage', curr),
-                filesystem=get('filesystem', curr),
-                capacity=get('capacity', curr),
-                snapshot_usage=get('snapshot_usage', curr),
-                free=get('free', curr)
-            )
-            record.save(commit=False)
-        db.session.commit()
-    _get_json(config, '{}/hnas/filesystem%2Fusage/summary?start={}&end={}'.\
+    def handler(records):
+        _replace_month(database.HnasFSUsage, cache.SERVICE_ALLOCATIONSUMMARY, year, month, records,
+            _build_hnasfs, config)
+    return _get_records(config, '{}/hnas/filesystem%2Fusage/summary?start={}&end={}'.\
             format(config.get('USAGE_SERVER'), start_ms, end_ms),
-        handler)
+        handler, 'hnasfs', year, month)
+
+
+def _build_hcp(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        ingested_bytes=get('ingested_bytes', curr),
+        bytes_in=get('bytes_in', curr),
+        namespace=get('namespace', curr),
+        reads=get('reads', curr),
+        writes=get('writes', curr),
+        raw_bytes=get('raw_bytes', curr),
+        metadata_only_bytes=get('metadata_only_bytes', curr),
+        metadata_only_objects=get('metadata_only_objects', curr),
+        deletes=get('deletes', curr),
+        tiered_objects=get('tiered_objects', curr),
+        bytes_out=get('bytes_out', curr),
+        objects=get('objects', curr),
+        tiered_bytes=get('tiered_bytes', curr)
+    )
 
 
 def _process_allocationsummary_hcp(year, month, start_ms, end_ms, config):
-    def handler(json_body):
-        db.session.query(database.HcpUsage).filter(
-            database.HcpUsage.year==year,
-            database.HcpUsage.month==month).delete()
-        for curr in json_body:
-            record = database.HcpUsage(
-                year=year,
-                month=month,
-                ingested_bytes=get('ingested_bytes', curr),
-                bytes_in=get('bytes_in', curr),
-                namespace=get('namespace', curr),
-                reads=get('reads', curr),
-                writes=get('writes', curr),
-                raw_bytes=get('raw_bytes', curr),
-                metadata_only_bytes=get('metadata_only_bytes', curr),
-                metadata_only_objects=get('metadata_only_objects', curr),
-                deletes=get('deletes', curr),
-                tiered_objects=get('tiered_objects', curr),
-                bytes_out=get('bytes_out', curr),
-                objects=get('objects', curr),
-                tiered_bytes=get('tiered_bytes', curr)
-            )
-            record.save(commit=False)
-        db.session.commit()
-    _get_json(config, '{}/hcp/usage/summary?start={}&end={}'.\
+    def handler(records):
+        _replace_month(database.HcpUsage, cache.SERVICE_ALLOCATIONSUMMARY, year, month, records,
+            _build_hcp, config)
+    return _get_records(config, '{}/hcp/usage/summary?start={}&end={}'.\
             format(config.get('USAGE_SERVER'), start_ms, end_ms),
-        handler)
+        handler, 'hcp', year, month)
+
+
+def _build_xfs(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        hard=get('hard', curr),
+        usage=get('usage', curr),
+        soft=get('soft', curr),
+        filesystem=get('filesystem', curr),
+        host=get('host', curr)
+    )
 
 
 def _process_allocationsummary_xfs(year, month, start_ms, end_ms, config):
-    def handler(json_body):
-        db.session.query(database.XfsUsage).filter(
-            database.XfsUsage.year==year,
-            database.XfsUsage.month==month).delete()
-        for curr in json_body:
-            record = database.XfsUsage(
-                year=year,
-                month=month,
-                hard=get('hard', curr),
-                usage=get('usage', curr),
-                soft=get('soft', curr),
-                filesystem=get('filesystem', curr),
-                host=get('host', curr)
-            )
-            record.save(commit=False)
-        db.session.commit()
-    _get_json(config, '{}/xfs/usage/summary?start={}&end={}'.\
+    def handler(records):
+        _replace_month(database.XfsUsage, cache.SERVICE_ALLOCATIONSUMMARY, year, month, records,
+            _build_xfs, config)
+    return _get_records(config, '{}/xfs/usage/summary?start={}&end={}'.\
             format(config.get('USAGE_SERVER'), start_ms, end_ms),
-        handler)
+        handler, 'xfs', year, month)
+
+
+def _combine_statuses(statuses):
+    """ a service made up of several endpoints was rewritten if any of them
+        were, skipped if any were unchanged and otherwise had no data """
+    for curr in (STATUS_REWRITTEN, STATUS_SKIPPED):
+        if curr in statuses:
+            return curr
+    return STATUS_NO_DATA
 
 
 def process_allocationsummary(year, month, config):
@@ -265,39 +642,248 @@ def process_allocationsummary(year, month, config):
     _log(year, month, 'Allocation Summary')
     start_ms = get_start_ms(year, month)
     end_ms = get_end_ms(year, month)
-    _process_allocationsummary_hnasvv(year, month, start_ms, end_ms, config)
-    _process_allocationsummary_hcp(year, month, start_ms, end_ms, config)
-    _process_allocationsummary_hnasfs(year, month, start_ms, end_ms, config)
-    _process_allocationsummary_xfs(year, month, start_ms, end_ms, config)
+    return _combine_statuses([
+        _process_allocationsummary_hnasvv(year, month, start_ms, end_ms, config),
+        _process_allocationsummary_hcp(year, month, start_ms, end_ms, config),
+        _process_allocationsummary_hnasfs(year, month, start_ms, end_ms, config),
+        _process_allocationsummary_xfs(year, month, start_ms, end_ms, config),
+    ])
 
 
 class ProcessingFailedError(Exception):
     pass
 
 
-def _get_json(config, url, callback):
+def _get_response(config, url, stream=False, etag=None):
+    """ performs the GET, returns None when there's no data (404). When an
+        etag is supplied the request is conditional and the response may be
+        a 304. """
     headers = {config.get('AUTH_HEADER_KEY') : config.get('ERSA_AUTH_TOKEN')}
+    if etag:
+        headers['If-None-Match'] = etag
     try:
-        resp = requests.get(url, headers=headers, verify=config.get('SSL_VERIFY'),
-                timeout=config.get('REMOTE_SERVER_CONNECT_TIMEOUT_SECS'))
-    except requests.exceptions.ReadTimeout:
+        resp = http_client.get(config, url, headers=headers, stream=stream)
+    except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError):
+        # retries (with backoff) have already been exhausted by this point
         logger.error('Failed while accessing url="%s"' % url)
         raise
     expected_status_code = 200
     actual_status_code = resp.status_code
     if actual_status_code == 404:
         logger.info('No data (404) at url=%s, skipping and continuing' % url)
+        resp.close()
         return None # TODO is this appropriate? Maybe should return a poison-pill.
+    if actual_status_code == 304 and etag:
+        resp.close()
+        return resp
     if actual_status_code != expected_status_code:
+        resp.close()
         raise ProcessingFailedError('Expected %d response code but got %d when calling %s' %
             (expected_status_code, actual_status_code, url))
+    return resp
+
+
+def _source_for(url):
+    """ the metrics source for an upstream without a name of its own """
+    return urlparse(url).path
+
+
+def _get_json(config, url, callback, source=None):
+    source = source or _source_for(url)
+    with metrics.stage(source, metrics.STAGE_FETCH):
+        resp = _get_response(config, url)
+        if resp is None:
+            return None
+        metrics.add_bytes(source, metrics.STAGE_FETCH, len(resp.content))
     try:
-        return callback(resp.json())
+        with metrics.stage(source, metrics.STAGE_DECODE):
+            body = resp.json()
+        if isinstance(body, list):
+            metrics.add_records(source, metrics.STAGE_DECODE, len(body))
+        return callback(body)
     except ValueError as e:
         content_type = resp.headers['Content-type']
         raise ProcessingFailedError('Expected a JSON response from %s but got %s' % (url, content_type)) from e
 
 
+def _iter_json_array(chunks):
+    """ incrementally parses a top level JSON array from an iterable of text
+        chunks, yielding each element as soon as it's complete """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    exhausted = False
+    chunks = iter(chunks)
+    def more():
+        nonlocal buffer, pos, exhausted
+        try:
+            buffer = buffer[pos:] + next(chunks)
+            pos = 0
+        except StopIteration:
+            exhausted = True
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in JSON_WHITESPACE:
+            pos += 1
+        if pos >= len(buffer):
+            if exhausted:
+                raise ValueError('Unexpected end of JSON array')
+            more()
+            continue
+        char = buffer[pos]
+        if not started:
+            if char != '[':
+                raise ValueError('Expected a JSON array but found "%s"' % char)
+            started = True
+            pos += 1
+            continue
+        if char == ']':
+            return
+        if char == ',':
+            pos += 1
+            continue
+        try:
+            value, end = decoder.raw_decode(buffer, pos)
+        except ValueError:
+            if exhausted:
+                raise
+            more()
+            continue
+        if end >= len(buffer) and not exhausted:
+            more() # we can't tell a number is complete until we see what follows it
+            continue
+        pos = end
+        yield value
+
+
+def _decode_chunks(chunks, encoding):
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8')()
+    return (decoder.decode(x) for x in chunks)
+
+
+def _get_payload(config, url, callback, source=None):
+    """ like _get_json but the callback receives the undecoded Payload, the
+        body having been streamed to a temporary file """
+    source = source or _source_for(url)
+    with tempfile.NamedTemporaryFile(suffix='.payload') as f:
+        with metrics.stage(source, metrics.STAGE_FETCH):
+            resp = _get_response(config, url, stream=True)
+            if resp is None:
+                return None
+            try:
+                for chunk in metrics.counted_bytes(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE_BYTES),
+                        source, metrics.STAGE_FETCH):
+                    f.write(chunk)
+            finally:
+                resp.close()
+        f.flush()
+        try:
+            return callback(Payload(f.name, resp.encoding, source))
+        except ValueError as e:
+            content_type = resp.headers['Content-type']
+            raise ProcessingFailedError('Expected a JSON response from %s but got %s' % (url, content_type)) from e
+
+
+def _get_json_stream(config, url, callback, source=None):
+    """ like _get_json but the callback receives an iterator of the elements
+        of the top level array, parsed as the body is read off the wire. So
+        the fetch stage is only the time to the response headers, reading
+        the body is part of the decode stage. """
+    source = source or _source_for(url)
+    with metrics.stage(source, metrics.STAGE_FETCH):
+        resp = _get_response(config, url, stream=True)
+    if resp is None:
+        return None
+    chunks = _decode_chunks(metrics.counted_bytes(
+            resp.iter_content(chunk_size=STREAM_CHUNK_SIZE_BYTES), source, metrics.STAGE_FETCH),
+        resp.encoding)
+    try:
+        return callback(metrics.timed_iter(_iter_json_array(chunks), source, metrics.STAGE_DECODE))
+    except ValueError as e:
+        content_type = resp.headers['Content-type']
+        raise ProcessingFailedError('Expected a JSON response from %s but got %s' % (url, content_type)) from e
+    finally:
+        resp.close()
+
+
+def _get_records_if_changed(config, url, callback, endpoint, year, month):
+    """ only calls the callback when the payload differs from the one we
+        stored last time for this endpoint/month. We send the previous ETag
+        so the server can reply 304, otherwise we spool the body to a
+        temporary file (memory first, then disk) while hashing it and compare
+        the digest. The new digest is saved in the callback's transaction.
+        With TRANSFORM_PROCESSES the spool is always on disk so the Payload
+        can name it. """
+    previous = database.UpstreamDigest.query.filter_by(
+        endpoint=endpoint, year=year, month=month).first()
+    fetch_start = time.perf_counter()
+    resp = _get_response(config, url, stream=True, etag=previous and previous.etag)
+    if resp is None or resp.status_code == 304:
+        metrics.observe_stage(endpoint, metrics.STAGE_FETCH, time.perf_counter() - fetch_start)
+        return STATUS_NO_DATA if resp is None else STATUS_SKIPPED
+    if config.get('TRANSFORM_PROCESSES'):
+        spool = tempfile.NamedTemporaryFile(suffix='.payload')
+    else:
+        spool = tempfile.SpooledTemporaryFile(max_size=config.get('SPOOL_MAX_MEMORY_BYTES') or 0)
+    with spool:
+        digest = hashlib.sha256()
+        try:
+            for chunk in metrics.counted_bytes(resp.iter_content(chunk_size=STREAM_CHUNK_SIZE_BYTES),
+                    endpoint, metrics.STAGE_FETCH):
+                digest.update(chunk)
+                spool.write(chunk)
+        finally:
+            resp.close()
+            metrics.observe_stage(endpoint, metrics.STAGE_FETCH, time.perf_counter() - fetch_start)
+        digest = digest.hexdigest()
+        if previous and previous.digest == digest:
+            return STATUS_SKIPPED
+        if previous is None:
+            previous = database.UpstreamDigest(endpoint=endpoint, year=year, month=month)
+            db.session.add(previous)
+        previous.digest = digest
+        previous.etag = resp.headers.get('ETag')
+        spool.seek(0)
+        chunks = _decode_chunks(iter(lambda: spool.read(STREAM_CHUNK_SIZE_BYTES), b''),
+            resp.encoding)
+        try:
+            if config.get('TRANSFORM_PROCESSES'):
+                spool.flush()
+                callback(Payload(spool.name, resp.encoding, endpoint))
+            elif config.get('STREAM_JSON'):
+                callback(metrics.timed_iter(_iter_json_array(chunks), endpoint, metrics.STAGE_DECODE))
+            else:
+                with metrics.stage(endpoint, metrics.STAGE_DECODE):
+                    records = json.loads(''.join(chunks))
+                metrics.add_records(endpoint, metrics.STAGE_DECODE, len(records))
+                callback(records)
+        except ValueError as e:
+            db.session.rollback()
+            content_type = resp.headers['Content-type']
+            raise ProcessingFailedError('Expected a JSON response from %s but got %s' % (url, content_type)) from e
+        db.session.commit()
+    return STATUS_REWRITTEN
+
+
+def _get_records(config, url, callback, endpoint, year, month):
+    """ gets the records for a service's month using the configured strategy
+        (streaming, whole or as a Payload for the transform pool, skipping
+        unchanged payloads or not) and reports
+        what happened as one of the STATUS_* values """
+    if config.get('SKIP_UNCHANGED_PAYLOADS'):
+        return _get_records_if_changed(config, url, callback, endpoint, year, month)
+    def rewritten(records):
+        callback(records)
+        return STATUS_REWRITTEN
+    if config.get('TRANSFORM_PROCESSES'):
+        result = _get_payload(config, url, rewritten, endpoint)
+    elif config.get('STREAM_JSON'):
+        result = _get_json_stream(config, url, rewritten, endpoint)
+    else:
+        result = _get_json(config, url, rewritten, endpoint)
+    return result or STATUS_NO_DATA
+
+
 class NoFilesystemIdFoundError(Exception):
     pass
 
@@ -313,6 +899,17 @@ def _get_filesystem_id(name, config):
     return _get_json(config, '{}/xfs/filesystem'.format(config.get('USAGE_SERVER')), handler)
 
 
+def _build_hpchome(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        hard=get('hard', curr),
+        usage=get('usage', curr),
+        soft=get('soft', curr),
+        owner=get('owner', curr)
+    )
+
+
 def process_hpcstorage(year, month, config):
     """ pull and store HPC Storage (Home Account Storage) """
     _log(year, month, 'HPC Storage')
@@ -320,24 +917,38 @@ def process_hpcstorage(year, month, config):
     end_ms = get_end_ms(year, month)
     filesystem_name = config.get('HPC_STORAGE_FSNAME')
     filesystem_id = _get_filesystem_id(filesystem_name, config)
-    def handler(json_body):
-        db.session.query(database.HpcHomeUsage).filter(
-            database.HpcHomeUsage.year==year,
-            database.HpcHomeUsage.month==month).delete()
-        for curr in json_body:
-            record = database.HpcHomeUsage(
-                year=year,
-                month=month,
-                hard=get('hard', curr),
-                usage=get('usage', curr),
-                soft=get('soft', curr),
-                owner=get('owner', curr)
-            )
-            record.save(commit=False)
-        db.session.commit()
-    _get_json(config, '{}/xfs/filesystem/{}/summary?start={}&end={}'.\
+    def handler(records):
+        _replace_month(database.HpcHomeUsage, cache.SERVICE_HPCSTORAGE, year, month, records,
+            _build_hpchome, config)
+    return _get_records(config, '{}/xfs/filesystem/{}/summary?start={}&end={}'.\
             format(config.get('USAGE_SERVER'), filesystem_id, start_ms, end_ms),
-        handler)
+        handler, 'hpchome', year, month)
+
+
+def _get_manager_prop(record, index):
+    try:
+        return record['manager'][index]
+    except IndexError:
+        return None
+
+
+def _build_nectar(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        flavor=get('flavor', curr),
+        instance_id=get('instance_id', curr),
+        biller=_get_manager_prop(curr, 0),
+        managerunit=_get_manager_prop(curr, 1),
+        server=get('server', curr),
+        server_id=get('server_id', curr),
+        az=get('az', curr),
+        tenant=get('tenant', curr),
+        account=get('account', curr),
+        image=get('image', curr),
+        span=get('span', curr),
+        hypervisor=get('hypervisor', curr),
+    )
 
 
 def process_nectar(year, month, config):
@@ -345,41 +956,32 @@ def process_nectar(year, month, config):
     _log(year, month, 'NECTAR')
     start_ms = get_start_ms(year, month)
     end_ms = get_end_ms(year, month)
-    def handler(json_body):
-        def get_manager_prop(record, index):
-            try:
-                return record['manager'][index]
-            except IndexError:
-                return None
-        db.session.query(database.NectarUsage).filter(
-            database.NectarUsage.year==year,
-            database.NectarUsage.month==month).delete()
-        for curr in json_body:
-            record = database.NectarUsage(
-                year=year,
-                month=month,
-                flavor=get('flavor', curr),
-                instance_id=get('instance_id', curr),
-                biller=get_manager_prop(curr, 0),
-                managerunit=get_manager_prop(curr, 1),
-                server=get('server', curr),
-                server_id=get('server_id', curr),
-                az=get('az', curr),
-                tenant=get('tenant', curr),
-                account=get('account', curr),
-                image=get('image', curr),
-                span=get('span', curr),
-                hypervisor=get('hypervisor', curr),
-            )
-            record.save(commit=False)
-        db.session.commit()
+    def handler(records):
+        _replace_month(database.NectarUsage, cache.SERVICE_NECTAR, year, month, records,
+            _build_nectar, config)
     try:
-        _get_json(config, '{}/usage/nova/NovaUsage_{}_{}.json'.\
+        return _get_records(config, '{}/usage/nova/NovaUsage_{}_{}.json'.\
                 format(config.get('REPORTING_SERVER'), start_ms, end_ms),
-            handler)
+            handler, 'nectar', year, month)
     except ProcessingFailedError as e:
         logger.warn('Problem getting NECTAR data for %d/%d. ' % (month, year) +
                 "Endpoint doesn't use 404 status code like we want.")
+        return STATUS_NO_DATA
+
+
+def _build_tango(year, month, curr):
+    return dict(
+        year=year,
+        month=month,
+        business_unit=get('businessUnit', curr),
+        core=get('core', curr),
+        vm_id=get('id', curr),
+        os=get('os', curr),
+        ram=get('ram', curr),
+        server=get('server', curr),
+        storage=get('storage', curr),
+        span=get('span', curr),
+    )
 
 
 def process_tango(year, month, config):
@@ -387,52 +989,136 @@ def process_tango(year, month, config):
     _log(year, month, 'Tango')
     start_ms = get_start_ms(year, month)
     end_ms = get_end_ms(year, month)
-    def handler(json_body):
-        db.session.query(database.TangoUsage).filter(
-            database.TangoUsage.year==year,
-            database.TangoUsage.month==month).delete()
-        for curr in json_body:
-            record = database.TangoUsage(
-                year=year,
-                month=month,
-                business_unit=get('businessUnit', curr),
-                core=get('core', curr),
-                vm_id=get('id', curr),
-                os=get('os', curr),
-                ram=get('ram', curr),
-                server=get('server', curr),
-                storage=get('storage', curr),
-                span=get('span', curr),
-            )
-            record.save(commit=False)
-        db.session.commit()
+    def handler(records):
+        _replace_month(database.TangoUsage, cache.SERVICE_TANGO, year, month, records,
+            _build_tango, config)
     try:
-        _get_json(config, '{}/vms/instance?start={}&end={}'.\
+        return _get_records(config, '{}/vms/instance?start={}&end={}'.\
                 format(config.get('USAGE_SERVER'), start_ms, end_ms),
-            handler)
+            handler, 'tango', year, month)
     except ProcessingFailedError as e:
         logger.warn('Problem getting Tango data for %d/%d. ' % (month, year) +
                 "Endpoint doesn't use 404 status code like we want")
+        return STATUS_NO_DATA
+
+
+# the service and endpoint each usage table is ingested for
+MODEL_SOURCES = {
+    database.HpcSummaryUsage: (cache.SERVICE_HPCSUMMARY, 'hpcsummary'),
+    database.HnasVVUsage: (cache.SERVICE_ALLOCATIONSUMMARY, 'hnasvv'),
+    database.HnasFSUsage: (cache.SERVICE_ALLOCATIONSUMMARY, 'hnasfs'),
+    database.HcpUsage: (cache.SERVICE_ALLOCATIONSUMMARY, 'hcp'),
+    database.XfsUsage: (cache.SERVICE_ALLOCATIONSUMMARY, 'xfs'),
+    database.HpcHomeUsage: (cache.SERVICE_HPCSTORAGE, 'hpchome'),
+    database.NectarUsage: (cache.SERVICE_NECTAR, 'nectar'),
+    database.TangoUsage: (cache.SERVICE_TANGO, 'tango'),
+}
+
+
+def forget_month(model, year, month):
+    """ forgets what ingestion knows of the model's month once its rows have
+        gone: the payload digest, so ingesting it again isn't skipped as
+        unchanged, and the rollup, which is marked stale so it's rebuilt
+        without them """
+    service, endpoint = MODEL_SOURCES[model]
+    try:
+        database.UpstreamDigest.query.\
+            filter_by(endpoint=endpoint, year=year, month=month).\
+            delete(synchronize_session=False)
+        _data_changed(service, year, month)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    cache.response_cache.invalidate(service, year, month)
+
+
+def detach_months(before_year, before_month):
+    """ detaches the partitions of every usage table for the months before
+        the given one, for archiving, and forgets those months. Returns the
+        names of the detached tables. """
+    result = []
+    for model in database.PARTITIONED_MODELS:
+        for name, year, month in database.detach_month_partitions(model, before_year, before_month):
+            forget_month(model, year, month)
+            result.append(name)
+    return result
+
+
+FLAVOR_FIELDS = ('flavor_id', 'vcpus', 'ephemeral', 'name', 'ram', 'disk', 'is_public',
+    'openstack_id')
+
+
+def _flavor_values(curr):
+    """ maps an upstream flavor to the values we store for it, with the ids
+        as the strings they're stored as so they compare equal """
+    result = {
+        'flavor_id': get('id', curr),
+        'vcpus': get('vcpus', curr),
+        'ephemeral': get('ephemeral', curr),
+        'name': get('name', curr),
+        'ram': get('ram', curr),
+        'disk': get('disk', curr),
+        'is_public': get('public', curr),
+        'openstack_id': get('openstack_id', curr),
+    }
+    for field in ('flavor_id', 'openstack_id'):
+        if result[field] is not None:
+            result[field] = str(result[field])
+    return result
+
+
+def _load_flavors():
+    found = db.session.query(database.NovaFlavor.id,
+        *[getattr(database.NovaFlavor, x) for x in FLAVOR_FIELDS]).all()
+    return [(x[0], dict(zip(FLAVOR_FIELDS, x[1:]))) for x in found]
+
+
+def _diff_flavors(existing, incoming):
+    """ like _diff_contracts but for the flavors, which are keyed on their
+        flavor_id. existing is a list of (id, values) and incoming a list of
+        values. Returns (ids to delete, values to insert). """
+    incoming_by_id = {x['flavor_id']: x for x in incoming}
+    existing_by_id = {}
+    for row_id, values in existing:
+        existing_by_id.setdefault(values['flavor_id'], []).append((row_id, values))
+    ids_to_delete = []
+    to_insert = []
+    for flavor_id, values in incoming_by_id.items():
+        matches = existing_by_id.get(flavor_id, [])
+        if len(matches) == 1 and matches[0][1] == values:
+            continue
+        ids_to_delete.extend(x[0] for x in matches)
+        to_insert.append(values)
+    return ids_to_delete, to_insert
 
 
 def process_nova_flavor(config):
-    """ pull and store the NECTAR Nova flavor data """
+    """ pull and store the NECTAR Nova flavor data. Like the contracts, only
+        the flavors that changed are rewritten and NECTAR is only marked as
+        changed when there were some. """
     url = config.get('USAGE_SERVER') + '/nova/flavor'
     def handler(json_body):
         logger.debug('retrieved %d records nova flavor' % len(json_body))
-        for curr in json_body:
-            flavor_id = get('id', curr)
-            database.NovaFlavor.query.filter_by(flavor_id=flavor_id).delete()
-            record = database.NovaFlavor(
-                flavor_id=flavor_id,
-                vcpus=get('vcpus', curr),
-                ephemeral=get('ephemeral', curr),
-                name=get('name', curr),
-                ram=get('ram', curr),
-                disk=get('disk', curr),
-                is_public=get('public', curr),
-                openstack_id=get('openstack_id', curr),
-            )
-            record.save(commit=False)
-        db.session.commit()
-    _get_json(config, url, handler)
+        ids_to_delete, to_insert = _diff_flavors(_load_flavors(),
+            [_flavor_values(x) for x in json_body])
+        if not (ids_to_delete or to_insert):
+            return STATUS_SKIPPED
+        with writer(config):
+            try:
+                for i in range(0, len(ids_to_delete), DELETE_CHUNK_SIZE):
+                    database.NovaFlavor.query.\
+                        filter(database.NovaFlavor.id.in_(ids_to_delete[i:i + DELETE_CHUNK_SIZE])).\
+                        delete(synchronize_session=False)
+                db.session.add_all([database.NovaFlavor(**x) for x in to_insert])
+                # the cost of every NECTAR month depends on the flavors
+                _data_changed(cache.SERVICE_NECTAR)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+        logger.debug('nova flavor: deleted %d and inserted %d records' %
+            (len(ids_to_delete), len(to_insert)))
+        cache.response_cache.invalidate(cache.SERVICE_NECTAR)
+        return STATUS_REWRITTEN
+    return _get_json(config, url, handler) or STATUS_NO_DATA
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Opt-in profiling of the SQL and Python work behind a single request"""
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('profiling')
+logger.setLevel(logging.DEBUG)
+
+SECTION_BUILD_DICT = 'build_dict'
+SECTION_COST = 'cost'
+SECTION_CLEAN_TYPES = 'clean_types'
+EXPLAINABLE = ('SELECT', 'WITH')
+
+_current = threading.local()
+_active = [0] # profiles current in any thread, so the common case is one check
+_active_lock = threading.Lock()
+
+
+class Profile(object):
+    """ the queries (SQL, rows, time and, for slow ones, the plan) and time
+        spent in each Python section while the profile was current """
+
+    def __init__(self, slow_query_ms=None):
+        self.slow_query_ms = slow_query_ms
+        self.queries = []
+        self.sections = OrderedDict()
+        self.elapsed = 0
+
+    def add_section(self, name, seconds):
+        self.sections[name] = self.sections.get(name, 0) + seconds
+
+    @property
+    def db_seconds(self):
+        return sum(x['elapsed_ms'] for x in self.queries) / 1000.0
+
+    def to_dict(self):
+        """ times are in ms, python_ms is everything that wasn't the DB """
+        result = OrderedDict([
+            ('total_ms', round(self.elapsed * 1000, 2)),
+            ('db_ms', round(self.db_seconds * 1000, 2)),
+            ('python_ms', round((self.elapsed - self.db_seconds) * 1000, 2)),
+        ])
+        for name, seconds in self.sections.items():
+            result[name + '_ms'] = round(seconds * 1000, 2)
+        result['query_count'] = len(self.queries)
+        result['queries'] = self.queries
+        return result
+
+    def server_timing(self):
+        """ a Server-Timing header value, which browser dev tools display """
+        timings = [(k[:-3], v) for k, v in self.to_dict().items() if k.endswith('_ms')]
+        return ', '.join('%s;dur=%s' % x for x in timings)
+
+
+def current():
+    return getattr(_current, 'profile', None)
+
+
+@contextmanager
+def profiled(slow_query_ms=None):
+    """ profiles everything the calling thread does in the block """
+    previous = current()
+    profile = _current.profile = Profile(slow_query_ms)
+    with _active_lock:
+        _active[0] += 1
+    start = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.elapsed = time.perf_counter() - start
+        _current.profile = previous
+        with _active_lock:
+            _active[0] -= 1
+
+
+def timed(section):
+    """ decorates a function so the time spent in it counts towards the
+        section, only costs a lookup when nothing is being profiled """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _active[0]:
+                return fn(*args, **kwargs)
+            profile = current()
+            if profile is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profile.add_section(section, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _explain_analyze(cursor, statement, parameters):
+    """ the plan for the statement, run on a fresh cursor inside a savepoint
+        so a failure doesn't abort the request's transaction. ANALYZE really
+        runs the statement so this is only done for reads. """
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute('SAVEPOINT profiling_explain')
+        try:
+            explain_cursor.execute('EXPLAIN ANALYZE ' + statement, parameters)
+            plan = '\n'.join(x[0] for x in explain_cursor.fetchall())
+        except Exception:
+            explain_cursor.execute('ROLLBACK TO SAVEPOINT profiling_explain')
+            logger.exception('Could not EXPLAIN ANALYZE the slow query')
+            return None
+        explain_cursor.execute('RELEASE SAVEPOINT profiling_explain')
+        return plan
+    finally:
+        explain_cursor.close()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active[0] and current() is not None:
+        conn.info.setdefault('profiling_starts', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not _active[0]:
+        return
+    profile = current()
+    starts = conn.info.get('profiling_starts')
+    if profile is None or not starts:
+        return
+    elapsed_ms = (time.perf_counter() - starts.pop()) * 1000
+    query = OrderedDict([
+        ('sql', statement),
+        # DBAPIs like sqlite3 don't know the row count of a SELECT
+        ('rows', cursor.rowcount if cursor.rowcount >= 0 else None),
+        ('elapsed_ms', round(elapsed_ms, 2)),
+    ])
+    profile.queries.append(query)
+    if not profile.slow_query_ms or elapsed_ms < profile.slow_query_ms:
+        return
+    plan = None
+    is_read = statement.lstrip().upper().startswith(EXPLAINABLE)
+    if conn.dialect.name == 'postgresql' and is_read and not executemany:
+        plan = query['plan'] = _explain_analyze(cursor, statement, parameters)
+    logger.warning('Slow query (%.1fms, %s rows): %s\nparameters: %r%s' % (elapsed_ms,
+        query['rows'], statement, parameters, '\n' + plan if plan else ''))
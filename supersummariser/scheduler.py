@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Periodic ingestion, running each group of processors at its own cadence"""
+import fcntl
+import logging
+import os
+import random
+import time
+
+import supersummariser.services as services
+
+logger = logging.getLogger('scheduler')
+
+
+class IngestLock(object):
+    """ an exclusive lock on a file. Every scheduler and /process job on the
+        host shares the file, so only one of them ingests at a time. The OS
+        releases the lock if the holder dies. """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = None
+
+    def acquire(self, blocking=False):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+
+class Schedule(object):
+    """ a named group of tasks, from build_tasks(now), that runs every
+        interval_secs """
+
+    def __init__(self, name, interval_secs, build_tasks):
+        self.name = name
+        self.interval_secs = interval_secs
+        self.build_tasks = build_tasks
+        self.next_run = None
+
+
+def _current_month_tasks(now):
+    return services._build_month_tasks(services._get_months_to_process(1, now))
+
+
+def _historical_month_tasks(months_back):
+    def result(now):
+        # everything but the current month, that has its own schedule
+        months = services._get_months_to_process(months_back, now)[:-1]
+        return services._build_month_tasks(months)
+    return result
+
+
+def build_schedules(config):
+    """ the current month changes constantly, contracts change daily-ish
+        and older months only change when upstream fixes something """
+    return [
+        Schedule('current_month', config.get('SCHEDULE_CURRENT_MONTH_SECS'),
+            _current_month_tasks),
+        Schedule('contracts', config.get('SCHEDULE_CONTRACTS_SECS'),
+            lambda now: services._build_contract_tasks()),
+        Schedule('historical_months', config.get('SCHEDULE_HISTORICAL_SECS'),
+            _historical_month_tasks(config.get('SCHEDULE_HISTORICAL_MONTHS'))),
+    ]
+
+
+class Scheduler(object):
+    """ runs each schedule when it's due. Every run is pushed back by a
+        random amount, up to jitter_secs, so schedulers that started
+        together drift apart, and a run only happens while holding the
+        lock. A schedule that couldn't get the lock tries again after
+        another jitter. """
+
+    def __init__(self, schedules, config, lock, jitter_secs=0,
+            clock=time.time, sleep=time.sleep, rand=random.uniform):
+        self.schedules = schedules
+        self.config = config
+        self.lock = lock
+        self.jitter_secs = jitter_secs or 0
+        self.clock = clock
+        self.sleep = sleep
+        self.rand = rand
+
+    def _jitter(self):
+        return self.rand(0, self.jitter_secs)
+
+    def start(self):
+        """ everything is due straight away (give or take the jitter) """
+        now = self.clock()
+        for curr in self.schedules:
+            curr.next_run = now + self._jitter()
+
+    def start_now(self):
+        """ everything is due straight away, no jitter """
+        now = self.clock()
+        for curr in self.schedules:
+            curr.next_run = now
+
+    def run_pending(self):
+        """ runs every schedule that's due, returns their names """
+        result = []
+        for curr in self.schedules:
+            now = self.clock()
+            if curr.next_run > now:
+                continue
+            if not self.lock.acquire():
+                logger.info('Another process is ingesting, deferring %s' % curr.name)
+                curr.next_run = now + max(self._jitter(), 1)
+                continue
+            try:
+                self._run(curr)
+            finally:
+                self.lock.release()
+            curr.next_run = self.clock() + curr.interval_secs + self._jitter()
+            result.append(curr.name)
+        return result
+
+    def _run(self, schedule):
+        tasks = schedule.build_tasks(services._now_provider())
+        logger.info('Running schedule %s with %d tasks' % (schedule.name, len(tasks)))
+        try:
+            outcome = services.run_tasks(tasks, self.config)
+        except Exception:
+            # keep the daemon alive, the next run will try again
+            logger.exception('Schedule %s failed' % schedule.name)
+            return
+        if outcome['success']:
+            logger.info('Schedule %s finished in %dms, rewrote %s, skipped %s' % (schedule.name,
+                outcome['elapsed_ms'], outcome['months_rewritten'], outcome['months_skipped']))
+        else:
+            logger.warning('Schedule %s failed: %s' % (schedule.name, outcome['message']))
+
+    def seconds_until_next(self):
+        return max(min(x.next_run for x in self.schedules) - self.clock(), 0)
+
+    def run_forever(self):
+        self.start()
+        while True:
+            self.run_pending()
+            self.sleep(self.seconds_until_next())
+
+
+def create_scheduler(config):
+    return Scheduler(build_schedules(config), config,
+        IngestLock(config.get('SCHEDULE_LOCK_FILE')),
+        jitter_secs=config.get('SCHEDULE_JITTER_SECS'))
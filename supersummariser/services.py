@@ -3,11 +3,15 @@
 import math
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-from sqlalchemy import func, or_, and_
+from flask import current_app
+from sqlalchemy import func, or_, cast, literal_column, tuple_, type_coerce, union_all
 from decimal import Decimal
 import pendulum
 
+from supersummariser import cache, metrics, profiling
+from supersummariser.contract_index import contract_index
 import supersummariser.database as d
 from supersummariser.extensions import db, migrate
 import supersummariser.processors as p
@@ -20,6 +24,7 @@ BYTES_TO_GB = 1073741824
 MB_TO_GB = 1000
 
 
+@profiling.timed(profiling.SECTION_BUILD_DICT)
 def build_dict(src, list_of_fields):
     # FIXME look at access results by dict key, not list index
     result = {}
@@ -35,16 +40,19 @@ def merge_cols(base_cols, *cols):
     return base_cols + cols
 
 
+@profiling.timed(profiling.SECTION_COST)
 def calculate_cost(usage, cost):
     return usage * cost
 
 
+@profiling.timed(profiling.SECTION_COST)
 def seconds_to_hours(seconds):
     seconds_per_hour = 3600
     decimal_seconds= Decimal(seconds)
     return decimal_seconds / seconds_per_hour
 
 
+@profiling.timed(profiling.SECTION_CLEAN_TYPES)
 def _clean_types(source):
     """ converts any types that don't play nice with JSON, like decimal """
     for curr_key in source:
@@ -54,30 +62,73 @@ def _clean_types(source):
     return source
 
 
-def get_hpcsummary_simple(year, month, config):
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.Contract.unit_price)
-    found = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.HpcSummaryUsage.cores),
-                func.sum(d.HpcSummaryUsage.cpu_seconds),
-                func.sum(d.HpcSummaryUsage.job_count)
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            d.HpcSummaryUsage.year == year,
-            d.HpcSummaryUsage.month == month,
-            d.AccountContact.managerusername == d.HpcSummaryUsage.owner,
-            d.Contract.contract_type == p.CONTRACT_TYPE_ERSA_ACCOUNT
-        ).\
-        group_by(*cols).\
+def _add_sums(a, b):
+    """ adds like SQL's SUM does, where NULLs are ignored """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _usage_by_contract(contract_type, key_column, group_columns, sum_columns, filters,
+        org_filter=None, by_unit_price=True):
+    """ sums the usage per contract join key (and group_columns) in SQL then
+        resolves each key's biller/managerunit/unit_price from the contract
+        index, rather than joining Account, AccountContact and Contract for
+        every query. Like the join, a key billed against several contracts
+        counts towards each of them. Returns a dict of (biller, managerunit,
+        [unit_price,] *group values) to the list of sums. """
+    found = db.session.query(key_column, *merge_cols(tuple(group_columns), *sum_columns)).\
+        filter(*filters).\
+        group_by(key_column, *group_columns).\
         all()
-    result = []
+    index = contract_index.lookup_all()
+    group_count = len(group_columns)
+    result = {}
     for row in found:
-        item = build_dict(row, [
+        groups = tuple(row[1:1 + group_count])
+        sums = row[1 + group_count:]
+        for biller, managerunit, unit_price in index.get((contract_type, row[0]), ()):
+            if org_filter and biller != org_filter:
+                continue
+            key = (biller, managerunit) + ((unit_price,) if by_unit_price else ()) + groups
+            try:
+                result[key] = [_add_sums(x, y) for x, y in zip(result[key], sums)]
+            except KeyError:
+                result[key] = list(sums)
+    return result
+
+
+def _since_month_window(model, month_window):
+    """ a row value comparison, rather than ORing the year and month tests,
+        so it's a single range on the (year, month, ...) indexes """
+    date_bounds = p.get_year_month_for_n_months_ago(month_window)
+    return tuple_(model.year, model.month) > tuple_(date_bounds['year'], date_bounds['month'])
+
+
+def month_period(year, month):
+    """ the integer period key of a month, ordered like (year, month) """
+    return year * 12 + month
+
+
+def _since_period_window(month_window):
+    """ the MonthlyRollup rows in the window, as one comparison on the
+        indexed period column """
+    date_bounds = p.get_year_month_for_n_months_ago(month_window)
+    return d.MonthlyRollup.period > month_period(date_bounds['year'], date_bounds['month'])
+
+
+def _live_hpcsummary_simple(year, month, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_ERSA_ACCOUNT, d.HpcSummaryUsage.owner, (),
+        (func.sum(d.HpcSummaryUsage.cores),
+         func.sum(d.HpcSummaryUsage.cpu_seconds),
+         func.sum(d.HpcSummaryUsage.job_count)),
+        (d.HpcSummaryUsage.year == year,
+         d.HpcSummaryUsage.month == month))
+    result = []
+    for key, sums in found.items():
+        item = build_dict(key + tuple(sums), [
             'biller',
             'managerunit',
             'unit_price',
@@ -180,38 +231,17 @@ def get_hpcsummary_detailed(year, month, config):
     return result
 
 
-def get_hpcsummary_chart(org_filter, month_window, config):
-    date_bounds = p.get_year_month_for_n_months_ago(month_window)
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.Contract.unit_price,
-            d.HpcSummaryUsage.year,
-            d.HpcSummaryUsage.month)
-    partial = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.HpcSummaryUsage.cores),
-                func.sum(d.HpcSummaryUsage.cpu_seconds),
-                func.sum(d.HpcSummaryUsage.job_count)
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            or_(d.HpcSummaryUsage.year > date_bounds['year'],
-                and_(
-                    d.HpcSummaryUsage.year == date_bounds['year'],
-                    d.HpcSummaryUsage.month > date_bounds['month']
-                )),
-            d.AccountContact.managerusername == d.HpcSummaryUsage.owner,
-            d.Contract.contract_type == p.CONTRACT_TYPE_ERSA_ACCOUNT
-        ).\
-        group_by(*cols)
-    if org_filter:
-        partial = partial.filter(d.Account.biller == org_filter)
-    found = partial.all()
+def _live_hpcsummary_chart(org_filter, month_window, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_ERSA_ACCOUNT, d.HpcSummaryUsage.owner,
+        (d.HpcSummaryUsage.year, d.HpcSummaryUsage.month),
+        (func.sum(d.HpcSummaryUsage.cores),
+         func.sum(d.HpcSummaryUsage.cpu_seconds),
+         func.sum(d.HpcSummaryUsage.job_count)),
+        (_since_month_window(d.HpcSummaryUsage, month_window),),
+        org_filter=org_filter)
     result = []
-    for row in found:
-        item = build_dict(row, [
+    for key, sums in found.items():
+        item = build_dict(key + tuple(sums), [
             'biller',
             'managerunit',
             'unit_price',
@@ -223,495 +253,606 @@ def get_hpcsummary_chart(org_filter, month_window, config):
         ])
         item['cpu_hours'] = seconds_to_hours(item['cpu_seconds'])
         item['cost'] = calculate_cost(item['cpu_hours'], item['unit_price'])
-        item['unit_price'] = item['unit_price']
-        item['cpu_hours'] = item['cpu_hours']
         item['service'] = 'HPC Compute'
         result.append(_clean_types(item))
     return result
 
 
-def get_allocationsummary_simple(year, month, config):
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.Contract.unit_price)
-    contract_filter = or_(
-        d.Contract.contract_type == p.CONTRACT_TYPE_STORAGE,
-        d.Contract.contract_type == p.CONTRACT_TYPE_STORAGE_BACKUP)
-    hnasvv_usage = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.HnasVVUsage.usage) / MB_TO_GB
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            d.HnasVVUsage.year == year,
-            d.HnasVVUsage.month == month,
-            d.Contract.file_system_name == d.HnasVVUsage.virtual_volume,
-            contract_filter
-        ).\
-        group_by(*cols).\
-        all()
-    hnasfs_usage = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.HnasFSUsage.live_usage) / MB_TO_GB
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            d.HnasFSUsage.year == year,
-            d.HnasFSUsage.month == month,
-            d.Contract.file_system_name == d.HnasFSUsage.filesystem,
-            contract_filter
-        ).\
-        group_by(*cols).\
-        all()
-    hcp_usage = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.HcpUsage.ingested_bytes) / BYTES_TO_GB
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            d.HcpUsage.year == year,
-            d.HcpUsage.month == month,
-            d.Contract.file_system_name == d.HcpUsage.namespace,
-            contract_filter
-        ).\
-        group_by(*cols).\
-        all()
-    xfs_usage = db.session.query(
+ALLOCATION_USAGE_GB = (
+    # (usage model, the column matching Contract.file_system_name, usage in GB)
+    (d.HnasVVUsage, d.HnasVVUsage.virtual_volume, func.sum(d.HnasVVUsage.usage) / MB_TO_GB),
+    (d.HnasFSUsage, d.HnasFSUsage.filesystem, func.sum(d.HnasFSUsage.live_usage) / MB_TO_GB),
+    (d.HcpUsage, d.HcpUsage.namespace, func.sum(d.HcpUsage.ingested_bytes) / BYTES_TO_GB),
+    (d.XfsUsage, d.XfsUsage.filesystem, func.sum(d.XfsUsage.usage) * 1000 / BYTES_TO_GB),
+)
+# the chart labels a biller/managerunit with the latest month of the last of
+# the systems above that it has usage on, as the original per system loop
+# did. That's max(system * SYSTEM_LABEL_FACTOR + year * 100 + month).
+SYSTEM_LABEL_FACTOR = 1000000
+
+
+def _allocation_source(system, model, key_column, usage_gb, filters, org_filter=None,
+        by_month=False):
+    """ the usage (GB) of one of the storage systems per biller, managerunit
+        and unit_price (and year/month when by_month), the level that blocks
+        are charged at. system is its index in ALLOCATION_USAGE_GB. """
+    cols = (d.Account.biller.label('biller'),
+            d.AccountContact.managerunit.label('managerunit'),
+            d.Contract.unit_price.label('unit_price'))
+    if by_month:
+        cols = merge_cols(cols, model.year.label('year'), model.month.label('month'))
+    partial = db.session.query(
             *merge_cols(cols,
-                func.sum(d.XfsUsage.usage) * 1000 / BYTES_TO_GB
+                usage_gb.label('usage'),
+                literal_column(str(system)).label('system')
             )
         ).\
         join(d.AccountContact).\
         join(d.Contract).\
         filter(
-            d.XfsUsage.year == year,
-            d.XfsUsage.month == month,
-            d.Contract.file_system_name == d.XfsUsage.filesystem,
-            contract_filter
+            d.Contract.file_system_name == key_column,
+            or_(
+                d.Contract.contract_type == p.CONTRACT_TYPE_STORAGE,
+                d.Contract.contract_type == p.CONTRACT_TYPE_STORAGE_BACKUP),
+            *filters
         ).\
+        group_by(*cols)
+    if org_filter:
+        partial = partial.filter(d.Account.biller == org_filter)
+    return partial
+
+
+def _allocation_union(filters_for, org_filter=None, by_month=False):
+    """ the usage (GB) of all four storage systems as one UNION ALL
+        subquery, still one row per system so blocks are charged per system.
+        filters_for(model) gives the filters for each usage model. """
+    sources = [_allocation_source(i, model, key_column, usage_gb, filters_for(model),
+            org_filter, by_month).statement
+        for i, (model, key_column, usage_gb) in enumerate(ALLOCATION_USAGE_GB)]
+    return union_all(*sources).subquery()
+
+
+def _storage_totals(source, block_size, by_month=False):
+    """ charges whole blocks for each row of the source and totals the usage,
+        blocks and cost per biller/managerunit, all in the DB. The block size
+        is inlined as a decimal literal so the division is exact on
+        PostgreSQL (rather than integer division) and matches Python's on
+        SQLite. The last column is the chart label (see SYSTEM_LABEL_FACTOR),
+        or just the last system with usage when not by_month. """
+    blocks = cast(func.ceil(source.c.usage / literal_column(repr(float(block_size)))),
+        db.BigInteger)
+    cols = (source.c.biller, source.c.managerunit)
+    aggregates = (
+        func.sum(source.c.usage),
+        cast(func.sum(blocks), db.BigInteger),
+        type_coerce(func.sum(blocks * source.c.unit_price), db.Numeric))
+    label = source.c.system
+    if by_month:
+        label = source.c.system * SYSTEM_LABEL_FACTOR + source.c.year * 100 + source.c.month
+    aggregates = merge_cols(aggregates, func.max(label))
+    return db.session.query(*merge_cols(cols, *aggregates)).\
         group_by(*cols).\
         all()
-    summed_totals = {}
-    for curr in hnasvv_usage + hnasfs_usage + hcp_usage + xfs_usage:
-        biller = curr[0]
-        managerunit = curr[1]
-        key = (biller, managerunit)
-        unit_price = curr[2]
-        usage = curr[3]
-        blocks = int(math.ceil(usage / config.get('STORAGE_BLOCK_SIZE_GB')))
-        cost = blocks * unit_price
-        try:
-            record = summed_totals[key]
-        except KeyError:
-            summed_totals[key] = {
-                'usage': 0,
-                'blocks': 0,
-                'cost': 0
-            }
-            record = summed_totals[key]
-        record['usage'] += usage
-        record['blocks'] += blocks
-        record['cost'] += cost
-    result = [
-        _clean_types({
-            'biller': x[0],
-            'managerunit': x[1],
-            'usage': summed_totals[x]['usage'],
-            'blocks': summed_totals[x]['blocks'],
-            'cost': summed_totals[x]['cost']
-        })
-        for x in summed_totals]
+
+
+def _storage_records(found, label=None):
+    """ turns the per biller/managerunit totals from _storage_totals into
+        records """
+    result = []
+    for curr in found:
+        record = {
+            'biller': curr[0],
+            'managerunit': curr[1],
+            'usage': curr[2],
+            'blocks': curr[3],
+            'cost': curr[4]
+        }
+        if label:
+            year_month = curr[5] % SYSTEM_LABEL_FACTOR
+            record['month'] = year_month % 100
+            record['year'] = year_month // 100
+            record['service'] = label
+        result.append(_clean_types(record))
     return result
 
 
-def get_allocationsummary_chart(org_filter, month_window, config):
-    date_bounds = p.get_year_month_for_n_months_ago(month_window)
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.Contract.unit_price)
-    contract_filter = or_(
-        d.Contract.contract_type == p.CONTRACT_TYPE_STORAGE,
-        d.Contract.contract_type == p.CONTRACT_TYPE_STORAGE_BACKUP)
-    # HNAS Virtual Volume
-    hnasvv_cols = merge_cols(cols,
-                d.HnasVVUsage.year,
-                d.HnasVVUsage.month)
-    hnasvv_partial = db.session.query(
-            *merge_cols(hnasvv_cols,
-                func.sum(d.HnasVVUsage.usage) / MB_TO_GB
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            or_(d.HnasVVUsage.year > date_bounds['year'],
-                and_(
-                    d.HnasVVUsage.year == date_bounds['year'],
-                    d.HnasVVUsage.month > date_bounds['month']
-                )),
-            d.Contract.file_system_name == d.HnasVVUsage.virtual_volume,
-            contract_filter
-        ).\
-        group_by(*hnasvv_cols)
-    if org_filter:
-        hnasvv_partial = hnasvv_partial.filter(d.Account.biller == org_filter)
-    hnasvv_usage = hnasvv_partial.all()
-    # HNAS FileSystem
-    hnasfs_cols = merge_cols(cols,
-                d.HnasFSUsage.year,
-                d.HnasFSUsage.month)
-    hnasfs_partial = db.session.query(
-            *merge_cols(hnasfs_cols,
-                func.sum(d.HnasFSUsage.live_usage) / MB_TO_GB
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            or_(d.HnasFSUsage.year > date_bounds['year'],
-                and_(
-                    d.HnasFSUsage.year == date_bounds['year'],
-                    d.HnasFSUsage.month > date_bounds['month']
-                )),
-            d.Contract.file_system_name == d.HnasFSUsage.filesystem,
-            contract_filter
-        ).\
-        group_by(*hnasfs_cols)
-    if org_filter:
-        hnasfs_partial = hnasfs_partial.filter(d.Account.biller == org_filter)
-    hnasfs_usage = hnasfs_partial.all()
-    # HCP
-    hcp_cols = merge_cols(cols,
-                d.HcpUsage.year,
-                d.HcpUsage.month)
-    hcp_partial = db.session.query(
-            *merge_cols(hcp_cols,
-                func.sum(d.HcpUsage.ingested_bytes) / BYTES_TO_GB
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            or_(d.HcpUsage.year > date_bounds['year'],
-                and_(
-                    d.HcpUsage.year == date_bounds['year'],
-                    d.HcpUsage.month > date_bounds['month']
-                )),
-            d.Contract.file_system_name == d.HcpUsage.namespace,
-            contract_filter
-        ).\
-        group_by(*hcp_cols)
-    if org_filter:
-        hcp_partial = hcp_partial.filter(d.Account.biller == org_filter)
-    hcp_usage = hcp_partial.all()
-    # XFS
-    xfs_cols = merge_cols(cols,
-                d.XfsUsage.year,
-                d.XfsUsage.month)
-    xfs_partial = db.session.query(
-            *merge_cols(xfs_cols,
-                func.sum(d.XfsUsage.usage) * 1000 / BYTES_TO_GB
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            or_(d.XfsUsage.year > date_bounds['year'],
-                and_(
-                    d.XfsUsage.year == date_bounds['year'],
-                    d.XfsUsage.month > date_bounds['month']
-                )),
-            d.Contract.file_system_name == d.XfsUsage.filesystem,
-            contract_filter
-        ).\
-        group_by(*xfs_cols)
-    if org_filter:
-        xfs_partial = xfs_partial.filter(d.Account.biller == org_filter)
-    xfs_usage = xfs_partial.all()
-    summed_totals = {}
-    for curr in hnasvv_usage + hnasfs_usage + hcp_usage + xfs_usage:
-        biller = curr[0]
-        managerunit = curr[1]
-        key = (biller, managerunit)
-        unit_price = curr[2]
-        year = curr[3]
-        month = curr[4]
-        usage = curr[5]
-        blocks = int(math.ceil(usage / config.get('STORAGE_BLOCK_SIZE_GB')))
-        cost = blocks * unit_price
-        try:
-            record = summed_totals[key]
-        except KeyError:
-            summed_totals[key] = {
-                'usage': 0,
-                'blocks': 0,
-                'cost': 0
-            }
-            record = summed_totals[key]
-        record['usage'] += usage
-        record['blocks'] += blocks
-        record['cost'] += cost
-        record['month'] = month
-        record['year'] = year
-    result = [
-        _clean_types({
-            'biller': x[0],
-            'managerunit': x[1],
-            'usage': summed_totals[x]['usage'],
-            'blocks': summed_totals[x]['blocks'],
-            'cost': summed_totals[x]['cost'],
-            'month': summed_totals[x]['month'],
-            'year': summed_totals[x]['year'],
-            'service': 'National Storage'
-        })
-        for x in summed_totals]
+def _allocationsummary_month_totals(year, month, config):
+    source = _allocation_union(lambda model: (model.year == year, model.month == month))
+    return _storage_totals(source, config.get('STORAGE_BLOCK_SIZE_GB'))
+
+
+def _live_allocationsummary_simple(year, month, config):
+    return _storage_records(_allocationsummary_month_totals(year, month, config))
+
+
+def _allocationsummary_rollup_simple(year, month, config):
+    """ the simple records plus the last system with usage, which the rollup
+        keeps so its chart is labelled the same as the live one """
+    found = _allocationsummary_month_totals(year, month, config)
+    result = _storage_records(found)
+    for record, curr in zip(result, found):
+        record['last_system'] = curr[5]
     return result
 
 
-def get_hpcstorage_simple(year, month, config):
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit)
-    found = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.HpcHomeUsage.usage)
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            d.HpcHomeUsage.year == year,
-            d.HpcHomeUsage.month == month,
-            d.AccountContact.managerusername == d.HpcHomeUsage.owner,
-            d.Contract.contract_type == p.CONTRACT_TYPE_ERSA_ACCOUNT
-        ).\
-        group_by(*cols).\
-        all()
+def _live_allocationsummary_chart(org_filter, month_window, config):
+    """ totals the window per biller/managerunit and labels it with the
+        latest month of the last system used """
+    source = _allocation_union(lambda model: (_since_month_window(model, month_window),),
+        org_filter, by_month=True)
+    found = _storage_totals(source, config.get('STORAGE_BLOCK_SIZE_GB'), by_month=True)
+    return _storage_records(found, 'National Storage')
+
+
+def _hpc_storage_records(found, config, label=None):
+    """ turns the raw HPC home usage per (biller, managerunit[, year,
+        month]) into usage, blocks and cost. Anything that rounds to nothing
+        isn't charged for. The config lookups are done once up front and the
+        records built directly, rather than cleaned afterwards, as this runs
+        for every group in the window. """
+    ceil = math.ceil
+    block_size = config.get('STORAGE_BLOCK_SIZE_GB')
+    block_price = config.get('HPC_HOME_BLOCK_PRICE')
+    fields = ('biller', 'managerunit', 'year', 'month')
     result = []
-    for row in found:
-        item = build_dict(row, [
-            'biller',
-            'managerunit'
-        ])
-        raw_usage = row[2]
-        usage_gb = raw_usage * 1024 / BYTES_TO_GB
-        item['usage'] = usage_gb
+    for key, sums in found.items():
+        usage_gb = sums[0] * 1024 / BYTES_TO_GB
         if usage_gb < 1 and round(usage_gb) == 0:
             blocks = 0
         else:
-            blocks = int(math.ceil(usage_gb / config.get('STORAGE_BLOCK_SIZE_GB')))
+            blocks = int(ceil(usage_gb / block_size))
+        item = dict(zip(fields, key))
+        item['usage'] = float(usage_gb) if type(usage_gb) == Decimal else usage_gb
         item['blocks'] = blocks
-        item['cost'] = blocks * config.get('HPC_HOME_BLOCK_PRICE')
+        item['cost'] = calculate_cost(blocks, block_price)
+        if label:
+            item['service'] = label
+        result.append(item)
+    return result
+
+
+def _live_hpcstorage_simple(year, month, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_ERSA_ACCOUNT, d.HpcHomeUsage.owner, (),
+        (func.sum(d.HpcHomeUsage.usage),),
+        (d.HpcHomeUsage.year == year,
+         d.HpcHomeUsage.month == month),
+        by_unit_price=False)
+    return _hpc_storage_records(found, config)
+
+
+def _live_hpcstorage_chart(org_filter, month_window, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_ERSA_ACCOUNT, d.HpcHomeUsage.owner,
+        (d.HpcHomeUsage.year, d.HpcHomeUsage.month),
+        (func.sum(d.HpcHomeUsage.usage),),
+        (_since_month_window(d.HpcHomeUsage, month_window),),
+        org_filter=org_filter, by_unit_price=False)
+    return _hpc_storage_records(found, config, 'HPC Storage')
+
+
+def _live_nectar_simple(year, month, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_NECTAR, d.NectarUsage.tenant, (),
+        (func.sum(d.NovaFlavor.vcpus),),
+        (d.NectarUsage.year == year,
+         d.NectarUsage.month == month,
+         d.NectarUsage.flavor == d.NovaFlavor.openstack_id),
+        by_unit_price=False)
+    result = []
+    for key, sums in found.items():
+        item = build_dict(key, [
+            'biller',
+            'managerunit'
+        ])
+        core_count = sums[0]
+        item['core'] = core_count
+        item['cost'] = calculate_cost(core_count, config.get('NECTAR_NOVA_VCPU_PRICE'))
         result.append(_clean_types(item))
     return result
 
 
-def get_hpcstorage_chart(org_filter, month_window, config):
-    date_bounds = p.get_year_month_for_n_months_ago(month_window)
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.HpcHomeUsage.year,
-            d.HpcHomeUsage.month)
-    partial = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.HpcHomeUsage.usage)
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            or_(d.HpcHomeUsage.year > date_bounds['year'],
-                and_(
-                    d.HpcHomeUsage.year == date_bounds['year'],
-                    d.HpcHomeUsage.month > date_bounds['month']
-                )),
-            d.AccountContact.managerusername == d.HpcHomeUsage.owner,
-            d.Contract.contract_type == p.CONTRACT_TYPE_ERSA_ACCOUNT
-        ).\
-        group_by(*cols)
-    if org_filter:
-        partial = partial.filter(d.Account.biller == org_filter)
-    found = partial.all()
+def _live_nectar_chart(org_filter, month_window, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_NECTAR, d.NectarUsage.tenant,
+        (d.NectarUsage.year, d.NectarUsage.month),
+        (func.sum(d.NovaFlavor.vcpus),),
+        (_since_month_window(d.NectarUsage, month_window),
+         d.NectarUsage.flavor == d.NovaFlavor.openstack_id),
+        org_filter=org_filter, by_unit_price=False)
     result = []
-    for row in found:
-        item = build_dict(row, [
+    for key, sums in found.items():
+        item = build_dict(key, [
             'biller',
             'managerunit',
             'year',
             'month'
         ])
-        raw_usage = row[4]
-        usage_gb = raw_usage * 1024 / BYTES_TO_GB
-        item['usage'] = usage_gb
-        if usage_gb < 1 and round(usage_gb) == 0:
-            blocks = 0
-        else:
-            blocks = int(math.ceil(usage_gb / config.get('STORAGE_BLOCK_SIZE_GB')))
-        item['blocks'] = blocks
-        item['cost'] = blocks * config.get('HPC_HOME_BLOCK_PRICE')
-        item['service'] = 'HPC Storage'
+        core_count = sums[0]
+        item['core'] = core_count
+        item['cost'] = calculate_cost(core_count, config.get('NECTAR_NOVA_VCPU_PRICE'))
+        item['service'] = 'NECTAR'
         result.append(_clean_types(item))
     return result
 
 
-def get_nectar_simple(year, month, config):
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit)
-    found = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.NovaFlavor.vcpus)
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            d.NectarUsage.year == year,
-            d.NectarUsage.month == month,
-            d.NectarUsage.flavor == d.NovaFlavor.openstack_id,
-            d.NectarUsage.tenant == d.Contract.openstack_project_id,
-            d.Contract.contract_type == p.CONTRACT_TYPE_NECTAR
-        ).\
-        group_by(*cols).\
-        all()
+def _live_tango_simple(year, month, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_TANGO, d.TangoUsage.vm_id, (),
+        (func.sum(d.TangoUsage.core),),
+        (d.TangoUsage.year == year,
+         d.TangoUsage.month == month))
     result = []
-    for row in found:
-        item = build_dict(row, [
+    for key, sums in found.items():
+        item = build_dict(key, [
             'biller',
-            'managerunit'
+            'managerunit',
+            'unit_price'
         ])
-        core_count = row[2]
+        core_count = sums[0]
         item['core'] = core_count
-        item['cost'] = config.get('NECTAR_NOVA_VCPU_PRICE') * core_count
+        item['cost'] = calculate_cost(core_count, item['unit_price'])
         result.append(_clean_types(item))
     return result
 
 
-def get_nectar_chart(org_filter, month_window, config):
-    date_bounds = p.get_year_month_for_n_months_ago(month_window)
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.NectarUsage.year,
-            d.NectarUsage.month)
-    partial = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.NovaFlavor.vcpus)
-            )
-        ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
-        filter(
-            or_(d.NectarUsage.year > date_bounds['year'],
-                and_(
-                    d.NectarUsage.year == date_bounds['year'],
-                    d.NectarUsage.month > date_bounds['month']
-                )),
-            d.NectarUsage.flavor == d.NovaFlavor.openstack_id,
-            d.NectarUsage.tenant == d.Contract.openstack_project_id,
-            d.Contract.contract_type == p.CONTRACT_TYPE_NECTAR
-        ).\
-        group_by(*cols)
-    if org_filter:
-        partial = partial.filter(d.Account.biller == org_filter)
-    found = partial.all()
+def _live_tango_chart(org_filter, month_window, config):
+    found = _usage_by_contract(p.CONTRACT_TYPE_TANGO, d.TangoUsage.vm_id,
+        (d.TangoUsage.year, d.TangoUsage.month),
+        (func.sum(d.TangoUsage.core),),
+        (_since_month_window(d.TangoUsage, month_window),),
+        org_filter=org_filter)
     result = []
-    for row in found:
-        item = build_dict(row, [
+    for key, sums in found.items():
+        item = build_dict(key, [
             'biller',
             'managerunit',
+            'unit_price',
             'year',
             'month'
         ])
-        core_count = row[4]
+        core_count = sums[0]
         item['core'] = core_count
-        item['cost'] = config.get('NECTAR_NOVA_VCPU_PRICE') * core_count
-        item['service'] = 'NECTAR'
+        item['cost'] = calculate_cost(core_count, item['unit_price'])
+        item['service'] = 'Tango'
         result.append(_clean_types(item))
     return result
 
 
-def get_tango_simple(year, month, config):
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.Contract.unit_price)
+ROLLUP_KEY_FIELDS = ('biller', 'managerunit')
+ROLLUP_COLUMNS = ('unit_price', 'cores', 'cpu_seconds', 'job_count', 'cpu_hours',
+    'usage', 'blocks', 'core', 'cost', 'last_system')
+
+
+class RollupService(object):
+    """ describes how a service is stored in, and read back from, the
+        MonthlyRollup table """
+    def __init__(self, name, label, usage_models, live_simple, live_chart, fields,
+            rollup_simple=None):
+        self.name = name
+        self.label = label
+        self.usage_models = usage_models
+        self.live_simple = live_simple
+        self.live_chart = live_chart
+        # gives the records the rollup rows are built from, when they need
+        # more than the simple response has
+        self.rollup_simple = rollup_simple or live_simple
+        # (rollup column, response key) pairs
+        self.fields = fields
+
+
+ROLLUP_SERVICES = {x.name: x for x in [
+    RollupService(cache.SERVICE_HPCSUMMARY, 'HPC Compute', (d.HpcSummaryUsage,),
+        _live_hpcsummary_simple, _live_hpcsummary_chart,
+        (('unit_price', 'unit_price'), ('cores', 'cores'), ('cpu_seconds', 'cpu_seconds'),
+         ('job_count', 'job_count'), ('cpu_hours', 'cpu_hours'), ('cost', 'fee_dollars'))),
+    RollupService(cache.SERVICE_ALLOCATIONSUMMARY, 'National Storage',
+        (d.HnasVVUsage, d.HnasFSUsage, d.HcpUsage, d.XfsUsage),
+        _live_allocationsummary_simple, _live_allocationsummary_chart,
+        (('usage', 'usage'), ('blocks', 'blocks'), ('cost', 'cost')),
+        _allocationsummary_rollup_simple),
+    RollupService(cache.SERVICE_HPCSTORAGE, 'HPC Storage', (d.HpcHomeUsage,),
+        _live_hpcstorage_simple, _live_hpcstorage_chart,
+        (('usage', 'usage'), ('blocks', 'blocks'), ('cost', 'cost'))),
+    RollupService(cache.SERVICE_NECTAR, 'NECTAR', (d.NectarUsage,),
+        _live_nectar_simple, _live_nectar_chart,
+        (('core', 'core'), ('cost', 'cost'))),
+    RollupService(cache.SERVICE_TANGO, 'Tango', (d.TangoUsage,),
+        _live_tango_simple, _live_tango_chart,
+        (('unit_price', 'unit_price'), ('core', 'core'), ('cost', 'cost'))),
+]}
+
+
+def get_data_versions(names):
+    """ the DataVersion of each name, 0 for ones that have never changed """
+    found = db.session.query(d.DataVersion.name, d.DataVersion.version).\
+        filter(d.DataVersion.name.in_(names)).\
+        all()
+    result = {x: 0 for x in names}
+    result.update(dict(found))
+    return result
+
+
+def _rollups_are_current(service_name):
+    """ the rollup can be used when nothing for the service is marked stale """
+    is_stale = db.session.query(
+        d.RollupStale.query.filter(d.RollupStale.service == service_name).exists()
+    ).scalar()
+    return not is_stale
+
+
+def _rollup_rows_for(service, year, month, config):
+    """ computes the rollup rows for a service's month from the raw usage """
+    result = []
+    for curr in service.rollup_simple(year, month, config):
+        row = {x: None for x in ROLLUP_COLUMNS}
+        row.update({x: curr[x] for x in ROLLUP_KEY_FIELDS})
+        for column, key in service.fields:
+            row[column] = curr[key]
+        row['last_system'] = curr.get('last_system')
+        row.update({'service': service.name, 'year': year, 'month': month,
+            'period': month_period(year, month)})
+        result.append(row)
+    return result
+
+
+def _months_with_usage(service):
+    result = set()
+    for model in service.usage_models + (d.MonthlyRollup,):
+        found = db.session.query(model.year, model.month).distinct()
+        if model is d.MonthlyRollup:
+            found = found.filter(d.MonthlyRollup.service == service.name)
+        result.update((x[0], x[1]) for x in found.all())
+    return result
+
+
+def refresh_rollups(config):
+    """ recomputes the rollup for every service/month that ingestion has
+        marked stale. The stale markers we act on are removed in the same
+        transaction as the new rollup rows are written, so readers switch
+        from the raw usage to the rollup atomically. """
+    stale = d.RollupStale.query.all()
+    months_by_service = {}
+    for curr in stale:
+        months = months_by_service.setdefault(curr.service, set())
+        if curr.year is None:
+            months.update(_months_with_usage(ROLLUP_SERVICES[curr.service]))
+        else:
+            months.add((curr.year, curr.month))
+    try:
+        for service_name, months in months_by_service.items():
+            service = ROLLUP_SERVICES[service_name]
+            for year, month in sorted(months):
+                rows = _rollup_rows_for(service, year, month, config)
+                d.MonthlyRollup.query.filter(
+                    d.MonthlyRollup.service == service_name,
+                    d.MonthlyRollup.year == year,
+                    d.MonthlyRollup.month == month).delete()
+                d.bulk_insert(d.MonthlyRollup, rows)
+        stale_ids = [x.id for x in stale]
+        for i in range(0, len(stale_ids), p.DELETE_CHUNK_SIZE):
+            d.RollupStale.query.\
+                filter(d.RollupStale.id.in_(stale_ids[i:i + p.DELETE_CHUNK_SIZE])).\
+                delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return {k: ["{}-{}".format(*x) for x in sorted(v)] for k, v in months_by_service.items()}
+
+
+def _rollup_columns(service):
+    return [getattr(d.MonthlyRollup, x[0]) for x in service.fields]
+
+
+def _get_simple(service_name, year, month, config):
+    service = ROLLUP_SERVICES[service_name]
+    if not _rollups_are_current(service_name):
+        return service.live_simple(year, month, config)
     found = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.TangoUsage.core)
-            )
+            d.MonthlyRollup.biller,
+            d.MonthlyRollup.managerunit,
+            *_rollup_columns(service)
         ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
         filter(
-            d.TangoUsage.year == year,
-            d.TangoUsage.month == month,
-            d.TangoUsage.vm_id == d.Contract.openstack_project_id,
-            d.Contract.contract_type == p.CONTRACT_TYPE_TANGO
+            d.MonthlyRollup.service == service_name,
+            d.MonthlyRollup.year == year,
+            d.MonthlyRollup.month == month
         ).\
-        group_by(*cols).\
         all()
+    fields = list(ROLLUP_KEY_FIELDS) + [x[1] for x in service.fields]
+    return [_clean_types(build_dict(x, fields)) for x in found]
+
+
+def _rollup_chart_query(columns, service_names, org_filter, month_window):
+    partial = db.session.query(*columns).\
+        filter(
+            d.MonthlyRollup.service.in_(service_names),
+            _since_period_window(month_window)
+        ).\
+        order_by(d.MonthlyRollup.period)
+    if org_filter:
+        partial = partial.filter(d.MonthlyRollup.biller == org_filter)
+    return partial
+
+
+def _rollup_chart_records(service, rows):
+    """ rows are dicts of the rollup columns, with biller, managerunit, year
+        and month """
     result = []
-    for row in found:
-        item = build_dict(row, [
-            'biller',
-            'managerunit',
-            'unit_price'
-        ])
-        core_count = row[3]
-        item['core'] = core_count
-        item['cost'] = item['unit_price'] * core_count
+    for curr in rows:
+        item = {x: curr[x] for x in ROLLUP_KEY_FIELDS + ('year', 'month')}
+        item.update({x[0]: curr[x[0]] for x in service.fields})
+        item['service'] = service.label
         result.append(_clean_types(item))
     return result
 
 
-def get_tango_chart(org_filter, month_window, config):
-    date_bounds = p.get_year_month_for_n_months_ago(month_window)
-    cols = (d.Account.biller,
-            d.AccountContact.managerunit,
-            d.Contract.unit_price,
-            d.TangoUsage.year,
-            d.TangoUsage.month)
+def _get_chart(service_name, org_filter, month_window, config):
+    service = ROLLUP_SERVICES[service_name]
+    if not _rollups_are_current(service_name):
+        return service.live_chart(org_filter, month_window, config)
+    columns = [d.MonthlyRollup.biller, d.MonthlyRollup.managerunit, d.MonthlyRollup.year,
+        d.MonthlyRollup.month] + _rollup_columns(service)
+    fields = list(ROLLUP_KEY_FIELDS) + ['year', 'month'] + [x[0] for x in service.fields]
+    found = _rollup_chart_query(columns, [service_name], org_filter, month_window).all()
+    return _rollup_chart_records(service, [build_dict(x, fields) for x in found])
+
+
+def get_hpcsummary_simple(year, month, config):
+    return _get_simple(cache.SERVICE_HPCSUMMARY, year, month, config)
+
+
+def get_hpcsummary_chart(org_filter, month_window, config):
+    return _get_chart(cache.SERVICE_HPCSUMMARY, org_filter, month_window, config)
+
+
+def get_allocationsummary_simple(year, month, config):
+    return _get_simple(cache.SERVICE_ALLOCATIONSUMMARY, year, month, config)
+
+
+def get_allocationsummary_chart(org_filter, month_window, config):
+    """ like the live version, this totals the window per biller/managerunit
+        and labels it with the latest month of the last system used """
+    service = ROLLUP_SERVICES[cache.SERVICE_ALLOCATIONSUMMARY]
+    if not _rollups_are_current(service.name):
+        return service.live_chart(org_filter, month_window, config)
     partial = db.session.query(
-            *merge_cols(cols,
-                func.sum(d.TangoUsage.core)
-            )
+            d.MonthlyRollup.biller,
+            d.MonthlyRollup.managerunit,
+            func.sum(d.MonthlyRollup.usage),
+            cast(func.sum(d.MonthlyRollup.blocks), db.BigInteger),
+            func.sum(d.MonthlyRollup.cost),
+            func.max(func.coalesce(d.MonthlyRollup.last_system, 0) * SYSTEM_LABEL_FACTOR +
+                d.MonthlyRollup.year * 100 + d.MonthlyRollup.month)
         ).\
-        join(d.AccountContact).\
-        join(d.Contract).\
         filter(
-            or_(d.TangoUsage.year > date_bounds['year'],
-                and_(
-                    d.TangoUsage.year == date_bounds['year'],
-                    d.TangoUsage.month > date_bounds['month']
-                )),
-            d.TangoUsage.vm_id == d.Contract.openstack_project_id,
-            d.Contract.contract_type == p.CONTRACT_TYPE_TANGO
+            d.MonthlyRollup.service == service.name,
+            _since_period_window(month_window)
         ).\
-        group_by(*cols)
+        group_by(d.MonthlyRollup.biller, d.MonthlyRollup.managerunit)
     if org_filter:
-        partial = partial.filter(d.Account.biller == org_filter)
-    found = partial.all()
+        partial = partial.filter(d.MonthlyRollup.biller == org_filter)
+    return _storage_records(partial.all(), service.label)
+
+
+def get_hpcstorage_simple(year, month, config):
+    return _get_simple(cache.SERVICE_HPCSTORAGE, year, month, config)
+
+
+def get_hpcstorage_chart(org_filter, month_window, config):
+    return _get_chart(cache.SERVICE_HPCSTORAGE, org_filter, month_window, config)
+
+
+def get_nectar_simple(year, month, config):
+    return _get_simple(cache.SERVICE_NECTAR, year, month, config)
+
+
+def get_nectar_chart(org_filter, month_window, config):
+    return _get_chart(cache.SERVICE_NECTAR, org_filter, month_window, config)
+
+
+def get_tango_simple(year, month, config):
+    return _get_simple(cache.SERVICE_TANGO, year, month, config)
+
+
+def get_tango_chart(org_filter, month_window, config):
+    return _get_chart(cache.SERVICE_TANGO, org_filter, month_window, config)
+
+
+def _stale_services():
+    return {x[0] for x in db.session.query(d.RollupStale.service).distinct()}
+
+
+def _window_totals(rows):
+    """ totals the usage, blocks and cost of the rows per biller/managerunit,
+        in the same shape as _storage_totals with by_month """
+    totals = {}
+    for curr in rows:
+        key = (curr['biller'], curr['managerunit'])
+        sums = [curr['usage'], curr['blocks'], curr['cost'],
+            (curr['last_system'] or 0) * SYSTEM_LABEL_FACTOR + curr['year'] * 100 + curr['month']]
+        try:
+            found = totals[key]
+            totals[key] = [_add_sums(x, y) for x, y in zip(found[:3], sums)] + \
+                [max(found[3], sums[3])]
+        except KeyError:
+            totals[key] = sums
+    return [k + tuple(v) for k, v in totals.items()]
+
+
+def get_chart(org_filter, month_window, config):
+    """ the chart records of every service, one service after another, as
+        their own chart endpoints give them. The services with a current
+        rollup are all read with one query; any that are stale are computed
+        live. """
+    stale = _stale_services()
+    current = [x for x in ROLLUP_SERVICES.values() if x.name not in stale]
+    rows_by_service = {x.name: [] for x in current}
+    if current:
+        columns = [d.MonthlyRollup.service, d.MonthlyRollup.biller,
+            d.MonthlyRollup.managerunit, d.MonthlyRollup.year, d.MonthlyRollup.month] + \
+            [getattr(d.MonthlyRollup, x) for x in ROLLUP_COLUMNS]
+        fields = ['service'] + list(ROLLUP_KEY_FIELDS) + ['year', 'month'] + list(ROLLUP_COLUMNS)
+        found = _rollup_chart_query(columns, list(rows_by_service), org_filter, month_window)
+        for curr in found.all():
+            rows_by_service[curr[0]].append(build_dict(curr, fields))
     result = []
-    for row in found:
-        item = build_dict(row, [
-            'biller',
-            'managerunit',
-            'unit_price',
-            'year',
-            'month'
-        ])
-        item['unit_price'] = item['unit_price']
-        core_count = row[5]
-        item['core'] = core_count
-        item['cost'] = item['unit_price'] * core_count
-        item['service'] = 'Tango'
-        result.append(_clean_types(item))
+    for service in ROLLUP_SERVICES.values():
+        if service.name in stale:
+            result.extend(service.live_chart(org_filter, month_window, config))
+        elif service.name == cache.SERVICE_ALLOCATIONSUMMARY:
+            totals = _window_totals(rows_by_service[service.name])
+            result.extend(_storage_records(totals, service.label))
+        else:
+            result.extend(_rollup_chart_records(service, rows_by_service[service.name]))
     return result
 
 
+def _summarise_by_biller(costs):
+    """ turns (biller, service, cost) tuples into one record per biller """
+    by_biller = {}
+    for biller, service_name, cost in costs:
+        try:
+            record = by_biller[biller]
+        except KeyError:
+            record = {x: 0 for x in cache.ALL_SERVICES}
+            record['biller'] = biller
+            by_biller[biller] = record
+        record[service_name] += cost
+    result = []
+    for biller in sorted(by_biller, key=lambda x: (x is None, x)):
+        record = by_biller[biller]
+        record['total'] = sum(record[x] for x in cache.ALL_SERVICES)
+        result.append(_clean_types(record))
+    return result
+
+
+def _live_summary_costs(year, month, config):
+    for service_name in cache.ALL_SERVICES:
+        service = ROLLUP_SERVICES[service_name]
+        cost_key = dict(service.fields)['cost']
+        for curr in service.live_simple(year, month, config):
+            yield curr['biller'], service_name, curr[cost_key]
+
+
+def get_summary(year, month, config):
+    """ the cost of every service for the month, per biller. The rollup has
+        already resolved the contracts so this is a single grouped query.
+        While any service's rollup is stale we fall back to the live queries
+        so the totals always agree with the /<service>/simple endpoints. """
+    is_stale = db.session.query(d.RollupStale.query.exists()).scalar()
+    if is_stale:
+        return _summarise_by_biller(_live_summary_costs(year, month, config))
+    found = db.session.query(
+            d.MonthlyRollup.biller,
+            d.MonthlyRollup.service,
+            func.sum(d.MonthlyRollup.cost)
+        ).\
+        filter(
+            d.MonthlyRollup.year == year,
+            d.MonthlyRollup.month == month
+        ).\
+        group_by(d.MonthlyRollup.biller, d.MonthlyRollup.service).\
+        all()
+    return _summarise_by_biller(found)
+
+
 def _now_in_ms():
     return int(round(time.time() * 1000.0))
 
@@ -732,29 +873,157 @@ def _now_provider():
     return pendulum.now()
 
 
-def process(months_back, config):
-    """ pull all the latest data and persist it """
+def _build_contract_tasks():
+    """ the CRM/contract pulls, which aren't tied to a month """
+    return [
+        ('ersaaccount', p.process_ersaaccount, ()),
+        ('attachedstorage', p.process_attachedstorage, ()),
+        ('attachedstoragebackup', p.process_attachedstoragebackup, ()),
+        ('nova_flavor', p.process_nova_flavor, ()),
+        ('nectar_contract', p.process_nectar_contract, ()),
+        ('tango_contract', p.process_tango_contract, ()),
+    ]
+
+
+MONTH_SERVICES = ('hpcsummary', 'allocationsummary', 'hpcstorage', 'nectar', 'tango')
+
+
+def _build_month_tasks(months, service_names=MONTH_SERVICES):
+    """ a task for each of the services (each has a processors.process_<name>)
+        for each (year, month) """
+    result = []
+    for curr in months:
+        year = curr[0]
+        month = curr[1]
+        suffix = ' {}-{}'.format(year, month)
+        for name in MONTH_SERVICES:
+            if name in service_names:
+                result.append((name + suffix, getattr(p, 'process_' + name), (year, month)))
+    return result
+
+
+def _build_tasks(months):
+    """ builds the list of (name, processor function, args) that make up a
+        full harvest. The contract pulls don't depend on each other or on
+        the usage data so every task is independent and can run in any
+        order. """
+    return _build_contract_tasks() + _build_month_tasks(months)
+
+
+TASK_PENDING = 'pending'
+TASK_RUNNING = 'running'
+TASK_DONE = 'done'
+# what a processor can report, a task whose processor returns anything else is TASK_DONE
+PROCESSOR_STATUSES = (p.STATUS_REWRITTEN, p.STATUS_SKIPPED, p.STATUS_NO_DATA)
+TASK_FAILED = 'failed'
+
+
+def _ignore_progress(name, status):
+    pass
+
+
+def _run_task(task, config, progress=_ignore_progress):
+    """ runs the task, reporting its status, elapsed time and the time,
+        records and bytes of each stage (fetch, decode, delete, insert,
+        swap, commit) of each upstream endpoint/table it touched """
+    name, fn, args = task
+    start_ms = _now_in_ms()
+    progress(name, TASK_RUNNING)
+    with metrics.recording() as recorder:
+        try:
+            status = fn(*(args + (config,)))
+        except Exception:
+            progress(name, TASK_FAILED)
+            raise
+    if status not in PROCESSOR_STATUSES:
+        status = TASK_DONE
+    progress(name, status)
+    return {
+        'name': name,
+        'status': status,
+        'elapsed_ms': _now_in_ms() - start_ms,
+        'stages': recorder.to_list()
+    }
+
+
+def _run_tasks_serially(tasks, config, progress=_ignore_progress):
+    return [_run_task(x, config, progress) for x in tasks]
+
+
+def _run_tasks_concurrently(tasks, config, workers, progress=_ignore_progress):
+    """ runs the tasks on a thread pool. Each worker pushes its own app
+        context so it gets its own scoped DB session, meaning every
+        processor still commits its table(s) in its own transaction. """
+    app = current_app._get_current_object()
+    def run_in_context(task):
+        with app.app_context():
+            return _run_task(task, config, progress)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_in_context, x) for x in tasks]
+        try:
+            return [x.result() for x in futures]
+        except Exception:
+            for curr in futures:
+                curr.cancel()
+            raise
+
+
+def _run_tasks(tasks, config, progress=_ignore_progress):
+    for curr in tasks:
+        progress(curr[0], TASK_PENDING)
+    workers = config.get('PROCESS_WORKERS') or 1
+    if workers > 1:
+        logger.debug('Running %d tasks with %d workers' % (len(tasks), workers))
+        return _run_tasks_concurrently(tasks, config, workers, progress)
+    return _run_tasks_serially(tasks, config, progress)
+
+
+def _tables_with_deletes(timings):
+    """ the tables that tasks deleted rows from, per their stages """
+    result = set()
+    for task in timings:
+        for curr in task['stages']:
+            is_table = curr['source'] in db.metadata.tables
+            if is_table and curr['stage'] == metrics.STAGE_DELETE and curr['records']:
+                result.add(curr['source'])
+    return sorted(result)
+
+
+def _vacuum_after(timings, config):
+    """ reclaims the space of the rows replaced by the tasks in one pass per
+        table. Failing here doesn't fail the ingestion, its data is already
+        committed. """
+    if not config.get('VACUUM_AFTER_INGEST'):
+        return []
+    tables = _tables_with_deletes(timings)
+    try:
+        return d.vacuum(tables)
+    except Exception:
+        logger.exception('Could not VACUUM %s' % tables)
+        return []
+
+
+def run_tasks(tasks, config, progress=None):
+    """ runs the supplied (name, processor function, args) tasks then
+        refreshes the rollups they made stale. progress, if supplied, is
+        called with (task name, status) as each task moves through pending,
+        running and then done (or its processor's status) or failed. """
+    progress = progress or _ignore_progress
     start_ms = _now_in_ms()
-    logger.info('Processing for %d months back' % months_back)
     try:
-        p.process_ersaaccount(config)
-        p.process_attachedstorage(config)
-        p.process_attachedstoragebackup(config)
-        p.process_nova_flavor(config)
-        p.process_nectar_contract(config)
-        p.process_tango_contract(config)
-        months = _get_months_to_process(months_back, _now_provider())
-        for curr in months:
-            year = curr[0]
-            month = curr[1]
-            p.process_hpcsummary(year, month, config)
-            p.process_allocationsummary(year, month, config)
-            p.process_hpcstorage(year, month, config)
-            p.process_nectar(year, month, config)
-            p.process_tango(year, month, config)
+        timings = _run_tasks(tasks, config, progress)
+        rollups_refreshed = refresh_rollups(config)
+        tables_vacuumed = _vacuum_after(timings, config)
+        month_tasks = {x[0] for x in tasks if x[2]}
+        def names_with(status):
+            return [x['name'] for x in timings if x['status'] == status and x['name'] in month_tasks]
         return {
             'success': True,
-            'months_processed': ["{}-{}".format(x[0], x[1]) for x in months],
+            'months_rewritten': names_with(p.STATUS_REWRITTEN),
+            'months_skipped': names_with(p.STATUS_SKIPPED),
+            'rollups_refreshed': rollups_refreshed,
+            'tables_vacuumed': tables_vacuumed,
+            'timings': timings,
             'elapsed_ms': _now_in_ms() - start_ms
         }
     except p.ProcessingFailedError as e:
@@ -763,3 +1032,13 @@ def process(months_back, config):
             'message': str(e),
             'elapsed_ms': _now_in_ms() - start_ms
         }
+
+
+def process(months_back, config, progress=None):
+    """ pull all the latest data and persist it, see run_tasks for progress """
+    logger.info('Processing for %d months back' % months_back)
+    months = _get_months_to_process(months_back, _now_provider())
+    result = run_tasks(_build_tasks(months), config, progress)
+    if result['success']:
+        result['months_processed'] = ["{}-{}".format(x[0], x[1]) for x in months]
+    return result
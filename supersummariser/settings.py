@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Application configuration."""
 import os
+import tempfile
 
 from flask_env import MetaFlaskEnv
 
@@ -19,6 +20,33 @@ class Config(metaclass=MetaFlaskEnv):
     AUTH_HEADER_KEY = 'x-ersa-auth-token'
     SSL_VERIFY = True
     REMOTE_SERVER_CONNECT_TIMEOUT_SECS = 10
+    HTTP_POOL_MAXSIZE = 10 # pooled keep-alive connections per upstream host
+    HTTP_MAX_RETRIES = 3 # for 5xx responses and read timeouts
+    HTTP_RETRY_BACKOFF_SECS = 0.5 # exponential backoff factor between retries
+    STREAM_JSON = True # parse usage payloads incrementally rather than all at once
+    INGEST_BATCH_SIZE = 1000 # records written to the DB per flush during ingestion
+    STAGED_MONTH_SWAP = True # on partitioned tables, load each month into a new table then swap it in for the month's partition
+    VACUUM_AFTER_INGEST = True # on PostgreSQL, VACUUM ANALYZE the usage tables that had months replaced
+    SKIP_UNCHANGED_PAYLOADS = True # don't rewrite a month when the upstream payload hasn't changed
+    SPOOL_MAX_MEMORY_BYTES = 8 * 1024 * 1024 # payloads bigger than this are spooled to disk while hashing
+    PROCESS_WORKERS = 1 # >1 fetches the upstream endpoints concurrently during /process
+    TRANSFORM_PROCESSES = 0 # >0 decodes payloads and builds their rows in this many worker processes
+    RESPONSE_CACHE_SIZE = 512 # max number of read endpoint responses to cache, 0 to disable
+    RESPONSE_CACHE_TTL_SECS = 300 # catches ingestion that happened in another worker process
+    PROCESS_JOB_HISTORY = 20 # finished /process jobs to keep for status polling
+    SCHEDULE_CURRENT_MONTH_SECS = 60 * 60 # how often `flask scheduler` ingests the current month
+    SCHEDULE_CONTRACTS_SECS = 24 * 60 * 60 # how often it pulls the CRM contracts
+    SCHEDULE_HISTORICAL_SECS = 7 * 24 * 60 * 60 # how often it re-ingests the months before the current one
+    SCHEDULE_HISTORICAL_MONTHS = 3 # months back, including the current one, that count as historical
+    SCHEDULE_JITTER_SECS = 5 * 60 # random delay added to each run so schedulers don't line up
+    SCHEDULE_LOCK_FILE = os.path.join(tempfile.gettempdir(), 'supersummariser-ingest.lock') # held while ingesting
+    STREAM_RESPONSE_MIN_RECORDS = 5000 # uncached read responses with this many records are streamed, 0 to never stream
+    DATA_VERSION_ETAGS = True # build read response ETags from the data versions, so a 304 doesn't run the query
+    COMPRESS_MIN_BYTES = 1024 # smaller read responses aren't compressed
+    COMPRESS_LEVEL = 6 # gzip level (brotli quality) for read responses, 0 to not compress
+    PROFILE_TOKEN = None # set to allow profiling a read request by sending this value in PROFILE_HEADER
+    PROFILE_HEADER = 'X-Supersummariser-Profile'
+    PROFILE_SLOW_QUERY_MS = 200 # while profiling, queries slower than this are logged (with their plan on PostgreSQL)
 
     APP_DIR = os.path.abspath(os.path.dirname(__file__))  # This directory
     PROJECT_ROOT = os.path.abspath(os.path.join(APP_DIR, os.pardir))
@@ -4,6 +4,8 @@
 import pytest
 
 from supersummariser.app import create_app
+from supersummariser.cache import response_cache
+from supersummariser.contract_index import contract_index
 from supersummariser.database import db as _db
 from supersummariser.settings import TestConfig
 
@@ -24,6 +26,8 @@ def app():
 def db(app):
     """A database for the tests."""
     _db.app = app
+    contract_index.invalidate()
+    response_cache.clear()
     with app.app_context():
         _db.create_all()
 
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 """Test app"""
+import gzip
+import socket
+import subprocess
+import threading
 import unittest
 
 from flask import Flask
 from flask.json import loads
 
 import supersummariser.app as object_under_test
+from supersummariser.database import ProcessJob
 
 
 def test_add_routes01():
@@ -17,9 +22,12 @@ def test_add_routes01():
     result.index('/hpcsummary/rollup/<int:year>/<int:month>')
     result.index('/hpcsummary/detailed/<int:year>/<int:month>')
     result.index('/hpcsummary/chart')
+    result.index('/chart')
     result.index('/allocationsummary/simple/<int:year>/<int:month>')
     result.index('/hpcstorage/simple/<int:year>/<int:month>')
     result.index('/process')
+    result.index('/process/<job_id>')
+    result.index('/metrics')
 
 
 class ServicesTestCase(unittest.TestCase):
@@ -30,21 +38,280 @@ class ServicesTestCase(unittest.TestCase):
         object_under_test.add_routes(app)
         self.app = app.test_client()
 
-    def test_process01(self):
-        """ can we process for the default number of months? """
-        def stub_process(months_back, config):
-            assert months_back == 2
-            return {'success': True}
-        object_under_test.services.process = stub_process
-        result = self.app.get('/process')
-        assert loads(result.data)['success'] == True
-
-
-    def test_process02(self):
-        """ can we process for a custom number of months? """
-        def stub_process(months_back, config):
-            assert months_back == 3
-            return {'success': True}
-        object_under_test.services.process = stub_process
-        result = self.app.get('/process?months_back=3')
-        assert loads(result.data)['success'] == True
+    def tearDown(self):
+        object_under_test.cache.response_cache.configure(0, None)
+
+
+    def test_get_tango_simple01(self):
+        """ do we serve repeat requests from the cache and honour ETags? """
+        calls = []
+        def stub_get_tango_simple(year, month, config):
+            calls.append((year, month))
+            return [{'biller': 'Uni A', 'cost': 1.5}]
+        orig = object_under_test.services.get_tango_simple
+        object_under_test.services.get_tango_simple = stub_get_tango_simple
+        object_under_test.cache.response_cache.configure(10, None)
+        try:
+            first = self.app.get('/tango/simple/2018/3')
+            second = self.app.get('/tango/simple/2018/3')
+            not_modified = self.app.get('/tango/simple/2018/3',
+                headers={'If-None-Match': first.headers['ETag']})
+            object_under_test.cache.response_cache.invalidate('tango', 2018, 3)
+            third = self.app.get('/tango/simple/2018/3')
+        finally:
+            object_under_test.services.get_tango_simple = orig
+        assert loads(first.data)[0]['biller'] == 'Uni A'
+        assert second.data == first.data
+        assert not_modified.status_code == 304
+        assert third.status_code == 200
+        assert len(calls) == 2
+
+
+    def test_get_tango_chart01(self):
+        """ can we get the chart as parallel arrays? """
+        def stub_get_tango_chart(org_filter, month_window, config):
+            return [{'biller': 'Uni A', 'cost': 1.5}, {'biller': 'Uni B', 'cost': 2}]
+        orig = object_under_test.services.get_tango_chart
+        object_under_test.services.get_tango_chart = stub_get_tango_chart
+        try:
+            result = self.app.get('/tango/chart?format=columnar')
+            bad_format = self.app.get('/tango/chart?format=csv')
+        finally:
+            object_under_test.services.get_tango_chart = orig
+        assert loads(result.data) == {
+            'count': 2,
+            'columns': {'biller': ['Uni A', 'Uni B'], 'cost': [1.5, 2]}
+        }
+        assert bad_format.status_code == 400
+
+
+def _wait_for(client, job_id):
+    object_under_test.jobs.job_queue.wait(job_id, 5)
+    return loads(client.get('/process/' + job_id).data)
+
+
+def test_process01(app, db, monkeypatch):
+    """ can we process for the default number of months? """
+    def stub_process(months_back, config, progress=None):
+        assert months_back == 2
+        progress('hpcsummary 2018-3', 'rewritten')
+        return {'success': True}
+    monkeypatch.setattr(object_under_test.services, 'process', stub_process)
+    client = app.test_client()
+    result = client.get('/process')
+    assert result.status_code == 202
+    job_id = loads(result.data)['job_id']
+    assert result.headers['Location'].endswith('/process/' + job_id)
+    status = _wait_for(client, job_id)
+    assert status['state'] == 'succeeded'
+    assert status['result']['success'] == True
+    assert status['tasks'] == [{'name': 'hpcsummary 2018-3', 'status': 'rewritten'}]
+
+
+def test_process02(app, db, monkeypatch):
+    """ can we process for a custom number of months? """
+    def stub_process(months_back, config, progress=None):
+        assert months_back == 3
+        return {'success': False, 'message': 'nectar is down'}
+    monkeypatch.setattr(object_under_test.services, 'process', stub_process)
+    client = app.test_client()
+    result = client.get('/process?months_back=3')
+    status = _wait_for(client, loads(result.data)['job_id'])
+    assert status['state'] == 'failed'
+    assert status['message'] == 'nectar is down'
+
+
+def test_process03(app, db, monkeypatch):
+    """ do we coalesce a duplicate submission into the running job? """
+    release = threading.Event()
+    calls = []
+    def stub_process(months_back, config, progress=None):
+        calls.append(months_back)
+        release.wait(5)
+        return {'success': True}
+    monkeypatch.setattr(object_under_test.services, 'process', stub_process)
+    client = app.test_client()
+    first = loads(client.get('/process').data)
+    second = loads(client.get('/process').data)
+    release.set()
+    assert second['job_id'] == first['job_id']
+    assert second['coalesced'] == True
+    _wait_for(client, first['job_id'])
+    assert calls == [2]
+
+
+def _add_job(db, owner, months_back=2):
+    db.session.add(ProcessJob(job_id='other', months_back=months_back, active=months_back,
+        state='running', owner=owner, submitted=1, tasks='[]'))
+    db.session.commit()
+
+
+def test_process04(app, db, monkeypatch):
+    """ do we coalesce into, and report on, a job that another process is running? """
+    calls = []
+    monkeypatch.setattr(object_under_test.services, 'process',
+        lambda months_back, config, progress=None: calls.append(months_back))
+    _add_job(db, 'otherhost:1')
+    client = app.test_client()
+    result = loads(client.get('/process').data)
+    assert result['job_id'] == 'other'
+    assert result['coalesced'] == True
+    assert loads(client.get('/process/other').data)['state'] == 'running'
+    assert calls == []
+
+
+def test_process05(app, db, monkeypatch):
+    """ do we fail a job whose process has gone, rather than coalesce into it forever? """
+    monkeypatch.setattr(object_under_test.services, 'process',
+        lambda months_back, config, progress=None: {'success': True})
+    gone = subprocess.Popen(['true'])
+    gone.wait()
+    _add_job(db, '%s:%d' % (socket.gethostname(), gone.pid))
+    client = app.test_client()
+    result = loads(client.get('/process').data)
+    assert result['job_id'] != 'other'
+    assert result['coalesced'] == False
+    assert _wait_for(client, result['job_id'])['state'] == 'succeeded'
+    abandoned = loads(client.get('/process/other').data)
+    assert abandoned['state'] == 'failed'
+    assert abandoned['message'].startswith('abandoned')
+
+
+def test_get_process_status01(app, db):
+    """ do we 404 for a job we don't know about? """
+    result = app.test_client().get('/process/not-a-job')
+    assert result.status_code == 404
+
+
+def test_get_tango_chart02(app, db, monkeypatch):
+    """ do we stream big responses, with the data version ETag, then serve
+        them from the cache? """
+    monkeypatch.setitem(app.config, 'STREAM_RESPONSE_MIN_RECORDS', 2)
+    monkeypatch.setattr(object_under_test.encoding, 'STREAM_CHUNK_RECORDS', 1)
+    calls = []
+    def stub_get_tango_chart(org_filter, month_window, config):
+        calls.append(month_window)
+        return [{'biller': 'Uni A', 'cost': 1.5}, {'biller': 'Uni B', 'cost': 2}]
+    monkeypatch.setattr(object_under_test.services, 'get_tango_chart', stub_get_tango_chart)
+    object_under_test.cache.response_cache.configure(10, None)
+    try:
+        client = app.test_client()
+        first = client.get('/tango/chart')
+        assert first.is_streamed
+        first_data = first.data # the response is cached once it's been read
+        second = client.get('/tango/chart')
+    finally:
+        object_under_test.cache.response_cache.configure(0, None)
+    assert loads(first_data) == [{'biller': 'Uni A', 'cost': 1.5}, {'biller': 'Uni B', 'cost': 2}]
+    assert second.data == first_data
+    assert second.headers['ETag'] == first.headers['ETag']
+    assert len(calls) == 1
+
+
+def _stub_tango_chart(monkeypatch, records):
+    calls = []
+    def stub_get_tango_chart(org_filter, month_window, config):
+        calls.append(month_window)
+        return records
+    monkeypatch.setattr(object_under_test.services, 'get_tango_chart', stub_get_tango_chart)
+    return calls
+
+
+def test_get_tango_chart03(app, db, monkeypatch):
+    """ do we 304 from the data versions, without computing, until the data changes? """
+    calls = _stub_tango_chart(monkeypatch, [{'biller': 'Uni A', 'cost': 1.5}])
+    client = app.test_client()
+    first = client.get('/tango/chart')
+    etag = first.headers['ETag']
+    not_modified = client.get('/tango/chart', headers={'If-None-Match': etag})
+    now = object_under_test.services._now_provider()
+    object_under_test.processors._bump_version(
+        object_under_test.processors.usage_version_name('tango', now.year, now.month))
+    db.session.commit()
+    changed = client.get('/tango/chart', headers={'If-None-Match': etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers['ETag'] == etag
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert len(calls) == 2
+
+
+def test_get_tango_chart04(app, db, monkeypatch):
+    """ do we gzip big responses, and only those, when the client accepts it? """
+    monkeypatch.setitem(app.config, 'COMPRESS_MIN_BYTES', 100)
+    records = [{'biller': 'Uni %d' % i, 'cost': i} for i in range(50)]
+    _stub_tango_chart(monkeypatch, records)
+    client = app.test_client()
+    plain = client.get('/tango/chart')
+    compressed = client.get('/tango/chart', headers={'Accept-Encoding': 'gzip'})
+    not_modified = client.get('/tango/chart', headers={'Accept-Encoding': 'gzip',
+        'If-None-Match': compressed.headers['ETag']})
+    assert 'Content-Encoding' not in plain.headers
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert compressed.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(compressed.data) == plain.data
+    assert compressed.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+    monkeypatch.setitem(app.config, 'COMPRESS_MIN_BYTES', 10 ** 6)
+    uncompressed = client.get('/tango/chart?month_window=2', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in uncompressed.headers
+    assert not_modified.status_code == 304
+
+
+def test_get_tango_chart05(app, db, monkeypatch):
+    """ do we gzip streamed responses as they go? """
+    monkeypatch.setitem(app.config, 'STREAM_RESPONSE_MIN_RECORDS', 2)
+    monkeypatch.setattr(object_under_test.encoding, 'STREAM_CHUNK_RECORDS', 1)
+    records = [{'biller': 'Uni %d' % i, 'cost': i} for i in range(5)]
+    _stub_tango_chart(monkeypatch, records)
+    result = app.test_client().get('/tango/chart', headers={'Accept-Encoding': 'gzip'})
+    assert result.headers['Content-Encoding'] == 'gzip'
+    assert loads(gzip.decompress(result.data)) == records
+
+
+def test_get_metrics01(app, db):
+    """ do we expose the request latencies in the Prometheus format? """
+    client = app.test_client()
+    client.get('/process/not-a-job')
+    result = client.get('/metrics')
+    assert result.content_type.startswith('text/plain')
+    text = result.data.decode('utf-8')
+    assert '# TYPE supersummariser_http_request_duration_seconds histogram' in text
+    assert 'supersummariser_http_request_duration_seconds_count{method="GET",route="/process/<job_id>",status="404"}' in text
+    assert '# TYPE supersummariser_ingest_stage_seconds histogram' in text
+
+
+def test_get_tango_chart06(app, db, monkeypatch):
+    """ do we profile, bypassing the cache, only with the right token? """
+    calls = _stub_tango_chart(monkeypatch, [{'biller': 'Uni A', 'cost': 1.5}])
+    client = app.test_client()
+    header = app.config['PROFILE_HEADER']
+    not_enabled = client.get('/tango/chart', headers={header: 'secret'})
+    monkeypatch.setitem(app.config, 'PROFILE_TOKEN', 'secret')
+    wrong_token = client.get('/tango/chart', headers={header: 'guess'})
+    profiled = client.get('/tango/chart', headers={header: 'secret'})
+    assert 'Server-Timing' not in not_enabled.headers
+    assert 'Server-Timing' not in wrong_token.headers
+    assert 'db;dur=' in profiled.headers['Server-Timing']
+    assert loads(profiled.data) == [{'biller': 'Uni A', 'cost': 1.5}]
+    assert len(calls) == 2 # the profiled request didn't come from the cache
+
+
+def test_get_chart01(app, db, monkeypatch):
+    """ does a change to any service's usage change the all service chart's ETag? """
+    calls = []
+    def stub_get_chart(org_filter, month_window, config):
+        calls.append((org_filter, month_window))
+        return [{'biller': 'Uni A', 'cost': 1.5, 'service': 'Tango'}]
+    monkeypatch.setattr(object_under_test.services, 'get_chart', stub_get_chart)
+    client = app.test_client()
+    first = client.get('/chart?org=Uni%20A&month_window=3')
+    etag = first.headers['ETag']
+    now = object_under_test.services._now_provider()
+    object_under_test.processors._bump_version(
+        object_under_test.processors.usage_version_name('nectar', now.year, now.month))
+    db.session.commit()
+    changed = client.get('/chart?org=Uni%20A&month_window=3', headers={'If-None-Match': etag})
+    assert loads(first.data) == [{'biller': 'Uni A', 'cost': 1.5, 'service': 'Tango'}]
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+    assert calls == [('Uni A', 3), ('Uni A', 3)]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""Test backfill"""
+import supersummariser.backfill as object_under_test
+from supersummariser.database import BackfillCheckpoint
+from supersummariser.processors import ProcessingFailedError, STATUS_REWRITTEN, STATUS_SKIPPED
+
+
+def test_months_between01():
+    """ can we list the months across a year boundary, including both ends? """
+    result = object_under_test.months_between((2017, 11), (2018, 2))
+    assert result == [(2017, 11), (2017, 12), (2018, 1), (2018, 2)]
+
+
+def test_months_between02():
+    """ do we get nothing when the range is backwards? """
+    assert object_under_test.months_between((2018, 2), (2017, 11)) == []
+
+
+class FakeProcessors(object):
+    """ records the tasks that ran, failing those named in fail with error.
+        Like the contract tasks used to, the tasks without a month don't
+        return a status. """
+    ProcessingFailedError = ProcessingFailedError
+    STATUS_REWRITTEN = STATUS_REWRITTEN
+    STATUS_SKIPPED = STATUS_SKIPPED
+
+    def __init__(self, fail=(), error=ProcessingFailedError):
+        self.fail = fail
+        self.error = error
+        self.ran = []
+
+    def __getattr__(self, name):
+        service = name[len('process_'):]
+        def process(*args):
+            is_month = len(args) > 1
+            task = '%s %d-%d' % ((service,) + args[:2]) if is_month else service
+            if task in self.fail:
+                raise self.error('%s is down' % task)
+            self.ran.append(task)
+            return STATUS_REWRITTEN if is_month else 1
+        return process
+
+
+def test_run01(db, monkeypatch):
+    """ do we resume after a failure without rerunning the finished tasks? """
+    monkeypatch.setattr(object_under_test.services, 'refresh_rollups', lambda c: {})
+    config = {}
+    failing = FakeProcessors(fail=('tango 2018-2',))
+    monkeypatch.setattr(object_under_test.services, 'p', failing)
+    result = object_under_test.run((2017, 12), (2018, 3), config, ('hpcsummary', 'tango'),
+        chunk_months=2)
+    assert result == {'success': False, 'message': 'tango 2018-2 is down', 'tasks_run': 4,
+        'tasks_resumed': 0}
+    assert 'hpcsummary 2018-2' in failing.ran
+    assert BackfillCheckpoint.query.count() == 5
+    working = FakeProcessors()
+    monkeypatch.setattr(object_under_test.services, 'p', working)
+    result = object_under_test.run((2017, 12), (2018, 3), config, ('hpcsummary', 'tango'),
+        chunk_months=2)
+    assert result == {'success': True, 'tasks_run': 3, 'tasks_resumed': 5}
+    assert working.ran == ['tango 2018-2', 'hpcsummary 2018-3', 'tango 2018-3']
+    assert BackfillCheckpoint.query.count() == 0
+
+
+def test_run02(db, monkeypatch):
+    """ do we start over when asked to restart? """
+    monkeypatch.setattr(object_under_test.services, 'refresh_rollups', lambda c: {})
+    name = object_under_test.checkpoint_name((2018, 1), (2018, 1), ('nectar',), False)
+    db.session.add(BackfillCheckpoint(backfill=name, task='nectar 2018-1', status='rewritten'))
+    db.session.commit()
+    processors = FakeProcessors()
+    monkeypatch.setattr(object_under_test.services, 'p', processors)
+    result = object_under_test.run((2018, 1), (2018, 1), {}, ('nectar',), restart=True)
+    assert result['tasks_run'] == 1
+    assert processors.ran == ['nectar 2018-1']
+
+
+def test_run03(db, monkeypatch):
+    """ do we checkpoint the contract tasks, and fail with a message whatever
+        error a task raises? """
+    monkeypatch.setattr(object_under_test.services, 'refresh_rollups', lambda c: {})
+    crashing = FakeProcessors(fail=('nectar 2018-1',), error=KeyError)
+    monkeypatch.setattr(object_under_test.services, 'p', crashing)
+    result = object_under_test.run((2018, 1), (2018, 1), {}, ('nectar',), contracts=True)
+    assert result['success'] == False
+    assert result['message'].startswith('nectar 2018-1 failed: ')
+    assert BackfillCheckpoint.query.count() == 6
+    working = FakeProcessors()
+    monkeypatch.setattr(object_under_test.services, 'p', working)
+    result = object_under_test.run((2018, 1), (2018, 1), {}, ('nectar',), contracts=True)
+    assert result == {'success': True, 'tasks_run': 1, 'tasks_resumed': 6}
+    assert working.ran == ['nectar 2018-1']
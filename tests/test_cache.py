@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Test the response cache"""
+import supersummariser.cache as object_under_test
+
+
+def test_get01():
+    """ can we get back what we put in? """
+    cache = object_under_test.ResponseCache(max_size=2)
+    cache.put('a', b'[1]', ['tango'], [(2018, 3)])
+    result = cache.get('a')
+    assert result.body == b'[1]'
+    assert result.etag
+
+
+def test_put01():
+    """ do we evict the least recently used entry when we're full? """
+    cache = object_under_test.ResponseCache(max_size=2)
+    cache.put('a', b'a', ['tango'], [])
+    cache.put('b', b'b', ['tango'], [])
+    cache.get('a')
+    cache.put('c', b'c', ['tango'], [])
+    assert cache.get('b') is None
+    assert cache.get('a').body == b'a'
+    assert cache.get('c').body == b'c'
+
+
+def test_put02():
+    """ do we store nothing when the cache is disabled? """
+    cache = object_under_test.ResponseCache(max_size=0)
+    result = cache.put('a', b'a', ['tango'], [])
+    assert result.body == b'a'
+    assert cache.get('a') is None
+
+
+def test_invalidate01():
+    """ do we only drop entries for the service and month that changed? """
+    cache = object_under_test.ResponseCache(max_size=10)
+    cache.put('tango-march', b'', ['tango'], [(2018, 3)])
+    cache.put('tango-chart', b'', ['tango'], [(2018, 2), (2018, 3)])
+    cache.put('tango-april', b'', ['tango'], [(2018, 4)])
+    cache.put('nectar-march', b'', ['nectar'], [(2018, 3)])
+    cache.invalidate('tango', 2018, 3)
+    assert cache.get('tango-march') is None
+    assert cache.get('tango-chart') is None
+    assert cache.get('tango-april') is not None
+    assert cache.get('nectar-march') is not None
+
+
+def test_invalidate02():
+    """ can we drop every entry for a service? """
+    cache = object_under_test.ResponseCache(max_size=10)
+    cache.put('tango-march', b'', ['tango'], [(2018, 3)])
+    cache.put('nectar-march', b'', ['nectar'], [(2018, 3)])
+    cache.invalidate('tango')
+    assert cache.get('tango-march') is None
+    assert len(cache) == 1
+
+
+def test_invalidate03():
+    """ do we drop an entry built from several services when any changes? """
+    cache = object_under_test.ResponseCache(max_size=10)
+    cache.put('summary', b'', ['tango', 'nectar'], [(2018, 3)])
+    cache.invalidate('nectar', 2018, 3)
+    assert cache.get('summary') is None
+
+
+def test_get02():
+    """ do entries expire after the TTL? """
+    cache = object_under_test.ResponseCache(max_size=10, ttl_secs=60)
+    entry = cache.put('a', b'a', ['tango'], [])
+    entry.created -= 61
+    assert cache.get('a') is None
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Test contract index"""
+from decimal import Decimal
+
+import supersummariser.contract_index as object_under_test
+import supersummariser.processors as p
+from supersummariser.database import Account, AccountContact, Contract
+
+
+def _add_account(contract_type, biller, unit_price, managerusername=None, **contract_fields):
+    return Account(
+        order_id='1', name='acc', biller=biller,
+        account_contact=AccountContact(managerusername=managerusername, managerunit='Unit'),
+        contract=Contract(contract_type=contract_type, unit_price=unit_price, **contract_fields))
+
+
+def test_lookup01(db):
+    """ do we key each contract type on the column its usage joins on? """
+    db.session.add_all([
+        _add_account('ersa_account', 'Uni A', Decimal('1'), managerusername='alice'),
+        _add_account('ersa_account', 'Uni B', Decimal('2'), managerusername='alice'),
+        _add_account('attached_storage', 'Uni A', Decimal('3'), file_system_name='vv1'),
+        _add_account('tango_contract', 'Uni B', Decimal('4'), openstack_project_id='vm1'),
+        _add_account('tango_contract', 'Uni C', Decimal('5')),
+    ])
+    db.session.commit()
+    index = object_under_test.ContractIndex()
+    assert sorted(index.lookup('ersa_account', 'alice')) == \
+        [('Uni A', 'Unit', Decimal('1')), ('Uni B', 'Unit', Decimal('2'))]
+    assert index.lookup('attached_storage', 'vv1') == [('Uni A', 'Unit', Decimal('3'))]
+    assert index.lookup('tango_contract', 'vm1') == [('Uni B', 'Unit', Decimal('4'))]
+    assert index.lookup('tango_contract', None) == ()
+    assert index.lookup('nectar_contract', 'vm1') == ()
+
+
+def test_lookup02(db):
+    """ do we only rebuild once the contracts' data version changes? """
+    index = object_under_test.ContractIndex()
+    assert index.lookup('tango_contract', 'vm1') == ()
+    db.session.add(_add_account('tango_contract', 'Uni B', Decimal('4'), openstack_project_id='vm1'))
+    db.session.commit()
+    assert index.lookup('tango_contract', 'vm1') == ()
+    p._bump_version(p.VERSION_CONTRACTS)
+    db.session.commit()
+    assert index.lookup('tango_contract', 'vm1') == [('Uni B', 'Unit', Decimal('4'))]
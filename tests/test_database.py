@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Test database helpers"""
+import supersummariser.database as object_under_test
+
+
+def test__rows_to_copy_text01():
+    """ do we escape values and mark NULLs for COPY? """
+    rows = [
+        {'owner': 'a\tb', 'cores': 1},
+        {'owner': None, 'cores': 2},
+        {'owner': 'back\\slash\n', 'cores': None},
+    ]
+    result = object_under_test._rows_to_copy_text(['owner', 'cores'], rows).read()
+    assert result == 'a\\tb\t1\n\\N\t2\nback\\\\slash\\n\t\\N\n'
+
+
+def test_bulk_insert01(db):
+    """ can we bulk insert rows using the non-PostgreSQL fallback? """
+    rows = [{'year': 2018, 'month': 3, 'owner': 'u%d' % i, 'cores': i} for i in range(3)]
+    object_under_test.bulk_insert(object_under_test.HpcSummaryUsage, rows)
+    db.session.commit()
+    result = object_under_test.HpcSummaryUsage.query.order_by('cores').all()
+    assert [x.owner for x in result] == ['u0', 'u1', 'u2']
+
+
+def test_bulk_insert02(db):
+    """ do we do nothing with no rows? """
+    object_under_test.bulk_insert(object_under_test.HpcSummaryUsage, [])
+    assert object_under_test.HpcSummaryUsage.query.count() == 0
+
+
+def test__month_partition_ddl01():
+    """ do we bound a month's partition by the start of the next month? """
+    result = object_under_test._month_partition_ddl('hpc_summary_usage', 2018, 3)
+    assert result == ('CREATE TABLE IF NOT EXISTS hpc_summary_usage_y2018m03 PARTITION OF '
+        'hpc_summary_usage FOR VALUES FROM (2018, 3) TO (2018, 4)')
+
+
+def test__month_partition_ddl02():
+    """ does December's partition end at January of the next year? """
+    result = object_under_test._month_partition_ddl('tango_usage', 2017, 12)
+    assert result.endswith('tango_usage_y2017m12 PARTITION OF tango_usage '
+        'FOR VALUES FROM (2017, 12) TO (2018, 1)')
+
+
+def test_detach_month_partitions01(db):
+    """ do we leave tables alone when the database can't partition them? """
+    object_under_test.ensure_month_partition(object_under_test.TangoUsage, 2018, 3)
+    result = object_under_test.detach_month_partitions(object_under_test.TangoUsage, 2019, 1)
+    assert result == []
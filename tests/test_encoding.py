@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Test encoding"""
+import json
+from decimal import Decimal
+
+import supersummariser.encoding as object_under_test
+
+
+def test_dumps01():
+    """ do we write Decimals as numbers, with sorted keys? """
+    result = object_under_test.dumps([{'cost': Decimal('1.5'), 'biller': 'Uni A'}])
+    assert result == b'[{"biller":"Uni A","cost":1.5}]'
+
+
+def test_dumps02(monkeypatch):
+    """ does the stdlib fallback give the same bytes? """
+    value = [{'cost': Decimal('1.5'), 'biller': 'Uni A', 'blocks': 3, 'x': None}]
+    expected = object_under_test.dumps(value)
+    monkeypatch.setattr(object_under_test, 'orjson', None)
+    assert object_under_test.dumps(value) == expected
+
+
+def test_to_columns01():
+    """ do we get one array per field, with nulls for missing fields? """
+    result = object_under_test.to_columns([
+        {'biller': 'Uni A', 'cost': 1},
+        {'biller': 'Uni B', 'blocks': 2},
+    ])
+    assert result == {
+        'count': 2,
+        'columns': {
+            'biller': ['Uni A', 'Uni B'],
+            'cost': [1, None],
+            'blocks': [None, 2],
+        }
+    }
+
+
+def test_iter_dumps01(monkeypatch):
+    """ do the chunks add up to the same bytes as dumps? """
+    monkeypatch.setattr(object_under_test, 'STREAM_CHUNK_RECORDS', 2)
+    records = [{'biller': 'Uni %d' % i, 'cost': Decimal(i)} for i in range(5)]
+    for value in ([], records, object_under_test.to_columns(records),
+            object_under_test.to_columns([]), {'a': 1}):
+        chunks = list(object_under_test.iter_dumps(value))
+        assert b''.join(chunks) == object_under_test.dumps(value)
+        json.loads(b''.join(chunks).decode('utf-8'))
+    assert len(list(object_under_test.iter_dumps(records))) == 5
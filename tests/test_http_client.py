@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Test the shared HTTP client"""
+import supersummariser.http_client as object_under_test
+
+
+def _config(**overrides):
+    result = {
+        'SSL_VERIFY': True,
+        'HTTP_POOL_MAXSIZE': 4,
+        'HTTP_MAX_RETRIES': 2,
+        'HTTP_RETRY_BACKOFF_SECS': 0.1,
+    }
+    result.update(overrides)
+    return result
+
+
+def test_get_session01():
+    """ do we reuse the same session for the same config? """
+    object_under_test.close_sessions()
+    first = object_under_test.get_session(_config())
+    second = object_under_test.get_session(_config())
+    assert first is second
+    object_under_test.close_sessions()
+
+
+def test_get_session02():
+    """ do we get a new session when the verify bundle changes? """
+    object_under_test.close_sessions()
+    first = object_under_test.get_session(_config())
+    second = object_under_test.get_session(_config(SSL_VERIFY='comodo-bundle.crt'))
+    assert first is not second
+    assert second.verify == 'comodo-bundle.crt'
+    object_under_test.close_sessions()
+
+
+def test_get_session03():
+    """ is the session configured with pooling and retries? """
+    object_under_test.close_sessions()
+    result = object_under_test.get_session(_config())
+    adapter = result.get_adapter('https://bman.ersa.edu.au')
+    assert adapter._pool_maxsize == 4
+    assert adapter.max_retries.total == 2
+    assert adapter.max_retries.backoff_factor == 0.1
+    assert 503 in adapter.max_retries.status_forcelist
+    assert 'gzip' in result.headers['Accept-Encoding']
+    object_under_test.close_sessions()
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Test metrics"""
+import supersummariser.metrics as object_under_test
+
+
+def test_histogram01():
+    """ do we render cumulative buckets, the sum and the count? """
+    histogram = object_under_test.Histogram('latency', 'how long', ('route',), (0.1, 1))
+    histogram.observe(('/a',), 0.05)
+    histogram.observe(('/a',), 0.5)
+    histogram.observe(('/a',), 5)
+    assert histogram.render() == [
+        '# HELP latency how long',
+        '# TYPE latency histogram',
+        'latency_bucket{route="/a",le="0.1"} 1',
+        'latency_bucket{route="/a",le="1"} 2',
+        'latency_bucket{route="/a",le="+Inf"} 3',
+        'latency_sum{route="/a"} 5.55',
+        'latency_count{route="/a"} 3',
+    ]
+
+
+def test_counter01():
+    """ do we total per label values and escape them? """
+    counter = object_under_test.Counter('records_total', 'records', ('source', 'stage'))
+    counter.inc(('a"b', 'insert'), 2)
+    counter.inc(('a"b', 'insert'), 3)
+    assert counter.render()[2] == 'records_total{source="a\\"b",stage="insert"} 5'
+
+
+def test_recording01():
+    """ do the stages run within a recording get totalled for it? """
+    object_under_test.registry.clear()
+    with object_under_test.recording() as recorder:
+        values = list(object_under_test.timed_iter(iter([1, 2, 3]), 'hcp', 'decode'))
+        with object_under_test.stage('hcp_usage', 'insert'):
+            pass
+        object_under_test.add_records('hcp_usage', 'insert', 3)
+        list(object_under_test.counted_bytes([b'ab', b'c'], 'hcp', 'fetch'))
+    object_under_test.add_records('hcp_usage', 'insert', 10) # not recorded, we've finished
+    assert values == [1, 2, 3]
+    result = {(x['source'], x['stage']): x for x in recorder.to_list()}
+    assert result[('hcp', 'decode')]['records'] == 3
+    assert result[('hcp_usage', 'insert')]['records'] == 3
+    assert result[('hcp', 'fetch')]['bytes'] == 3
+    assert object_under_test.ingest_records.get(('hcp_usage', 'insert')) == 13
+    assert object_under_test.ingest_stage_seconds.count(('hcp', 'decode')) == 1
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""Test processors"""
+import os
+import tempfile
+from decimal import Decimal
+
+import pytest
+
+import supersummariser.metrics as metrics
+import supersummariser.processors as object_under_test
+from supersummariser.database import HpcSummaryUsage, Account, AccountContact, Contract, \
+    DataVersion, NovaFlavor, RollupStale, MonthlyRollup, TangoUsage
+
+
+def _chunked(text, size):
+    return [text[i:i+size] for i in range(0, len(text), size)]
+
+
+def test__iter_json_array01():
+    """ can we parse an array that arrives in tiny chunks? """
+    text = '[{"owner": "a", "cores": 1}, {"owner": "b", "cores": 22}]'
+    result = list(object_under_test._iter_json_array(_chunked(text, 3)))
+    assert result == [{'owner': 'a', 'cores': 1}, {'owner': 'b', 'cores': 22}]
+
+
+def test__iter_json_array02():
+    """ do we wait for the end of a number that's split across chunks? """
+    result = list(object_under_test._iter_json_array(['[1, 2', '34 ,5]']))
+    assert result == [1, 234, 5]
+
+
+def test__iter_json_array03():
+    """ can we handle an empty array with whitespace? """
+    result = list(object_under_test._iter_json_array([' \n[ ', ' ]\n']))
+    assert result == []
+
+
+def test__iter_json_array04():
+    """ do we reject a body that isn't a JSON array? """
+    with pytest.raises(ValueError):
+        list(object_under_test._iter_json_array(['<html>', '</html>']))
+
+
+def test__iter_json_array05():
+    """ do we reject a truncated body? """
+    with pytest.raises(ValueError):
+        list(object_under_test._iter_json_array(['[{"owner": "a"}, {"own']))
+
+
+def test__batches01():
+    """ can we split records into bounded batches? """
+    result = list(object_under_test._batches(iter(range(5)), 2))
+    assert result == [[0, 1], [2, 3], [4]]
+
+
+def test__replace_month01(db):
+    """ do we replace only the records for the month being processed? """
+    db.session.add(HpcSummaryUsage(year=2018, month=2, owner='old'))
+    db.session.add(HpcSummaryUsage(year=2018, month=3, owner='old'))
+    db.session.commit()
+    records = iter([{'owner': 'x%d' % i, 'cores': i} for i in range(5)])
+    object_under_test._replace_month(HpcSummaryUsage, 'hpcsummary', 2018, 3, records,
+        object_under_test._build_hpcsummary, {'INGEST_BATCH_SIZE': 2})
+    march = HpcSummaryUsage.query.filter_by(year=2018, month=3).all()
+    assert sorted(x.owner for x in march) == ['x0', 'x1', 'x2', 'x3', 'x4']
+    assert HpcSummaryUsage.query.filter_by(year=2018, month=2).count() == 1
+    assert DataVersion.query.filter_by(name='hpcsummary 2018-3').one().version == 1
+
+
+def test__replace_month03(db):
+    """ do we record the delete, insert and commit stages against the table? """
+    db.session.add(HpcSummaryUsage(year=2018, month=3, owner='old'))
+    db.session.commit()
+    records = iter([{'owner': 'x%d' % i} for i in range(5)])
+    with metrics.recording() as recorder:
+        object_under_test._replace_month(HpcSummaryUsage, 'hpcsummary', 2018, 3, records,
+            object_under_test._build_hpcsummary, {'INGEST_BATCH_SIZE': 2})
+    result = {x['stage']: x for x in recorder.to_list() if x['source'] == 'hpc_summary_usage'}
+    assert sorted(result) == ['commit', 'delete', 'insert']
+    assert result['delete']['records'] == 1
+    assert result['insert']['records'] == 5
+
+
+def test__replace_month02(db):
+    """ do we keep the old data when the payload fails part way through? """
+    db.session.add(HpcSummaryUsage(year=2018, month=3, owner='old'))
+    db.session.commit()
+    def records():
+        yield {'owner': 'new'}
+        raise ValueError('truncated')
+    with pytest.raises(ValueError):
+        object_under_test._replace_month(HpcSummaryUsage, 'hpcsummary', 2018, 3, records(),
+            object_under_test._build_hpcsummary, {'INGEST_BATCH_SIZE': 1})
+    march = HpcSummaryUsage.query.filter_by(year=2018, month=3).all()
+    assert [x.owner for x in march] == ['old']
+
+
+def test__replace_month04(db):
+    """ do we replace the month in place when the table isn't partitioned, even with a swap? """
+    db.session.add(HpcSummaryUsage(year=2018, month=3, owner='old'))
+    db.session.add(HpcSummaryUsage(year=2018, month=4, owner='old'))
+    db.session.commit()
+    records = iter([{'owner': 'x%d' % i} for i in range(5)])
+    with metrics.recording() as recorder:
+        object_under_test._replace_month(HpcSummaryUsage, 'hpcsummary', 2018, 3, records,
+            object_under_test._build_hpcsummary, {'INGEST_BATCH_SIZE': 2, 'STAGED_MONTH_SWAP': True})
+    march = HpcSummaryUsage.query.filter_by(year=2018, month=3).all()
+    assert sorted(x.owner for x in march) == ['x0', 'x1', 'x2', 'x3', 'x4']
+    assert HpcSummaryUsage.query.filter_by(year=2018, month=4).count() == 1
+    result = {x['stage']: x for x in recorder.to_list() if x['source'] == 'hpc_summary_usage'}
+    assert sorted(result) == ['commit', 'delete', 'insert']
+    assert result['delete']['records'] == 1
+    assert result['insert']['records'] == 5
+
+
+def test__replace_month05(db):
+    """ do we keep the old data when a load with a swap fails, and can the next load still swap? """
+    db.session.add(HpcSummaryUsage(year=2018, month=3, owner='old'))
+    db.session.commit()
+    config = {'INGEST_BATCH_SIZE': 1, 'STAGED_MONTH_SWAP': True}
+    def records():
+        yield {'owner': 'new'}
+        raise ValueError('truncated')
+    with pytest.raises(ValueError):
+        object_under_test._replace_month(HpcSummaryUsage, 'hpcsummary', 2018, 3, records(),
+            object_under_test._build_hpcsummary, config)
+    assert [x.owner for x in HpcSummaryUsage.query.filter_by(year=2018, month=3)] == ['old']
+    object_under_test._replace_month(HpcSummaryUsage, 'hpcsummary', 2018, 3,
+        iter([{'owner': 'retry'}]), object_under_test._build_hpcsummary, config)
+    assert [x.owner for x in HpcSummaryUsage.query.filter_by(year=2018, month=3)] == ['retry']
+
+
+def test__writer01():
+    """ do we serialise the writes whenever tasks can run concurrently? """
+    lock = object_under_test._writer_lock
+    assert object_under_test.writer({'PROCESS_WORKERS': 4}) is lock
+    assert object_under_test.writer({'PROCESS_WORKERS': 1, 'TRANSFORM_PROCESSES': 2}) is lock
+    assert object_under_test.writer({'PROCESS_WORKERS': 1}) is not lock
+
+
+def test__bump_version01(db):
+    """ do we create the version on its first bump then increment it? """
+    object_under_test._bump_version('tango')
+    object_under_test._bump_version('tango')
+    db.session.commit()
+    object_under_test._bump_version('tango')
+    db.session.commit()
+    assert DataVersion.query.filter_by(name='tango').one().version == 3
+
+
+def _payload_file(tmp_path, body):
+    result = tmp_path / 'body.payload'
+    result.write_bytes(body)
+    return str(result)
+
+
+def test__transform01(tmp_path):
+    """ do we decode the payload and build batches of COPY text? """
+    body = _payload_file(tmp_path, b'[{"owner": "a", "cores": 1}, {"owner": "b"}, {"owner": "c"}]')
+    path, count = object_under_test._transform(body, 'utf-8',
+        object_under_test._build_hpcsummary, 2018, 3, 2, True)
+    try:
+        result = list(object_under_test._unpickled_batches(open(path, 'rb')))
+    finally:
+        os.unlink(path)
+    assert count == 3
+    assert [len(x) for x in result] == [2, 1]
+    assert result[0].columns[:3] == ['year', 'month', 'cores']
+    assert result[1].text.startswith('2018\t3\t\\N\t')
+
+
+def test__transform02(monkeypatch, tmp_path):
+    """ do we clean up the batches when the payload isn't a JSON array? """
+    body = _payload_file(tmp_path, b'{"owner": "a"}')
+    batches_dir = tmp_path / 'batches'
+    batches_dir.mkdir()
+    monkeypatch.setattr(tempfile, 'tempdir', str(batches_dir))
+    with pytest.raises(ValueError):
+        object_under_test._transform(body, 'utf-8',
+            object_under_test._build_hpcsummary, 2018, 3, 2, False)
+    assert os.listdir(str(batches_dir)) == []
+
+
+def test__replace_month06(db, tmp_path):
+    """ can we replace the month with rows built by the transform pool? """
+    db.session.add(HpcSummaryUsage(year=2018, month=3, owner='old'))
+    db.session.commit()
+    payload = object_under_test.Payload(
+        _payload_file(tmp_path, b'[{"owner": "a"}, {"owner": "b"}, {"owner": "c"}]'),
+        'utf-8', 'hpcsummary')
+    config = {'INGEST_BATCH_SIZE': 2, 'TRANSFORM_PROCESSES': 1}
+    try:
+        with metrics.recording() as recorder:
+            object_under_test._replace_month(HpcSummaryUsage, 'hpcsummary', 2018, 3, payload,
+                object_under_test._build_hpcsummary, config)
+    finally:
+        object_under_test.shutdown_transform_pools()
+    march = HpcSummaryUsage.query.filter_by(year=2018, month=3).all()
+    assert sorted(x.owner for x in march) == ['a', 'b', 'c']
+    decode = [x for x in recorder.to_list() if x['stage'] == 'decode']
+    assert decode[0]['source'] == 'hpcsummary'
+    assert decode[0]['records'] == 3
+
+
+def _crm_record(order_id, **overrides):
+    result = {
+        'orderID': order_id,
+        'name': 'Account %s' % order_id,
+        'biller': 'Uni A',
+        'allocated': 1,
+        'unitPrice': '0.15',
+        'managerusername': 'user%s' % order_id,
+        'managerunit': 'Unit A',
+    }
+    result.update(overrides)
+    return result
+
+
+def test__diff_contracts01():
+    """ do we skip unchanged contracts and replace changed ones? """
+    unchanged = object_under_test._contract_values(_crm_record('1'))
+    changed = object_under_test._contract_values(_crm_record('2'))
+    stored_changed = dict(changed, managerunit='Old Unit')
+    stored_unchanged = dict(unchanged, unit_price=Decimal('0.150'))
+    new = object_under_test._contract_values(_crm_record('3'))
+    existing = [(10, stored_unchanged), (20, stored_changed)]
+    ids_to_delete, to_insert = object_under_test._diff_contracts(existing,
+        [unchanged, changed, new])
+    assert ids_to_delete == [20]
+    assert [x['order_id'] for x in to_insert] == ['2', '3']
+
+
+def test__diff_contracts02():
+    """ do we replace every stored duplicate of a key? """
+    values = object_under_test._contract_values(_crm_record('1'))
+    existing = [(10, values), (11, values)]
+    ids_to_delete, to_insert = object_under_test._diff_contracts(existing, [values])
+    assert sorted(ids_to_delete) == [10, 11]
+    assert len(to_insert) == 1
+
+
+def test__apiv2_contract_helper01(db, monkeypatch):
+    """ do we only rewrite the contracts that changed between runs? """
+    payload = [_crm_record('1'), _crm_record('2'), _crm_record('2')]
+    monkeypatch.setattr(object_under_test, '_get_json',
+        lambda config, url, handler, source=None: handler(payload))
+    result = object_under_test._apiv2_contract_helper('url', 'ersa_account', {})
+    assert result == object_under_test.STATUS_REWRITTEN
+    assert Account.query.count() == 2
+    result = object_under_test._apiv2_contract_helper('url', 'ersa_account', {})
+    assert result == object_under_test.STATUS_SKIPPED
+    payload = [_crm_record('1'), _crm_record('2', managerunit='Unit B')]
+    result = object_under_test._apiv2_contract_helper('url', 'ersa_account', {})
+    assert result == object_under_test.STATUS_REWRITTEN
+    assert Account.query.count() == 2
+    assert AccountContact.query.count() == 2
+    assert Contract.query.count() == 2
+    units = sorted(x.managerunit for x in AccountContact.query.all())
+    assert units == ['Unit A', 'Unit B']
+
+
+def test__apiv2_contract_helper02(db, monkeypatch):
+    """ do we skip unchanged contracts when the CRM sends the fields as
+        different types to the ones they're stored as? """
+    payload = [_crm_record(1, allocated='2', unitPrice=0.15, OpenstackProjectID=123)]
+    monkeypatch.setattr(object_under_test, '_get_json',
+        lambda config, url, handler, source=None: handler(payload))
+    result = object_under_test._apiv2_contract_helper('url', 'tango_contract', {})
+    assert result == object_under_test.STATUS_REWRITTEN
+    result = object_under_test._apiv2_contract_helper('url', 'tango_contract', {})
+    assert result == object_under_test.STATUS_SKIPPED
+    account = Account.query.one()
+    assert (account.order_id, account.contract.allocated) == ('1', 2)
+    assert account.contract.openstack_project_id == '123'
+
+
+def test_process_nova_flavor01(db, monkeypatch):
+    """ do we only rewrite the flavors, and mark NECTAR as changed, when the
+        payload changes? """
+    payload = [{'id': 1, 'vcpus': 4, 'name': 'm1', 'public': True, 'openstack_id': 'f1'},
+        {'id': 2, 'vcpus': 8, 'name': 'm2', 'public': True, 'openstack_id': 'f2'}]
+    monkeypatch.setattr(object_under_test, '_get_json',
+        lambda config, url, handler, source=None: handler(payload))
+    config = {'USAGE_SERVER': 'http://usage'}
+    results = [object_under_test.process_nova_flavor(config) for _ in range(3)]
+    assert results == ['rewritten', 'skipped', 'skipped']
+    assert NovaFlavor.query.count() == 2
+    assert RollupStale.query.filter_by(service='nectar').count() == 1
+    assert DataVersion.query.filter_by(name='nectar').one().version == 1
+    payload[1] = dict(payload[1], vcpus=16)
+    object_under_test.process_nova_flavor(config)
+    assert sorted(x.vcpus for x in NovaFlavor.query.all()) == [4, 16]
+    assert DataVersion.query.filter_by(name='nectar').one().version == 2
+
+
+class FakeResponse(object):
+    def __init__(self, body, status_code=200, headers=None):
+        self.body = body
+        self.status_code = status_code
+        self.headers = headers or {'Content-type': 'application/json'}
+        self.encoding = 'utf-8'
+
+    def iter_content(self, chunk_size):
+        return _chunked(self.body.encode('utf-8'), chunk_size)
+
+    def close(self):
+        pass
+
+
+def test__get_records_if_changed01(db, monkeypatch):
+    """ do we skip rewriting the month when the payload hasn't changed? """
+    body = '[{"owner": "a", "cores": 1}, {"owner": "b", "cores": 2}]'
+    monkeypatch.setattr(object_under_test.http_client, 'get',
+        lambda config, url, **kwargs: FakeResponse(body))
+    calls = []
+    def handler(records):
+        calls.append(list(records))
+    config = {'STREAM_JSON': True}
+    result = object_under_test._get_records_if_changed(config, 'url', handler, 'hpcsummary', 2018, 3)
+    assert result == object_under_test.STATUS_REWRITTEN
+    result = object_under_test._get_records_if_changed(config, 'url', handler, 'hpcsummary', 2018, 3)
+    assert result == object_under_test.STATUS_SKIPPED
+    assert len(calls) == 1
+    assert [x['owner'] for x in calls[0]] == ['a', 'b']
+    body = '[{"owner": "a", "cores": 1}]'
+    result = object_under_test._get_records_if_changed(config, 'url', handler, 'hpcsummary', 2018, 3)
+    assert result == object_under_test.STATUS_REWRITTEN
+    assert len(calls) == 2
+
+
+def test__get_records_if_changed02(db, monkeypatch):
+    """ do we send the stored ETag and skip when the server replies 304? """
+    sent_headers = []
+    def fake_get(config, url, **kwargs):
+        sent_headers.append(kwargs['headers'])
+        if 'If-None-Match' in kwargs['headers']:
+            return FakeResponse('', status_code=304)
+        return FakeResponse('[]', headers={'ETag': '"v1"'})
+    monkeypatch.setattr(object_under_test.http_client, 'get', fake_get)
+    config = {'STREAM_JSON': False}
+    result = object_under_test._get_records_if_changed(config, 'url', lambda x: None, 'tango', 2018, 3)
+    assert result == object_under_test.STATUS_REWRITTEN
+    result = object_under_test._get_records_if_changed(config, 'url', lambda x: None, 'tango', 2018, 3)
+    assert result == object_under_test.STATUS_SKIPPED
+    assert sent_headers[1]['If-None-Match'] == '"v1"'
+
+
+def test__get_records_if_changed03(db, monkeypatch):
+    """ with TRANSFORM_PROCESSES, does the handler get the spooled body as a
+        file, rather than in memory, which is gone once it returns? """
+    body = '[{"owner": "a", "cores": 1}]'
+    monkeypatch.setattr(object_under_test.http_client, 'get',
+        lambda config, url, **kwargs: FakeResponse(body))
+    payloads = []
+    def handler(payload):
+        with open(payload.path, 'rb') as f:
+            payloads.append((payload.path, f.read()))
+    config = {'TRANSFORM_PROCESSES': 1, 'SPOOL_MAX_MEMORY_BYTES': 1024 * 1024}
+    result = object_under_test._get_records_if_changed(config, 'url', handler, 'hpcsummary', 2018, 3)
+    assert result == object_under_test.STATUS_REWRITTEN
+    assert payloads[0][1] == body.encode('utf-8')
+    assert not os.path.exists(payloads[0][0])
+
+
+def test_detach_months01(app, db, monkeypatch):
+    """ does a detached month drop out of the rollup, and is it rebuilt,
+        partition and all, when it's ingested again rather than skipped as
+        unchanged? SQLite can't partition, so the detach just deletes. """
+    import supersummariser.services as services
+    db.session.add(Account(order_id='1', name='acc', biller='Uni B',
+        account_contact=AccountContact(managerunit='Chemistry'),
+        contract=Contract(contract_type='tango_contract', unit_price=Decimal('10'),
+            openstack_project_id='vm1')))
+    db.session.commit()
+    body = '[{"id": "vm1", "core": 2, "businessUnit": "Chemistry"}]'
+    monkeypatch.setattr(object_under_test.http_client, 'get',
+        lambda config, url, **kwargs: FakeResponse(body))
+    ensured = []
+    monkeypatch.setattr(object_under_test.database, 'ensure_month_partition',
+        lambda model, year, month: ensured.append((model, year, month)))
+    def fake_detach(model, before_year, before_month):
+        if model is not TangoUsage:
+            return []
+        TangoUsage.query.filter_by(year=2018, month=3).delete()
+        db.session.commit()
+        return [('tango_usage_y2018m03_detached', 2018, 3)]
+    monkeypatch.setattr(object_under_test.database, 'detach_month_partitions', fake_detach)
+    config = dict(app.config, STREAM_JSON=True)
+    def rollup_cores():
+        return [x.core for x in MonthlyRollup.query.filter_by(service='tango', year=2018, month=3)]
+    assert object_under_test.process_tango(2018, 3, config) == object_under_test.STATUS_REWRITTEN
+    services.refresh_rollups(config)
+    assert rollup_cores() == [2]
+    assert object_under_test.detach_months(2018, 4) == ['tango_usage_y2018m03_detached']
+    services.refresh_rollups(config)
+    assert rollup_cores() == []
+    assert object_under_test.process_tango(2018, 3, config) == object_under_test.STATUS_REWRITTEN
+    assert ensured == [(TangoUsage, 2018, 3)] * 2
+    services.refresh_rollups(config)
+    assert rollup_cores() == [2]
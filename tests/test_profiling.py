@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""Test profiling"""
+import logging
+
+import supersummariser.profiling as object_under_test
+from supersummariser.database import HpcSummaryUsage
+
+
+def test_profiled01(db):
+    """ do we record each query and the time in each section? """
+    db.session.add(HpcSummaryUsage(year=2018, month=3, owner='alice'))
+    db.session.commit()
+    @object_under_test.timed('build_dict')
+    def build(x):
+        return {'owner': x}
+    with object_under_test.profiled() as profile:
+        found = HpcSummaryUsage.query.all()
+        build(found[0].owner)
+    HpcSummaryUsage.query.all() # not profiled, we've finished
+    result = profile.to_dict()
+    assert result['query_count'] == 1
+    assert 'hpc_summary_usage' in result['queries'][0]['sql']
+    assert result['queries'][0]['elapsed_ms'] >= 0
+    assert 'build_dict_ms' in result
+    assert result['total_ms'] >= result['db_ms']
+    assert 'build_dict;dur=' in profile.server_timing()
+
+
+def test_profiled02(db, caplog):
+    """ do we log queries slower than the threshold? """
+    with caplog.at_level(logging.WARNING, logger='profiling'):
+        with object_under_test.profiled(slow_query_ms=0.000001):
+            HpcSummaryUsage.query.all()
+    assert 'Slow query' in caplog.text
+    assert 'hpc_summary_usage' in caplog.text
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Test scheduler"""
+import pendulum
+
+import supersummariser.scheduler as object_under_test
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLock(object):
+    def __init__(self, available=True):
+        self.available = available
+        self.held = False
+
+    def acquire(self, blocking=False):
+        if not self.available:
+            return False
+        self.held = True
+        return True
+
+    def release(self):
+        self.held = False
+
+
+def _stub_run_tasks(monkeypatch):
+    result = []
+    def stub(tasks, config, progress=None):
+        result.append([x[0] for x in tasks])
+        return {'success': True, 'elapsed_ms': 0, 'months_rewritten': [], 'months_skipped': []}
+    monkeypatch.setattr(object_under_test.services, 'run_tasks', stub)
+    monkeypatch.setattr(object_under_test.services, '_now_provider',
+        lambda: pendulum.create(2018, 3, 15))
+    return result
+
+
+def test_build_schedules01(monkeypatch):
+    """ do the schedules cover the current month, contracts and older months? """
+    runs = _stub_run_tasks(monkeypatch)
+    schedules = object_under_test.build_schedules({
+        'SCHEDULE_CURRENT_MONTH_SECS': 60,
+        'SCHEDULE_CONTRACTS_SECS': 600,
+        'SCHEDULE_HISTORICAL_SECS': 6000,
+        'SCHEDULE_HISTORICAL_MONTHS': 3,
+    })
+    scheduler = object_under_test.Scheduler(schedules, {}, FakeLock(), clock=FakeClock())
+    scheduler.start()
+    assert scheduler.run_pending() == ['current_month', 'contracts', 'historical_months']
+    assert 'tango 2018-3' in runs[0]
+    assert 'hpcsummary 2018-2' not in runs[0]
+    assert 'ersaaccount' in runs[1]
+    assert 'hpcsummary 2018-1' in runs[2]
+    assert 'hpcsummary 2018-3' not in runs[2]
+
+
+def test_run_pending01(monkeypatch):
+    """ do we run each schedule at its own cadence, with jitter? """
+    runs = _stub_run_tasks(monkeypatch)
+    clock = FakeClock()
+    schedules = [
+        object_under_test.Schedule('fast', 60, lambda now: [('a', None, ())]),
+        object_under_test.Schedule('slow', 600, lambda now: [('b', None, ())]),
+    ]
+    scheduler = object_under_test.Scheduler(schedules, {}, FakeLock(), jitter_secs=10,
+        clock=clock, rand=lambda lo, hi: hi)
+    scheduler.start()
+    assert scheduler.run_pending() == []
+    clock.now += 10
+    assert scheduler.run_pending() == ['fast', 'slow']
+    assert scheduler.seconds_until_next() == 70
+    clock.now += 70
+    assert scheduler.run_pending() == ['fast']
+    assert runs == [['a'], ['b'], ['a']]
+
+
+def test_run_pending02(monkeypatch):
+    """ do we defer, rather than run, while another process holds the lock? """
+    runs = _stub_run_tasks(monkeypatch)
+    clock = FakeClock()
+    lock = FakeLock(available=False)
+    schedules = [object_under_test.Schedule('fast', 60, lambda now: [('a', None, ())])]
+    scheduler = object_under_test.Scheduler(schedules, {}, lock, jitter_secs=30,
+        clock=clock, rand=lambda lo, hi: hi)
+    scheduler.start_now()
+    assert scheduler.run_pending() == []
+    assert scheduler.seconds_until_next() == 30
+    lock.available = True
+    clock.now += 30
+    assert scheduler.run_pending() == ['fast']
+    assert runs == [['a']]
+    assert lock.held == False
+
+
+def test_ingest_lock01(tmpdir):
+    """ can only one holder have the lock at a time? """
+    path = str(tmpdir.join('ingest.lock'))
+    first = object_under_test.IngestLock(path)
+    second = object_under_test.IngestLock(path)
+    assert first.acquire() == True
+    assert second.acquire() == False
+    first.release()
+    assert second.acquire() == True
+    second.release()
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 """Test services"""
 import logging
+
+import pytest
 from decimal import Decimal
 
+from flask import Flask
 import supersummariser.services as object_under_test
+from supersummariser.processors import ProcessingFailedError, STATUS_REWRITTEN, \
+    STATUS_SKIPPED
+from supersummariser.database import Account, AccountContact, Contract, NovaFlavor, \
+    HpcSummaryUsage, HnasVVUsage, HcpUsage, HpcHomeUsage, NectarUsage, TangoUsage, \
+    XfsUsage, MonthlyRollup, RollupStale
 import pendulum
 from decimal import Decimal
 
@@ -50,6 +58,10 @@ def test__get_months_to_process04():
 
 
 class MockProcesses(object):
+    ProcessingFailedError = ProcessingFailedError
+    STATUS_REWRITTEN = STATUS_REWRITTEN
+    STATUS_SKIPPED = STATUS_SKIPPED
+
     @staticmethod
     def process_ersaaccount(c):
         pass
@@ -86,16 +98,20 @@ class MockProcesses(object):
 
 
 class StubConfig(object):
+    def __init__(self, **values):
+        self.values = values
+
     def get(self, key):
-        return None
+        return self.values.get(key)
 
 
-def test_process01():
+def test_process01(monkeypatch):
     """ can we process for the default number of months? """
-    object_under_test.p = MockProcesses()
+    monkeypatch.setattr(object_under_test, 'refresh_rollups', lambda c: {})
+    monkeypatch.setattr(object_under_test, 'p', MockProcesses())
     def mock_now_provider():
         return pendulum.create(2018, 3, 15)
-    object_under_test._now_provider = mock_now_provider
+    monkeypatch.setattr(object_under_test, '_now_provider', mock_now_provider)
     object_under_test.logger.setLevel(logging.WARN)
     result = object_under_test.process(2, StubConfig())
     object_under_test.logger.setLevel(logging.DEBUG)
@@ -104,6 +120,106 @@ def test_process01():
     months_processed.index('2018-2')
     months_processed.index('2018-3')
     assert result['elapsed_ms'] >= 0
+    task_names = [x['name'] for x in result['timings']]
+    task_names.index('ersaaccount')
+    task_names.index('hpcsummary 2018-2')
+    task_names.index('tango 2018-3')
+
+
+def test_process02(monkeypatch):
+    """ can we process with a pool of workers? """
+    monkeypatch.setattr(object_under_test, 'refresh_rollups', lambda c: {})
+    monkeypatch.setattr(object_under_test, 'p', MockProcesses())
+    def mock_now_provider():
+        return pendulum.create(2018, 3, 15)
+    monkeypatch.setattr(object_under_test, '_now_provider', mock_now_provider)
+    object_under_test.logger.setLevel(logging.WARN)
+    with Flask('test_process02').app_context():
+        result = object_under_test.process(3, StubConfig(PROCESS_WORKERS=4))
+    object_under_test.logger.setLevel(logging.DEBUG)
+    assert result['success'] == True
+    assert len(result['timings']) == 6 + (3 * 5)
+    assert result['timings'][0]['name'] == 'ersaaccount'
+
+
+def test_process03(monkeypatch):
+    """ do we report failure when one of the concurrent tasks fails? """
+    class FailingProcesses(MockProcesses):
+        @staticmethod
+        def process_nectar(y, m, c):
+            raise ProcessingFailedError('nectar is down')
+    monkeypatch.setattr(object_under_test, 'p', FailingProcesses())
+    object_under_test.logger.setLevel(logging.WARN)
+    with Flask('test_process03').app_context():
+        result = object_under_test.process(2, StubConfig(PROCESS_WORKERS=4))
+    object_under_test.logger.setLevel(logging.DEBUG)
+    assert result['success'] == False
+    assert result['message'] == 'nectar is down'
+
+
+def test_process04(monkeypatch):
+    """ do we report which months were skipped because upstream hadn't changed? """
+    class SkippingProcesses(MockProcesses):
+        @staticmethod
+        def process_hpcsummary(y, m, c):
+            return STATUS_SKIPPED if m == 2 else STATUS_REWRITTEN
+    monkeypatch.setattr(object_under_test, 'refresh_rollups', lambda c: {})
+    monkeypatch.setattr(object_under_test, 'p', SkippingProcesses())
+    monkeypatch.setattr(object_under_test, '_now_provider', lambda: pendulum.create(2018, 3, 15))
+    object_under_test.logger.setLevel(logging.WARN)
+    result = object_under_test.process(2, StubConfig())
+    object_under_test.logger.setLevel(logging.DEBUG)
+    assert result['months_skipped'] == ['hpcsummary 2018-2']
+    assert result['months_rewritten'] == ['hpcsummary 2018-3']
+
+
+def test_process05(monkeypatch):
+    """ do we report the progress of each task as it runs? """
+    monkeypatch.setattr(object_under_test, 'refresh_rollups', lambda c: {})
+    monkeypatch.setattr(object_under_test, 'p', MockProcesses())
+    monkeypatch.setattr(object_under_test, '_now_provider', lambda: pendulum.create(2018, 3, 15))
+    progress = []
+    object_under_test.logger.setLevel(logging.WARN)
+    object_under_test.process(1, StubConfig(), progress=lambda *x: progress.append(x))
+    object_under_test.logger.setLevel(logging.DEBUG)
+    tango = [x[1] for x in progress if x[0] == 'tango 2018-3']
+    assert tango == ['pending', 'running', 'done']
+
+
+def test_process06(monkeypatch):
+    """ do we report a task whose processor doesn't return a status as done,
+        and leave the contract tasks out of the months rewritten? """
+    class CountingProcesses(MockProcesses):
+        @staticmethod
+        def process_ersaaccount(c):
+            return 0
+        @staticmethod
+        def process_tango_contract(c):
+            return STATUS_REWRITTEN
+    monkeypatch.setattr(object_under_test, 'refresh_rollups', lambda c: {})
+    monkeypatch.setattr(object_under_test, 'p', CountingProcesses())
+    monkeypatch.setattr(object_under_test, '_now_provider', lambda: pendulum.create(2018, 3, 15))
+    progress = []
+    object_under_test.logger.setLevel(logging.WARN)
+    result = object_under_test.process(1, StubConfig(), progress=lambda *x: progress.append(x))
+    object_under_test.logger.setLevel(logging.DEBUG)
+    assert ('ersaaccount', 'done') in progress
+    assert ('tango_contract', STATUS_REWRITTEN) in progress
+    assert result['months_rewritten'] == []
+
+
+def test__tables_with_deletes01():
+    """ do we only pick the tables that rows were deleted from? """
+    def stage(source, stage, records):
+        return {'source': source, 'stage': stage, 'records': records}
+    timings = [
+        {'stages': [stage('hpcsummary', 'fetch', 0), stage('hpc_summary_usage', 'delete', 3)]},
+        {'stages': [stage('tango_usage', 'delete', 0), stage('tango_usage', 'insert', 5)]},
+        {'stages': [stage('tango_contract', 'delete', 2), stage('hcp_usage', 'delete', 1)]},
+    ]
+    result = object_under_test._tables_with_deletes(timings)
+    assert result == ['hcp_usage', 'hpc_summary_usage']
+
 
 def test_calculate_cost01():
     """ can we calculate the cost for a simple scenario """
@@ -158,3 +274,198 @@ def test_clean_types01():
     assert type(result['foo']) == float
     assert result['foo'] == 1.23
     assert result['bar'] == 'blah'
+
+
+def _add_account(contract_type, biller, managerunit, unit_price, managerusername=None, **contract_fields):
+    return Account(
+        order_id='1', name='acc', biller=biller,
+        account_contact=AccountContact(managerusername=managerusername, managerunit=managerunit),
+        contract=Contract(contract_type=contract_type, unit_price=unit_price, **contract_fields))
+
+
+def _seed_usage(db, months):
+    """ adds contracts and a little usage for every service in each month """
+    db.session.add_all([
+        _add_account('ersa_account', 'Uni A', 'Physics', Decimal('0.02'), managerusername='alice'),
+        _add_account('ersa_account', 'Uni B', 'Chemistry', Decimal('0.03'), managerusername='bob'),
+        _add_account('attached_storage', 'Uni A', 'Physics', Decimal('5'), file_system_name='vv1'),
+        _add_account('attached_storage_backup', 'Uni B', 'Chemistry', Decimal('7'), file_system_name='ns1'),
+        _add_account('nectar_contract', 'Uni A', 'Physics', None, openstack_project_id='tenant1'),
+        _add_account('tango_contract', 'Uni B', 'Chemistry', Decimal('10'), openstack_project_id='vm1'),
+        NovaFlavor(openstack_id='flavor1', vcpus=4),
+    ])
+    for i, (year, month) in enumerate(months):
+        ym = {'year': year, 'month': month}
+        db.session.add_all([
+            HpcSummaryUsage(owner='alice', cores=4 + i, cpu_seconds=7200 * (i + 1), job_count=2, **ym),
+            HpcSummaryUsage(owner='bob', cores=1, cpu_seconds=360, job_count=1, **ym),
+            HnasVVUsage(virtual_volume='vv1', usage=300000 + i, **ym),
+            HcpUsage(namespace='ns1', ingested_bytes=5 * 1073741824 * (i + 1), **ym),
+            HpcHomeUsage(owner='alice', usage=300 * 1048576 * (i + 1), **ym),
+            NectarUsage(tenant='tenant1', flavor='flavor1', **ym),
+            TangoUsage(vm_id='vm1', core=2 + i, **ym),
+        ])
+    db.session.commit()
+
+
+def _sorted(rows):
+    return sorted(rows, key=lambda x: sorted((k, str(v)) for k, v in x.items()))
+
+
+SERVICE_NAMES = ['hpcsummary', 'allocationsummary', 'hpcstorage', 'nectar', 'tango']
+
+
+def test_refresh_rollups01(app, db):
+    """ do the rollup backed reads match the live aggregates? """
+    now = pendulum.now()
+    months = [(x.year, x.month) for x in [now.subtract(months=1), now]]
+    _seed_usage(db, months)
+    for curr in SERVICE_NAMES:
+        db.session.add(RollupStale(service=curr))
+    db.session.commit()
+    result = object_under_test.refresh_rollups(app.config)
+    assert sorted(result.keys()) == sorted(SERVICE_NAMES)
+    assert RollupStale.query.count() == 0
+    assert MonthlyRollup.query.count() > 0
+    for curr in SERVICE_NAMES:
+        simple = getattr(object_under_test, 'get_%s_simple' % curr)
+        live_simple = getattr(object_under_test, '_live_%s_simple' % curr)
+        chart = getattr(object_under_test, 'get_%s_chart' % curr)
+        live_chart = getattr(object_under_test, '_live_%s_chart' % curr)
+        for year, month in months:
+            expected = _sorted(live_simple(year, month, app.config))
+            assert len(expected) > 0, curr
+            assert _sorted(simple(year, month, app.config)) == expected, curr
+        expected = _sorted(live_chart(None, 12, app.config))
+        assert _sorted(chart(None, 12, app.config)) == expected, curr
+        expected = _sorted(live_chart('Uni A', 12, app.config))
+        assert _sorted(chart('Uni A', 12, app.config)) == expected, curr
+
+
+def test_get_chart01(app, db):
+    """ is the all service chart every service's chart, with or without a
+        current rollup? """
+    now = pendulum.now()
+    months = [(x.year, x.month) for x in [now.subtract(months=13), now.subtract(months=1), now]]
+    _seed_usage(db, months)
+    for curr in SERVICE_NAMES:
+        db.session.add(RollupStale(service=curr))
+    db.session.commit()
+    object_under_test.refresh_rollups(app.config)
+    assert MonthlyRollup.query.filter(MonthlyRollup.period == None).count() == 0
+    db.session.add(RollupStale(service='nectar', year=now.year, month=now.month))
+    db.session.commit()
+    for org_filter in (None, 'Uni A'):
+        expected = []
+        for curr in SERVICE_NAMES:
+            expected.extend(getattr(object_under_test, 'get_%s_chart' % curr)(org_filter, 12,
+                app.config))
+        result = object_under_test.get_chart(org_filter, 12, app.config)
+        assert _sorted(result) == _sorted(expected)
+        assert {x['year'] for x in result} == {now.subtract(months=1).year, now.year}
+
+
+def test_live_hpcsummary_simple01(app, db):
+    """ like the SQL join, does usage count towards every contract for the key? """
+    _seed_usage(db, [(2018, 3)])
+    db.session.add(_add_account('ersa_account', 'Uni C', 'Maths', Decimal('0.02'),
+        managerusername='alice'))
+    db.session.commit()
+    result = object_under_test._live_hpcsummary_simple(2018, 3, app.config)
+    by_biller = {x['biller']: x for x in result}
+    assert sorted(by_biller) == ['Uni A', 'Uni B', 'Uni C']
+    assert by_biller['Uni C']['cpu_seconds'] == by_biller['Uni A']['cpu_seconds'] == 7200
+    assert by_biller['Uni B']['cpu_seconds'] == 360
+
+
+@pytest.mark.parametrize('service_name', ['hpcstorage', 'nectar', 'tango'])
+def test_live_simple_cost01(app, db, monkeypatch, service_name):
+    """ is the cost worked out by calculate_cost, so profiling counts it? """
+    _seed_usage(db, [(2018, 3)])
+    calls = []
+    calculate_cost = object_under_test.calculate_cost
+    def fake_calculate_cost(usage, cost):
+        calls.append((usage, cost))
+        return calculate_cost(usage, cost)
+    monkeypatch.setattr(object_under_test, 'calculate_cost', fake_calculate_cost)
+    live_simple = getattr(object_under_test, '_live_%s_simple' % service_name)
+    result = live_simple(2018, 3, app.config)
+    assert len(result) > 0
+    assert [x['cost'] for x in result] == [x[0] * x[1] for x in calls]
+
+
+def test_live_allocationsummary_simple01(app, db):
+    """ are blocks charged per storage system before the systems are totalled? """
+    _seed_usage(db, [(2018, 3)])
+    db.session.add(_add_account('attached_storage', 'Uni A', 'Physics', Decimal('5'),
+        file_system_name='fs1'))
+    db.session.add(XfsUsage(filesystem='fs1', usage=107374182, year=2018, month=3))
+    db.session.commit()
+    result = object_under_test._live_allocationsummary_simple(2018, 3, app.config)
+    by_biller = {x['biller']: x for x in result}
+    assert sorted(by_biller) == ['Uni A', 'Uni B']
+    uni_a = by_biller['Uni A']
+    assert uni_a['blocks'] == 3 # 2 for vv1's 300GB and 1 for fs1's ~100GB, not 2 for the total
+    assert uni_a['cost'] == 15
+    assert uni_a['usage'] == pytest.approx(400, abs=1)
+
+
+def test_allocationsummary_chart_label01(app, db):
+    """ is the window labelled with the latest month of the last storage
+        system used, as the per system loop did, by the live, rollup and all
+        service charts? """
+    now = pendulum.now()
+    last_month = now.subtract(months=1)
+    months = [(x.year, x.month) for x in [last_month, now]]
+    _seed_usage(db, months)
+    db.session.add(_add_account('attached_storage', 'Uni A', 'Physics', Decimal('5'),
+        file_system_name='fs1'))
+    db.session.add(XfsUsage(filesystem='fs1', usage=107374182, year=last_month.year,
+        month=last_month.month))
+    db.session.commit()
+    live = object_under_test._live_allocationsummary_chart(None, 12, app.config)
+    by_biller = {x['biller']: x for x in live}
+    assert (by_biller['Uni A']['year'], by_biller['Uni A']['month']) == months[0]
+    assert (by_biller['Uni B']['year'], by_biller['Uni B']['month']) == months[1]
+    db.session.add(RollupStale(service='allocationsummary'))
+    db.session.commit()
+    object_under_test.refresh_rollups(app.config)
+    result = object_under_test.get_allocationsummary_chart(None, 12, app.config)
+    assert _sorted(result) == _sorted(live)
+    result = object_under_test.get_chart(None, 12, app.config)
+    assert _sorted([x for x in result if x['service'] == 'National Storage']) == _sorted(live)
+
+
+def test_get_tango_simple01(app, db):
+    """ do we fall back to the raw usage while the rollup is stale? """
+    _seed_usage(db, [(2018, 3)])
+    db.session.add(RollupStale(service='tango'))
+    db.session.commit()
+    object_under_test.refresh_rollups(app.config)
+    TangoUsage.query.update({'core': 10})
+    db.session.add(RollupStale(service='tango', year=2018, month=3))
+    db.session.commit()
+    assert object_under_test.get_tango_simple(2018, 3, app.config)[0]['core'] == 10
+    object_under_test.refresh_rollups(app.config)
+    TangoUsage.query.update({'core': 20}) # nothing marked stale this time
+    db.session.commit()
+    assert object_under_test.get_tango_simple(2018, 3, app.config)[0]['core'] == 10
+
+
+def test_get_summary01(app, db):
+    """ does the summary agree with the simple endpoints, stale or not? """
+    _seed_usage(db, [(2018, 3)])
+    for curr in SERVICE_NAMES:
+        db.session.add(RollupStale(service=curr))
+    db.session.commit()
+    live = object_under_test.get_summary(2018, 3, app.config)
+    object_under_test.refresh_rollups(app.config)
+    result = object_under_test.get_summary(2018, 3, app.config)
+    assert result == live
+    assert [x['biller'] for x in result] == ['Uni A', 'Uni B']
+    uni_a = result[0]
+    expected_hpc = sum(x['fee_dollars'] for x in
+        object_under_test.get_hpcsummary_simple(2018, 3, app.config) if x['biller'] == 'Uni A')
+    assert uni_a['hpcsummary'] == expected_hpc
+    assert uni_a['tango'] == 0
+    assert uni_a['total'] == pytest.approx(sum(uni_a[x] for x in SERVICE_NAMES))